@@ -4,6 +4,7 @@ from . import tm_io
 from . import tm_func
 from . import tfce
 from . import adjacency
+from . import tm_mesh
 
 from . import tmanalysis
 from . import tm_multisurface
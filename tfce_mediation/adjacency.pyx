@@ -3,6 +3,10 @@ cimport numpy
 cimport cython
 
 from libcpp.vector cimport vector
+from scipy.spatial import cKDTree
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+from tfce_mediation.tm_io import CSRAdjacency
 
 #    Create adjacency set based on geodesic distance
 #    Copyright (C) 2016  Lea Waller
@@ -20,64 +24,216 @@ from libcpp.vector cimport vector
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-cdef extern from "geodesic/geodesic_mesh_elements.h" namespace "geodesic":
+cdef extern from "geodesic/geodesic_mesh_elements.h" namespace "geodesic" nogil:
 	cdef cppclass Vertex:
 		Vertex() 
 	cdef cppclass SurfacePoint:
 		SurfacePoint()
 		SurfacePoint(Vertex*)
 
-cdef extern from "geodesic/geodesic_mesh.h" namespace "geodesic":
+cdef extern from "geodesic/geodesic_mesh.h" namespace "geodesic" nogil:
 		cdef cppclass Mesh:
 				Mesh()
 				void initialize_mesh_data[P, F](unsigned num_vertices, P*, unsigned num_faces, F*)
 				vector[Vertex]& vertices()
 
-cdef extern from "geodesic/geodesic_algorithm_exact.h" namespace "geodesic":
-	cdef cppclass GeodesicAlgorithmExact:
-		GeodesicAlgorithmExact(Mesh*)
-
+cdef extern from "geodesic/geodesic_algorithm_base.h" namespace "geodesic" nogil:
+	cdef cppclass GeodesicAlgorithmBase:
 		void propagate(vector[SurfacePoint]&, double)
 		unsigned best_source(SurfacePoint&, double&)
 
+cdef extern from "geodesic/geodesic_algorithm_exact.h" namespace "geodesic" nogil:
+	cdef cppclass GeodesicAlgorithmExact(GeodesicAlgorithmBase):
+		GeodesicAlgorithmExact(Mesh*)
 
-def compute(numpy.ndarray[float, ndim=2, mode="c"] v,
-						numpy.ndarray[int, ndim=2, mode="c"] f,
-						numpy.ndarray[float, ndim=1, mode="c"] thresholds):
-	
-	cdef Mesh Mesh_
-	Mesh_.initialize_mesh_data[float, int](v.shape[0], &v[0, 0], f.shape[0], &f[0, 0])
+cdef extern from "geodesic/geodesic_algorithm_dijkstra.h" namespace "geodesic" nogil:
+	cdef cppclass GeodesicAlgorithmDijkstra(GeodesicAlgorithmBase):
+		GeodesicAlgorithmDijkstra(Mesh*)
 
-	cdef GeodesicAlgorithmExact *Algorithm = new GeodesicAlgorithmExact(&Mesh_)
+cdef extern from "geodesic/geodesic_algorithm_subdivision.h" namespace "geodesic" nogil:
+	cdef cppclass GeodesicAlgorithmSubdivision(GeodesicAlgorithmBase):
+		GeodesicAlgorithmSubdivision(Mesh*, unsigned)
 
-	cdef vector[SurfacePoint] *Source = new vector[SurfacePoint](1)
+# exact: exact polyhedral geodesic distance (Mitchell, Mount and Papadimitriou)
+# subdivision: shortest paths on a graph with subdivision_level extra nodes on each edge (approximate, overestimates)
+# dijkstra: shortest paths along the mesh edges (approximate, overestimates)
+GEODESIC_METHODS = ['exact', 'subdivision', 'dijkstra']
 
-	cdef SurfacePoint Target
 
-	cdef double Distance = 0
-	cdef double maxDistance = numpy.max(thresholds) + 1e-10 # epsilon
+# Symmetric CSR adjacency (with distances) from a list of vertex pairs (i < j)
+def pairs_to_csr(nvertices, source, target, distances):
+	rows = numpy.concatenate((source, target))
+	cols = numpy.concatenate((target, source))
+	dist = numpy.concatenate((distances, distances))
+	order = numpy.lexsort((cols, rows))
+	indptr = numpy.zeros(nvertices + 1, dtype = numpy.int32)
+	numpy.cumsum(numpy.bincount(rows, minlength = nvertices), out = indptr[1:])
+	return CSRAdjacency(indptr, cols[order], dist[order])
 
-	adjacency = [[[] for i in xrange(v.shape[0])] for k in xrange(thresholds.shape[0])]
+# Geodesic distance engine with its own copy of the mesh. The mesh and the algorithm are built once, and the distances
+# from a block of sources are computed without the GIL, so workers in different threads run concurrently.
+cdef class GeodesicDistanceWorker:
+	cdef Mesh *Mesh_
+	cdef GeodesicAlgorithmBase *Algorithm
+	cdef vector[SurfacePoint] *Source
 
-	for i in range(0, v.shape[0]):
-		Source[0][0] = SurfacePoint(&Mesh_.vertices()[i])
-		Algorithm.propagate(Source[0], maxDistance)
+	def __cinit__(self, numpy.ndarray[float, ndim=2, mode="c"] v, numpy.ndarray[int, ndim=2, mode="c"] f, method = 'exact', unsigned subdivision_level = 2):
+		if method not in GEODESIC_METHODS:
+			raise ValueError("Unknown geodesic method %s. Choose from: %s" % (method, ', '.join(GEODESIC_METHODS)))
+		self.Mesh_ = new Mesh()
+		self.Mesh_.initialize_mesh_data[float, int](v.shape[0], &v[0, 0], f.shape[0], &f[0, 0])
+		if method == 'exact':
+			self.Algorithm = new GeodesicAlgorithmExact(self.Mesh_)
+		elif method == 'subdivision':
+			self.Algorithm = new GeodesicAlgorithmSubdivision(self.Mesh_, subdivision_level)
+		else:
+			self.Algorithm = new GeodesicAlgorithmDijkstra(self.Mesh_)
+		self.Source = new vector[SurfacePoint](1)
 
-		for j in range(i + 1, v.shape[0]):
-			Target = SurfacePoint(&Mesh_.vertices()[j])
-			Algorithm.best_source(Target, Distance)
+	def __dealloc__(self):
+		del self.Source
+		del self.Algorithm
+		del self.Mesh_
 
-			for k in range(thresholds.shape[0]):
-				if Distance < thresholds[k]:
-					print("--> (" + str(i) + ", " + str(j) + ") " + str(thresholds[k]))
-					adjacency[k][j].append(i)
-					adjacency[k][i].append(j)
+	# distances from each source to its targets indices[indptr[s]:indptr[s + 1]]
+	def distances(self, int[::1] sources, int[::1] indptr, int[::1] indices, float[::1] out, double maxDistance):
+		cdef SurfacePoint Target
+		cdef double Distance = 0
+		cdef int s, k
+		with nogil:
+			for s in range(sources.shape[0]):
+				self.Source[0][0] = SurfacePoint(&self.Mesh_.vertices()[sources[s]])
+				self.Algorithm.propagate(self.Source[0], maxDistance)
+				for k in range(indptr[s], indptr[s + 1]):
+					Target = SurfacePoint(&self.Mesh_.vertices()[indices[k]])
+					self.Algorithm.best_source(Target, Distance)
+					out[k] = Distance
 
-	del Source
-	del Algorithm
+# Geodesic distance of all vertex pairs (i < j) closer than threshold. The propagation from each vertex is bounded by
+# the threshold, and only the vertices inside a euclidean ball of that radius (a superset of the vertices within the
+# geodesic distance) are evaluated. Blocks of sources are processed by nthreads workers, each with its own mesh.
+# Returns int32 source and target indices and float32 distances, ordered by source then target. If a GeodesicCache
+# (tm_io) is given, a cached list with the same mesh, method and an equal or larger threshold is returned instead.
+def compute_distance_pairs(v, f, threshold, nthreads = 1, blocksize = 1024, method = 'exact', subdivision_level = 2, cache = None):
+	v = numpy.ascontiguousarray(v, dtype = numpy.float32)
+	f = numpy.ascontiguousarray(f, dtype = numpy.int32)
+	if cache is not None:
+		mesh_key = cache.mesh_key(v, f, method, subdivision_level)
+		cached = cache.get(mesh_key, threshold)
+		if cached is not None:
+			return cached
+	maxDistance = float(threshold) + 1e-10 # epsilon
+	nvertices = v.shape[0]
+	tree = cKDTree(v)
+	blocks = list(range(0, nvertices, blocksize))
+	results = [None] * len(blocks)
+
+	def compute_blocks(worker_id):
+		worker = GeodesicDistanceWorker(v, f, method, subdivision_level)
+		for b in range(worker_id, len(blocks), nthreads):
+			start = blocks[b]
+			stop = min(start + blocksize, nvertices)
+			pairs = cKDTree(v[start:stop]).sparse_distance_matrix(tree, maxDistance * (1 + 1e-6) + 1e-6, output_type = 'ndarray')
+			source = pairs['i'].astype(numpy.int32) + start
+			target = pairs['j'].astype(numpy.int32)
+			order = numpy.lexsort((target, source))
+			source = source[order]
+			target = target[order]
+			keep = target > source
+			source = source[keep]
+			target = numpy.ascontiguousarray(target[keep])
+			indptr = numpy.zeros(stop - start + 1, dtype = numpy.int32)
+			numpy.cumsum(numpy.bincount(source - start, minlength = stop - start), out = indptr[1:])
+			distances = numpy.empty(target.shape[0], dtype = numpy.float32)
+			worker.distances(numpy.arange(start, stop, dtype = numpy.int32), indptr, target, distances, maxDistance)
+			within = distances < float(threshold)
+			results[b] = (source[within], target[within], distances[within])
 
+	with ThreadPoolExecutor(max_workers = nthreads) as executor:
+		list(executor.map(compute_blocks, range(nthreads)))
+	if len(results) == 0:
+		pairs = (numpy.zeros(0, dtype = numpy.int32), numpy.zeros(0, dtype = numpy.int32), numpy.zeros(0, dtype = numpy.float32))
+	else:
+		pairs = tuple([numpy.concatenate([result[k] for result in results]) for k in range(3)])
+	if cache is not None:
+		cache.put(mesh_key, threshold, nvertices, *pairs)
+	return pairs
+
+# Geodesic adjacency sets for all thresholds in one pass (see compute_distance_pairs).
+# Returns a CSRAdjacency (with distances) for each threshold.
+def compute_csr(numpy.ndarray[float, ndim=2, mode="c"] v,
+						numpy.ndarray[int, ndim=2, mode="c"] f,
+						numpy.ndarray[float, ndim=1, mode="c"] thresholds,
+						int nthreads = 1, method = 'exact', int subdivision_level = 2, cache = None):
+	source, target, distances = compute_distance_pairs(v, f, numpy.max(thresholds), nthreads = nthreads, method = method, subdivision_level = subdivision_level, cache = cache)
+	adjacency = []
+	for k in range(thresholds.shape[0]):
+		within = distances < thresholds[k]
+		adjacency.append(pairs_to_csr(v.shape[0], source[within], target[within], distances[within]))
 	return adjacency
 
+# Accuracy of an approximate geodesic method against the exact method for the pairs (within threshold) of a random
+# sample of sources. Returns a dictionary with the number of pairs, the absolute and relative errors (for the pairs
+# within the threshold for both methods), the pairs that are only within the threshold for one of the methods, and
+# the run time of each method.
+def geodesic_accuracy_report(v, f, threshold, method = 'dijkstra', subdivision_level = 2, nsources = 100, seed = None):
+	v = numpy.ascontiguousarray(v, dtype = numpy.float32)
+	f = numpy.ascontiguousarray(f, dtype = numpy.int32)
+	maxDistance = float(threshold) + 1e-10 # epsilon
+	nsources = min(int(nsources), v.shape[0])
+	sources = numpy.sort(numpy.random.RandomState(seed).choice(v.shape[0], nsources, replace = False)).astype(numpy.int32)
+	tree = cKDTree(v)
+	pairs = cKDTree(v[sources]).sparse_distance_matrix(tree, maxDistance * (1 + 1e-6) + 1e-6, output_type = 'ndarray')
+	order = numpy.lexsort((pairs['j'], pairs['i']))
+	source = pairs['i'][order]
+	target = numpy.ascontiguousarray(pairs['j'][order], dtype = numpy.int32)
+	keep = target != sources[source]
+	source = source[keep]
+	target = numpy.ascontiguousarray(target[keep])
+	indptr = numpy.zeros(nsources + 1, dtype = numpy.int32)
+	numpy.cumsum(numpy.bincount(source, minlength = nsources), out = indptr[1:])
+	distances = {}
+	runtime = {}
+	for name in ['exact', method]:
+		worker = GeodesicDistanceWorker(v, f, name, subdivision_level)
+		distances[name] = numpy.empty(target.shape[0], dtype = numpy.float32)
+		start_time = time()
+		worker.distances(sources, indptr, target, distances[name], maxDistance)
+		runtime[name] = time() - start_time
+	exact = distances['exact']
+	approx = distances[method]
+	within = exact < float(threshold)
+	approx_within = approx < float(threshold)
+	both = within & approx_within # the graph based methods do not return distances beyond the threshold
+	error = numpy.abs(approx[both] - exact[both])
+	relative_error = error / numpy.maximum(exact[both], 1e-10)
+	return {'method': method,
+			'nsources': nsources,
+			'npairs': int(within.sum()),
+			'mean_abs_error': float(error.mean()) if error.size else 0.,
+			'max_abs_error': float(error.max()) if error.size else 0.,
+			'mean_rel_error': float(relative_error.mean()) if error.size else 0.,
+			'max_rel_error': float(relative_error.max()) if error.size else 0.,
+			'missed_pairs': int(numpy.sum(within & ~approx_within)),
+			'extra_pairs': int(numpy.sum(~within & approx_within)),
+			'exact_time': runtime['exact'],
+			'method_time': runtime[method]}
+
+# Prints a geodesic_accuracy_report
+def print_accuracy_report(report):
+	print("Geodesic accuracy report: %s vs. exact (%d sampled sources, %d pairs)" % (report['method'], report['nsources'], report['npairs']))
+	print("Absolute error: mean %1.4f, max %1.4f" % (report['mean_abs_error'], report['max_abs_error']))
+	print("Relative error: mean %1.4f, max %1.4f" % (report['mean_rel_error'], report['max_rel_error']))
+	print("Pairs within the threshold only for the exact method: %d, only for %s: %d" % (report['missed_pairs'], report['method'], report['extra_pairs']))
+	print("Time: exact %1.2fs, %s %1.2fs (speedup %1.1fx)" % (report['exact_time'], report['method'], report['method_time'], report['exact_time'] / max(report['method_time'], 1e-10)))
+
+# Geodesic adjacency sets as lists of neighbours for each threshold (see compute_csr)
+def compute(numpy.ndarray[float, ndim=2, mode="c"] v,
+						numpy.ndarray[int, ndim=2, mode="c"] f,
+						numpy.ndarray[float, ndim=1, mode="c"] thresholds,
+						method = 'exact', int subdivision_level = 2):
+	return [adjacency.tolist() for adjacency in compute_csr(v, f, thresholds, method = method, subdivision_level = subdivision_level)]
+
 #parallizable computation of vertex distances
 def compute_distance_parallel(numpy.ndarray[float, ndim=2, mode="c"] v,
 						numpy.ndarray[int, ndim=2, mode="c"] f,
@@ -21,62 +21,21 @@ import nibabel as nib
 import os
 import argparse as ap
 from tfce_mediation.adjacency import compute
+from tfce_mediation.tm_mesh import merge_identical_vertices, remove_degenerate_triangles
 
 DESCRIPTION = "Create adjacency list based on geodesic distance for vertex-based TFCE. The surfaces must be inputted."
 
-def mergeIdenticalVertices(v, f):
-	vr = np.around(v, decimals = 10)
-	vrv = vr.view(v.dtype.descr * v.shape[1])
-	_, idx, inv = np.unique(vrv, return_index = True, return_inverse = True)
-
-	lkp = idx[inv]
-
-	v_ = v[idx, :]
-	f_ = np.asarray([[lkp[f[i, j]] for j in range(f.shape[1])] for i in range(f.shape[0])], dtype = np.int32)
-
-	return v, f_
-
-def removeNonManifoldTriangles(v, f):
-	v_ = v[f]
-	fn = np.cross(v_[:, 1] - v_[:, 0], v_[:, 2] - v_[:,0])
-
-	f_ = f[np.logical_not(np.all(np.isclose(fn, 0), axis = 1)), :]
-
-	return v, f_
-
-def computeNormals(v, f):
-	v_ = v[f]
-
-	fn = np.cross(v_[:, 1] - v_[:, 0], v_[:, 2] - v_[:,0])
-
-	fs = np.sqrt(np.sum((v_[:, [1, 2, 0], :] - v_) ** 2, axis = 2))
-	fs_ = np.sum(fs, axis = 1) / 2 # heron's formula
-	fa = np.sqrt(fs_ * (fs_ - fs[:, 0]) * (fs_ - fs[:, 1]) * (fs_ - fs[:, 2]))[:, None]
-
-	vn = np.zeros_like(v, dtype = np.float32)
-	vn[f[:, 0]] += fn * fa # weight by area
-	vn[f[:, 1]] += fn * fa
-	vn[f[:, 2]] += fn * fa
-
-	vlen = np.sqrt(np.sum(vn ** 2, axis = 1))[np.any(vn != 0, axis = 1), None]
-	vn[np.any(vn != 0, axis = 1), :] /= vlen
-
-	return vn
-
-def projNormFracThick(v, vn, t, projfrac):
-	return v + (vn * t[:, None] * projfrac)
-
 def compute_adjacency(geoname, hemi, min_dist, max_dist, step_dist):
 	v, f = nib.freesurfer.read_geometry(geoname)
 	v = v.astype(np.float32, order = "C")
 	f = f.astype(np.int32, order = "C")
 
-	v, f = mergeIdenticalVertices(v, f)
-	v, f = removeNonManifoldTriangles(v, f)
+	v, f = merge_identical_vertices(v, f)
+	v, f = remove_degenerate_triangles(v, f)
 
-#	vn = computeNormals(v, f)
+#	vn = compute_vertex_normals(v, f)
 #	t = nib.freesurfer.read_morph_data("%s/fsaverage/surf/%s.thickness" % ((os.environ["SUBJECTS_DIR"]),hemi))
-#	v_ = projNormFracThick(v, vn, t, projfrac) # project to midthickness
+#	v_ = project_vertices(v, vn, t, projfrac) # project to midthickness
 
 	nib.freesurfer.io.write_geometry("%s.midthickness" % hemi, v, f)
 	thresholds = np.arange(min_dist, max_dist, step=step_dist, dtype = np.float32)
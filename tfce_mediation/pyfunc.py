@@ -23,54 +23,24 @@ import nibabel as nib
 import math
 import sys
 import struct
-import uuid
-from scipy.stats import linregress, t, f
+import hashlib
+import threading
+from scipy.stats import linregress, t, f, norm
 from scipy.linalg import inv, sqrtm
+from scipy import sparse, ndimage
 import matplotlib.pyplot as plt
 import matplotlib.colors as colors
 import matplotlib.patches as mpatches
 from time import time
+from concurrent.futures import ThreadPoolExecutor
 
-from tfce_mediation.cynumstats import calc_beta_se, cy_lin_lstsqr_mat, cy_lin_lstsqr_mat_residual, se_of_slope
+from tfce_mediation.cynumstats import cy_lin_lstsqr_mat, cy_lin_lstsqr_mat_residual, se_of_slope
+from tfce_mediation.tm_mesh import mesh_adjacency
 
 # Creation of adjacencty sets for TFCE connectivity
 def create_adjac_vertex(vertices,faces): # basic version
-	adjacency = [set([]) for i in range(vertices.shape[0])]
-	for i in range(faces.shape[0]):
-		adjacency[faces[i, 0]].add(faces[i, 1])
-		adjacency[faces[i, 0]].add(faces[i, 2])
-		adjacency[faces[i, 1]].add(faces[i, 0])
-		adjacency[faces[i, 1]].add(faces[i, 2])
-		adjacency[faces[i, 2]].add(faces[i, 0])
-		adjacency[faces[i, 2]].add(faces[i, 1])
-	return adjacency
-
-def create_adjac_voxel(data_index,data_mask,num_voxel, dirtype=26): # default is 26 directions
-	ind=np.where(data_index)
-	dm=np.zeros_like(data_mask)
-	x_dim,y_dim,z_dim=data_mask.shape
-	adjacency = [set([]) for i in range(num_voxel)]
-	label=0
-	for x,y,z in zip(ind[0],ind[1],ind[2]):
-		dm[x,y,z] = label
-		label += 1
-	for x,y,z in zip(ind[0],ind[1],ind[2]):
-		xMin=max(x-1,0)
-		xMax=min(x+1,x_dim-1)
-		yMin=max(y-1,0)
-		yMax=min(y+1,y_dim-1)
-		zMin=max(z-1,0)
-		zMax=min(z+1,z_dim-1)
-		local_area = dm[xMin:xMax+1,yMin:yMax+1,zMin:zMax+1]
-		if int(dirtype)==6:
-			if local_area.shape!=(3,3,3): # check to prevent calculating adjacency at walls
-				local_area = dm[x,y,z] 
-			else:
-				local_area = local_area * np.array([0,0,0,0,1,0,0,0,0,0,1,0,1,1,1,0,1,0,0,0,0,0,1,0,0,0,0]).reshape(3,3,3)
-		cV = int(dm[x,y,z])
-		for j in local_area[local_area>0]:
-			adjacency[cV].add(int(j))
-	return adjacency
+	indptr, indices = mesh_adjacency(faces, vertices.shape[0])
+	return [set(indices[indptr[i]:indptr[i+1]].tolist()) for i in range(vertices.shape[0])]
 
 #writing statistics images
 
@@ -125,39 +95,256 @@ def write_perm_maxTFCE_voxel(statname, voxelStat, TFCEfunc):
 #calculating Sobel Z statistics using T stats
 
 def calc_sobelz(medtype, pred_x, depend_y, merge_y, n, num_vertex, alg = "aroian"):
-	if medtype == 'I':
-		PathA_beta, PathA_se = calc_beta_se(pred_x,merge_y,n,num_vertex)
-		PathB_beta, PathB_se = calc_beta_se(np.column_stack([pred_x,depend_y]),merge_y,n,num_vertex)
-		PathA_se = PathA_se[1]
-		PathB_se = PathB_se[1]
-	elif medtype == 'M':
-		PathA_beta, PathA_se = calc_beta_se(pred_x,merge_y,n,num_vertex)
-		PathB_beta, PathB_se = calc_beta_se(np.column_stack([depend_y,pred_x]),merge_y,n,num_vertex)
-		PathA_se = PathA_se[1]
-		PathB_se = PathB_se[1]
-	elif medtype == 'Y':
-		PathA_beta, _, _, _, PathA_se = linregress(pred_x, depend_y)
-		PathB_beta, PathB_se = calc_beta_se(np.column_stack([depend_y,pred_x]),merge_y,n,num_vertex)
-		PathB_se = PathB_se[1]
-	else:
+	mediation_model = mediation_invariants(medtype, pred_x, depend_y, merge_y)
+	return calc_sobelz_permutations(mediation_model, alg = alg)[0]
+
+def mediation_invariants(medtype, pred_x, depend_y, merge_y):
+	"""
+	Precomputes the parts of path A and path B of a simple mediation model that are the same for every permutation.
+	For medtype I and M only the predictor is permuted, and for medtype Y the predictor and the dependent variable are
+	permuted together (i.e., path A does not change).
+
+	Parameters
+	----------
+	medtype : str
+		mediation type {I|M|Y}
+	pred_x : array
+		independent variable (N_subjects)
+	depend_y : array
+		mediator (medtype I) or dependent variable (medtype M and Y) (N_subjects)
+	merge_y : array
+		data array (N_subjects, N_elements)
+
+	Returns
+	-------
+	mediation_model : dict
+		the (unpermuted) variables, the mean centred data, its sum of squares, and depend_y'Y (medtype I and M) or
+		the path A t-value (medtype Y).
+
+	"""
+	if medtype not in ['I', 'M', 'Y']:
 		print("Invalid mediation type")
 		exit()
-	ta = PathA_beta/PathA_se
-	tb = PathB_beta/PathB_se
-	if alg == 'aroian':
-		#Aroian variant
-		SobelZ = 1/np.sqrt((1/(tb**2))+(1/(ta**2))+(1/(ta**2*tb**2)))
-	elif alg == 'sobel':
-		#Sobel variant
-		SobelZ = 1/np.sqrt((1/(tb**2))+(1/(ta**2)))
-	elif alg == 'goodman':
-		#Goodman variant
-		SobelZ = 1/np.sqrt((1/(tb**2))+(1/(ta**2))-(1/(ta**2*tb**2)))
+	pred_x = np.ravel(pred_x).astype(np.float64)
+	depend_y = np.ravel(depend_y).astype(np.float64)
+	# the intercept is in every model, so centring the data does not change the slopes or residuals
+	y = np.array(merge_y, dtype = np.float64)
+	y -= y.mean(0)
+	mediation_model = {'medtype': medtype,
+		'pred_x': pred_x,
+		'depend_y': depend_y,
+		'y': y,
+		'yty': np.einsum('ij,ij->j', y, y)}
+	if medtype == 'Y':
+		PathA_beta, _, _, _, PathA_se = linregress(pred_x, depend_y)
+		mediation_model['ta'] = PathA_beta / PathA_se
 	else:
+		mediation_model['dty'] = np.dot(depend_y, y)
+	return mediation_model
+
+def _stacked_slope_tvalues(columns, products, mediation_model):
+	# t-values of the first column after the intercept for a block of designs. columns are the (block, N_subjects)
+	# regressors, and products are the matching regressor'Y (block, N_elements).
+	nblock = columns[0].shape[0]
+	n = columns[0].shape[1]
+	k = len(columns) + 1
+	XX = np.zeros((nblock, k, k))
+	XX[:,0,0] = n
+	for i, ci in enumerate(columns):
+		XX[:,0,i+1] = XX[:,i+1,0] = ci.sum(1)
+		for j, cj in enumerate(columns):
+			XX[:,i+1,j+1] = np.einsum('ij,ij->i', ci, cj)
+	invXX = np.linalg.inv(XX)
+	# the intercept row of X'Y is zero for mean centred data
+	XY = np.zeros((nblock, k, mediation_model['y'].shape[1]))
+	for i, product in enumerate(products):
+		XY[:,i+1] = product
+	beta = np.matmul(invXX, XY)
+	sigma2 = (mediation_model['yty'] - np.einsum('pkv,pkv->pv', beta, XY)) / (n - k)
+	return beta[:,1] / np.sqrt(invXX[:,1,1,np.newaxis] * sigma2)
+
+def calc_sobelz_permutations(mediation_model, permutations = None, alg = "aroian", blocksize = 16):
+	"""
+	Calculates the Sobel Z of the indirect effect for a set of permutations. The products of the permuted variables
+	with the data are computed with one matrix multiplication per block of permutations.
+
+	Parameters
+	----------
+	mediation_model : dict
+		output of mediation_invariants
+	
+	Optional Flags
+	----------
+	permutations : array
+		the permuted subject indices (N_permutations, N_subjects). Default is the unpermuted model.
+	alg : str
+		the indirect test algorithm {aroian|sobel|goodman} (default = "aroian")
+	blocksize : int
+		the number of permutations per matrix multiplication (default = 16)
+
+	Returns
+	-------
+	SobelZ : array
+		Sobel Z statistics (N_permutations, N_elements) as C-contiguous float32.
+
+	"""
+	if alg not in ['aroian', 'sobel', 'goodman']:
 		print("Unknown indirect test algorithm")
 		exit()
+	medtype = mediation_model['medtype']
+	pred_x = mediation_model['pred_x']
+	depend_y = mediation_model['depend_y']
+	y = mediation_model['y']
+	if permutations is None:
+		permutations = np.arange(y.shape[0])
+	permutations = np.atleast_2d(permutations)
+	SobelZ = np.zeros((permutations.shape[0], y.shape[1]), dtype = np.float32, order = "C")
+	for start in range(0, permutations.shape[0], blocksize):
+		indices_perm = permutations[start:start+blocksize]
+		nblock = indices_perm.shape[0]
+		xp = pred_x[indices_perm]
+		if medtype == 'Y':
+			dp = depend_y[indices_perm]
+			xy = np.dot(np.vstack((xp, dp)), y)
+			dy = xy[nblock:]
+			xy = xy[:nblock]
+			ta = mediation_model['ta']
+		else:
+			dp = np.tile(depend_y, (nblock, 1))
+			xy = np.dot(xp, y)
+			dy = np.tile(mediation_model['dty'], (nblock, 1))
+			ta = _stacked_slope_tvalues([xp], [xy], mediation_model)
+		if medtype == 'I':
+			tb = _stacked_slope_tvalues([xp, dp], [xy, dy], mediation_model)
+		else:
+			tb = _stacked_slope_tvalues([dp, xp], [dy, xy], mediation_model)
+		SobelZ[start:start+nblock] = calc_indirect(ta, tb, alg = alg)
 	return SobelZ
 
+def _weighted_indirect_effect(medtype, weights, pred_x, depend_y, y):
+	# indirect effects (a*b) for a block of subject weights (N_resamples, N_subjects), e.g., bootstrap counts. Only
+	# weighted sums are needed, so the products with the data are one matrix multiplication per block.
+	Sw = weights.sum(1)[:,np.newaxis]
+	Sx = np.dot(weights, pred_x)[:,np.newaxis]
+	Sd = np.dot(weights, depend_y)[:,np.newaxis]
+	cxx = np.dot(weights, pred_x**2)[:,np.newaxis] - Sx**2 / Sw
+	cdd = np.dot(weights, depend_y**2)[:,np.newaxis] - Sd**2 / Sw
+	cxd = np.dot(weights, pred_x*depend_y)[:,np.newaxis] - Sx*Sd / Sw
+	nblock = weights.shape[0]
+	products = np.dot(np.vstack((weights, weights*pred_x, weights*depend_y)), y)
+	Sm = products[:nblock]
+	cxm = products[nblock:2*nblock] - Sx*Sm / Sw
+	cdm = products[2*nblock:] - Sd*Sm / Sw
+	if medtype == 'Y':
+		# X = pred_x, M = depend_y, Y = image
+		a = cxd / cxx
+		b = (cdm - cxd*cxm / cxx) / (cdd - cxd**2 / cxx)
+	else:
+		cmm = np.dot(weights, y**2) - Sm**2 / Sw
+		if medtype == 'M':
+			# X = pred_x, M = image, Y = depend_y
+			a = cxm / cxx
+			b = (cdm - cxm*cxd / cxx) / (cmm - cxm**2 / cxx)
+		else:
+			# X = image, M = pred_x, Y = depend_y
+			a = cxm / cmm
+			b = (cxd - cxm*cdm / cmm) / (cxx - cxm**2 / cmm)
+	return a * b
+
+def bootstrap_indirect_effect(medtype, pred_x, depend_y, merge_y, nboot = 5000, alpha = 0.05, ci = 'bca', seed = None, blocksize = 4096, chunksize = 256):
+	"""
+	Bootstrap confidence intervals of the indirect effect (a*b) of simple mediation. The neuroimage is the
+	independent variable (medtype I), mediator (medtype M), or dependent variable (medtype Y). Each resample is a
+	vector of subject counts, so path A and path B of all elements are computed with one matrix multiplication per
+	chunk of resamples. The elements are processed in blocks, and only the resamples of one block are kept.
+
+	Parameters
+	----------
+	medtype : str
+		mediation type {I|M|Y}
+	pred_x : array
+		independent variable (medtype M and Y) or mediator (medtype I) (N_subjects)
+	depend_y : array
+		dependent variable (medtype I and M) or mediator (medtype Y) (N_subjects)
+	merge_y : array
+		data array (N_subjects, N_elements)
+
+	Optional Flags
+	----------
+	nboot : int
+		number of bootstrap resamples (default = 5000)
+	alpha : float
+		the confidence intervals are 100*(1-alpha)% (default = 0.05)
+	ci : str
+		percentile or bias-corrected and accelerated (bca) intervals (default = 'bca')
+	seed : int
+		random seed of the resamples
+	blocksize : int
+		number of elements per block (default = 4096)
+	chunksize : int
+		number of resamples per matrix multiplication (default = 256)
+
+	Returns
+	-------
+	indirect : array
+		the indirect effect (N_elements) as float32
+	lower : array
+		lower confidence limit (N_elements) as float32
+	upper : array
+		upper confidence limit (N_elements) as float32
+
+	"""
+	if medtype not in ['I', 'M', 'Y']:
+		print("Invalid mediation type")
+		exit()
+	if ci not in ['bca', 'percentile']:
+		print("Error: unknown confidence interval method %s" % ci)
+		exit()
+	pred_x = np.ravel(pred_x).astype(np.float64)
+	depend_y = np.ravel(depend_y).astype(np.float64)
+	n, num_elements = merge_y.shape
+	# resampling with replacement is a multinomial draw of the subject counts
+	counts = np.random.RandomState(seed).multinomial(n, np.ones(n)/n, size = nboot).astype(np.float64)
+	indirect = np.zeros(num_elements, dtype = np.float32)
+	lower = np.zeros(num_elements, dtype = np.float32)
+	upper = np.zeros(num_elements, dtype = np.float32)
+	z_alpha = norm.ppf([alpha/2, 1-alpha/2])
+	for start in range(0, num_elements, blocksize):
+		stop = min(start + blocksize, num_elements)
+		y = np.array(merge_y[:,start:stop], dtype = np.float64)
+		y -= y.mean(0)
+		estimate = _weighted_indirect_effect(medtype, np.ones((1,n)), pred_x, depend_y, y)[0]
+		boot = np.zeros((nboot, stop-start))
+		for chunk in range(0, nboot, chunksize):
+			boot[chunk:chunk+chunksize] = _weighted_indirect_effect(medtype, counts[chunk:chunk+chunksize], pred_x, depend_y, y)
+		boot.sort(0)
+		if ci == 'percentile':
+			quantiles = np.tile(np.array([alpha/2, 1-alpha/2])[:,np.newaxis], (1, stop-start))
+		else:
+			# bias correction from the bootstrap distribution, and acceleration from the jackknife (leave-one-out weights)
+			proportion = (np.sum(boot < estimate, 0) + 0.5*np.sum(boot == estimate, 0)) / nboot
+			z0 = norm.ppf(np.clip(proportion, 0.5/nboot, 1 - 0.5/nboot))
+			jackknife = np.zeros((n, stop-start))
+			for chunk in range(0, n, chunksize):
+				weights = np.ones((min(chunksize, n-chunk), n))
+				weights[np.arange(weights.shape[0]), np.arange(chunk, chunk+weights.shape[0])] = 0
+				jackknife[chunk:chunk+chunksize] = _weighted_indirect_effect(medtype, weights, pred_x, depend_y, y)
+			deviation = jackknife.mean(0) - jackknife
+			acceleration = np.sum(deviation**3, 0) / (6 * np.sum(deviation**2, 0)**1.5)
+			acceleration[~np.isfinite(acceleration)] = 0
+			zq = z0 + z_alpha[:,np.newaxis]
+			quantiles = norm.cdf(z0 + zq / (1 - acceleration*zq))
+		# linear interpolation between the order statistics
+		position = quantiles * (nboot - 1)
+		below = np.floor(position).astype(int)
+		above = np.minimum(below + 1, nboot - 1)
+		fraction = position - below
+		limits = np.take_along_axis(boot, below, 0) * (1 - fraction) + np.take_along_axis(boot, above, 0) * fraction
+		indirect[start:stop] = estimate
+		lower[start:stop] = limits[0]
+		upper[start:stop] = limits[1]
+	return (indirect, lower, upper)
+
 ### tm_maths functions ###
 
 
@@ -175,6 +362,122 @@ def converter_try(vals):
 			num_check=0
 	return num_check
 
+# operations that are applied elementwise (i.e., that can be fused into a single pass over the data)
+ELEMENTWISE_OPERATIONS = ['add', 'subtract', 'multiply', 'divide', 'power', 'naturallog', 'log10', 'abs',
+	'threshold', 'upperthreshold', 'binarize']
+
+def parse_operations(parser, argv, skip_dests = ()):
+	"""
+	Parses a command line into the ordered list of operations (e.g., tm_maths -a 1 -m 2 --mean)
+
+	Parameters
+	----------
+	parser : object
+		argparse.ArgumentParser of the program
+	argv : list
+		command line arguments (i.e., sys.argv[1:])
+
+	Optional Flags
+	----------
+	skip_dests : list
+		options (dest names) that are not operations (e.g., inputs and outputs)
+
+	Returns
+	-------
+	operations : list
+		(dest, value) of each operation in the order of the command line. The value is None for options without
+		arguments.
+
+	"""
+	actions = parser._option_string_actions
+	operations = []
+	i = 0
+	while i < len(argv):
+		if argv[i] not in actions:
+			print("Error: %s is not an option" % argv[i])
+			exit()
+		action = actions[argv[i]]
+		nargs = 0 if action.nargs == 0 else 1
+		if nargs and (i + 1 == len(argv)):
+			print("Error: %s requires an argument" % argv[i])
+			exit()
+		value = argv[i + 1] if nargs else None
+		if (value is not None) and (action.type is not None):
+			value = action.type(value)
+		if action.dest not in skip_dests:
+			operations.append((action.dest, value))
+		i += 1 + nargs
+	return operations
+
+def fuse_operations(operations):
+	"""
+	Groups consecutive elementwise operations into a single ('elementwise', [(dest, value), ...]) operation
+	"""
+	fused = []
+	for dest, value in operations:
+		if dest in ELEMENTWISE_OPERATIONS:
+			if fused and fused[-1][0] == 'elementwise':
+				fused[-1][1].append((dest, value))
+			else:
+				fused.append(('elementwise', [(dest, value)]))
+		else:
+			fused.append((dest, value))
+	return fused
+
+def apply_elementwise_operations(data, operations, blocksize = 65536):
+	"""
+	Applies a chain of elementwise operations in place. The rows of the data are processed in blocks, and every
+	operation is applied to a block before moving to the next block, so the data is only read and written once.
+
+	Parameters
+	----------
+	data : array
+		masked data (N_elements) or (N_elements, N_subjects)
+	operations : list
+		(dest, value) of each operation in ELEMENTWISE_OPERATIONS
+
+	Optional Flags
+	----------
+	blocksize : int
+		number of rows per block (Default = 65536)
+
+	Returns
+	-------
+	data : array
+		float32 data (the input array if it is already float32)
+
+	"""
+	if data.dtype != np.float32:
+		data = data.astype(np.float32)
+	for start in range(0, data.shape[0], blocksize):
+		block = data[start:start + blocksize]
+		for dest, value in operations:
+			if value is not None:
+				value = np.float32(value)
+			if dest == 'add':
+				block += value
+			elif dest == 'subtract':
+				block -= value
+			elif dest == 'multiply':
+				block *= value
+			elif dest == 'divide':
+				block /= value
+			elif dest == 'power':
+				np.power(block, value, out = block)
+			elif dest == 'naturallog':
+				np.log(block, out = block)
+			elif dest == 'log10':
+				np.log10(block, out = block)
+			elif dest == 'abs':
+				np.abs(block, out = block)
+			elif dest == 'threshold':
+				block[block < value] = 0
+			elif dest == 'upperthreshold':
+				block[block > value] = 0
+			elif dest == 'binarize':
+				block[block != 0] = 1
+	return data
+
 def loadnifti(imagename):
 	if os.path.exists(imagename): # check if file exists
 		if imagename.endswith('.nii.gz'):
@@ -247,6 +550,180 @@ def savemgh(imgdata, img, index, imagename):
 	imgout[index]=outdata
 	nib.save(nib.freesurfer.mghformat.MGHImage(imgout.astype(np.float32, order = "C"),img.affine),imagename)
 
+# Writes masked data (N_masked_voxels, N_volumes) to a NifTI or MGH image one volume at a time, so the full 4D image is
+# never held in memory. imgdata can be memory-mapped.
+def save_masked_volumes(imgdata, img, index, imagename, output_mgh = False):
+	nvolumes = 1 if imgdata.ndim == 1 else imgdata.shape[1]
+	shape = tuple(img.shape[:3]) + ((nvolumes,) if imgdata.ndim == 2 else ())
+	if output_mgh:
+		# the MGH geometry (centre of the volume) depends on the data shape, and set_data_shape resets the voxel sizes
+		hdr = nib.freesurfer.mghformat.MGHImage(np.broadcast_to(np.float32(0), shape), img.affine).header
+		dtype = np.dtype('>f4')
+	else:
+		hdr = nib.Nifti1Image(np.zeros((1,1,1), dtype = np.float32), img.affine).header
+		dtype = np.dtype(np.float32)
+		hdr['vox_offset'] = 352
+		hdr.set_data_shape(shape)
+	volume = np.zeros(img.shape[:3], dtype = dtype)
+	with nib.openers.ImageOpener(imagename, 'wb') as fobj:
+		if output_mgh:
+			hdr.writehdr_to(fobj)
+			fobj.write(b'\x00' * (hdr.get_data_offset() - fobj.tell()))
+		else:
+			fobj.write(hdr.binaryblock)
+			fobj.write(b'\x00' * 4) # no extensions
+		for t in range(nvolumes):
+			volume[index] = imgdata if imgdata.ndim == 1 else imgdata[:, t]
+			fobj.write(volume.tobytes(order = 'F'))
+		if output_mgh:
+			hdr.writeftr_to(fobj)
+
+def gd_fwhm_kernel(indices, distances, fwhm, nvertices, mask_index = None):
+	"""
+	Geodesic FWHM smoothing kernel as a row-normalised sparse matrix, i.e., smoothed = kernel.dot(data) gives the
+	same result as calc_gd_fwhm for every column of data.
+
+	Parameters
+	----------
+	indices : array
+		vertex pairs (N_pairs, 2) of the distance list
+	distances : array
+		geodesic distance of each pair (N_pairs)
+	fwhm : float
+		Geodesic FWHM (mm)
+	nvertices : int
+		number of vertices
+
+	Optional Flags
+	----------
+	mask_index : array
+		only pairs with both vertices in the mask (bool array or vertex indices) are used
+
+	Returns
+	-------
+	kernel : scipy.sparse.csr_matrix
+		float32 (N_vertices, N_vertices) smoothing matrix
+
+	"""
+	sigma = fwhm / np.sqrt(8 * np.log(2))
+	indices = np.asarray(indices)
+	distances = np.asarray(distances, dtype = np.float64)
+	if mask_index is not None:
+		mask = np.zeros(nvertices, dtype = bool)
+		mask[mask_index] = True
+		keep = mask[indices[:,0]] & mask[indices[:,1]]
+		indices = indices[keep]
+		distances = distances[keep]
+	# same weights as calc_gd_fwhm (pdf_compute takes sigma as the variance)
+	weights = np.exp(-0.5 * distances**2 / sigma)
+	diagonal = np.arange(nvertices)
+	rows = np.concatenate((indices[:,0], indices[:,1], diagonal))
+	cols = np.concatenate((indices[:,1], indices[:,0], diagonal))
+	kernel = sparse.csr_matrix((np.concatenate((weights, weights, np.ones(nvertices))), (rows, cols)), shape = (nvertices, nvertices))
+	kernel = sparse.diags(1. / np.asarray(kernel.sum(1)).ravel()).dot(kernel)
+	return sparse.csr_matrix(kernel, dtype = np.float32)
+
+def apply_sparse_kernel(kernel, data, out = None, nthreads = 1, blocksize = 256):
+	"""
+	Applies a sparse (N_vertices, N_vertices) kernel to every column of data. Blocks of columns are read, multiplied
+	and written by nthreads threads, so data and out can be memory-mapped arrays larger than the available RAM.
+
+	Parameters
+	----------
+	kernel : scipy.sparse matrix
+		smoothing kernel (e.g., gd_fwhm_kernel)
+	data : array
+		data array (N_vertices) or (N_vertices, N_subjects)
+
+	Optional Flags
+	----------
+	out : array
+		output array with the shape of data (Default = new float32 array)
+	nthreads : int
+		number of threads (Default = 1)
+	blocksize : int
+		number of columns per block (Default = 256)
+
+	Returns
+	-------
+	out : array
+		smoothed data
+
+	"""
+	if out is None:
+		out = np.zeros(data.shape, dtype = np.float32)
+	if data.ndim == 1:
+		out[:] = kernel.dot(np.asarray(data, dtype = np.float32))
+		return out
+	def smooth_block(start):
+		stop = min(start + blocksize, data.shape[1])
+		out[:, start:stop] = kernel.dot(np.asarray(data[:, start:stop], dtype = np.float32))
+	with ThreadPoolExecutor(max_workers = nthreads) as executor:
+		list(executor.map(smooth_block, range(0, data.shape[1], blocksize)))
+	return out
+
+def smooth_masked_voxels(data, mask_index, fwhm, affine, out = None, nthreads = 1):
+	"""
+	Mask-normalised Gaussian FWHM smoothing of masked voxel data. Only voxels within the mask contribute, and the
+	result is divided by the smoothed mask so the edge of the mask is not darkened. Each subject is smoothed as a
+	single float32 volume cropped to the mask (plus the kernel radius), and the masked result is written straight
+	into out, so the peak memory is a few volumes per thread regardless of the number of subjects.
+
+	Parameters
+	----------
+	data : array
+		masked data (N_masked_voxels) or (N_masked_voxels, N_subjects)
+	mask_index : array
+		3D mask (bool or binary)
+	fwhm : float
+		FWHM (mm)
+	affine : array
+		image affine (used for the voxel size)
+
+	Optional Flags
+	----------
+	out : array
+		output array with the shape of data (Default = new float32 array)
+	nthreads : int
+		number of subjects smoothed in parallel (Default = 1)
+
+	Returns
+	-------
+	out : array
+		smoothed data
+
+	"""
+	mask_index = np.asarray(mask_index, dtype = bool)
+	voxel_size = np.sqrt(np.sum(np.asarray(affine)[:3, :3] ** 2, axis = 0))
+	sigma = fwhm / (np.sqrt(8 * np.log(2)) * voxel_size)
+	if out is None:
+		out = np.zeros(data.shape, dtype = np.float32)
+	# crop to the mask plus the kernel radius (gaussian_filter1d truncates at 4 sigma)
+	radius = np.ceil(4. * sigma).astype(int) + 1
+	nonzero = np.nonzero(mask_index)
+	lower = np.maximum(np.min(nonzero, axis = 1) - radius, 0)
+	upper = np.minimum(np.max(nonzero, axis = 1) + radius + 1, mask_index.shape)
+	crop = tuple(slice(lo, hi) for lo, hi in zip(lower, upper))
+	crop_mask = mask_index[crop]
+	def gaussian_smooth(volume):
+		for axis, s in enumerate(sigma):
+			ndimage.gaussian_filter1d(volume, s, axis = axis, output = volume, mode = 'constant')
+		return volume
+	norm = gaussian_smooth(crop_mask.astype(np.float32))[crop_mask]
+	norm[norm <= 0] = 1.
+	def smooth_column(k):
+		volume = np.zeros(crop_mask.shape, dtype = np.float32)
+		volume[crop_mask] = data if data.ndim == 1 else data[:, k]
+		smoothed = gaussian_smooth(volume)[crop_mask] / norm
+		if data.ndim == 1:
+			out[:] = smoothed
+		else:
+			out[:, k] = smoothed
+	ncolumns = 1 if data.ndim == 1 else data.shape[1]
+	with ThreadPoolExecutor(max_workers = nthreads) as executor:
+		list(executor.map(smooth_column, range(ncolumns)))
+	return out
+
 #find nearest permuted TFCE max value that corresponse to family-wise error rate 
 def find_nearest(array,value,p_array):
 	idx = np.searchsorted(array, value, side="left")
@@ -328,21 +805,6 @@ def file_len(fname):
 			pass
 	return i + 1
 
-# not used
-def computeNormals(v, f):
-	v_ = v[f]
-	fn = np.cross(v_[:, 1] - v_[:, 0], v_[:, 2] - v_[:,0])
-	fs = np.sqrt(np.sum((v_[:, [1, 2, 0], :] - v_) ** 2, axis = 2))
-	fs_ = np.sum(fs, axis = 1) / 2 # heron's formula
-	fa = np.sqrt(fs_ * (fs_ - fs[:, 0]) * (fs_ - fs[:, 1]) * (fs_ - fs[:, 2]))[:, None]
-	vn = np.zeros_like(v, dtype = np.float32)
-	vn[f[:, 0]] += fn * fa # weight by area
-	vn[f[:, 1]] += fn * fa
-	vn[f[:, 2]] += fn * fa
-	vlen = np.sqrt(np.sum(vn ** 2, axis = 1))[np.any(vn != 0, axis = 1), None]
-	vn[np.any(vn != 0, axis = 1), :] /= vlen
-	return vn
-
 def normalize_v3(arr):
 	''' Normalize a numpy array of 3 component vectors shape=(n,3) '''
 	lens = np.sqrt( arr[:,0]**2 + arr[:,1]**2 + arr[:,2]**2 )
@@ -896,7 +1358,9 @@ def surface_smooth(v, f, adjacency, iter_num = 0, scalar = None, lambda_w = 1.0,
 
 def vectorized_surface_smooth(v, f, adjacency, number_of_iter = 5, scalar = None, lambda_w = 0.5, mode = 'laplacian', weighted = True):
 	"""
-	Applies Laplacian (Gaussian) or Taubin (low-pass) smoothing with option to smooth single volume
+	Applies Laplacian (Gaussian) or Taubin (low-pass) smoothing with option to smooth scalar images. The neighbour
+	averaging operator is a sparse matrix (inverse distance weighted or uniform), so each iteration is a sparse
+	product over the vertices and all scalar columns.
 	
 	Citations
 	----------
@@ -912,7 +1376,7 @@ def vectorized_surface_smooth(v, f, adjacency, number_of_iter = 5, scalar = None
 	f : array
 		face array
 	adjacency : array
-		adjacency array
+		adjacency array (list of sets or CSRAdjacency). If None, the mesh (edge) adjacency is used.
 
 	
 	Flags
@@ -920,12 +1384,14 @@ def vectorized_surface_smooth(v, f, adjacency, number_of_iter = 5, scalar = None
 	number_of_iter : int
 		number of smoothing iterations
 	scalar : array
-		apply the same smoothing to a image scalar
+		apply the same smoothing to an image scalar (N_vertices) or to many scalars (N_vertices, N_images), e.g., all subjects or all contrasts
 	lambda_w : float
 		lamda weighting of degree of movement for each iteration
 		The weighting should never be above 1.0
 	mode : string
 		The type of smoothing can either be laplacian (which cause surface shrinkage) or taubin (no shrinkage)
+	weighted : bool
+		Weight the neighbours by their inverse distance (updated each iteration)
 		
 	Returns
 	-------
@@ -940,74 +1406,58 @@ def vectorized_surface_smooth(v, f, adjacency, number_of_iter = 5, scalar = None
 		smoothed scalar array
 	
 	"""
+	if mode not in ['laplacian', 'taubin']:
+		print("Error: mode %s not understood" % mode)
+		quit()
 	k = 0.1
 	mu_w = -lambda_w/(1-k*lambda_w)
 
-	lengths = np.array([len(a) for a in adjacency])
-	maxlen = max(lengths)
-	padded = [list(a) + [-1] * (maxlen - len(a)) for a in adjacency]
-	adj = np.array(padded)
-	w = np.ones(adj.shape, dtype=float)
-	w[adj<0] = 0.
-	val = (adj>=0).sum(-1).reshape(-1, 1)
-	w /= val
-	w = w.reshape(adj.shape[0], adj.shape[1],1)
-
-	vorig = np.zeros_like(v)
-	vorig[:] = v
+	if adjacency is None:
+		indptr, indices = mesh_adjacency(f, v.shape[0])
+	elif hasattr(adjacency, 'indptr'):
+		indptr, indices = adjacency.indptr, adjacency.indices
+	else:
+		indptr = np.zeros(len(adjacency) + 1, dtype = np.int32)
+		np.cumsum([len(a) for a in adjacency], out = indptr[1:])
+		indices = np.fromiter((j for a in adjacency for j in a), dtype = np.int32, count = int(indptr[-1]))
+	n = v.shape[0]
+	lengths = np.diff(indptr)
+	rows = np.repeat(np.arange(n), lengths)
+	# row-normalised averaging operator (the pattern is fixed, only the weights change)
+	average = sparse.csr_matrix((np.ones(indices.shape[0]), indices, indptr), shape = (n, n))
+
+	def set_weights(weights):
+		with np.errstate(divide = 'ignore', invalid = 'ignore'):
+			average.data[:] = weights / np.bincount(rows, weights = weights, minlength = n)[rows]
+
+	def neighbour_mean(x):
+		mean = average.dot(x)
+		# vertices without (finite) neighbour weights are not moved
+		keep = ~np.isfinite(mean) if mean.ndim == 1 else ~np.all(np.isfinite(mean), axis = 1)
+		keep |= lengths == 0
+		mean[keep] = x[keep]
+		return mean
+
+	v = np.array(v, dtype = np.float64)
 	if scalar is not None:
+		scalar = np.array(scalar, dtype = np.float64)
 		scalar[np.isnan(scalar)] = 0
-		sorig = np.zeros_like(scalar)
-		sorig[:] = scalar
+	if not weighted:
+		set_weights(np.ones(indices.shape[0]))
 
 	for iter_num in range(number_of_iter):
 		if weighted:
-			vadj = v[adj]
-			vadj = np.swapaxes(v[adj],1,2)
-			weights = np.zeros((v.shape[0], maxlen))
-			for col in range(maxlen):
-				weights[:,col] = np.power(np.linalg.norm(vadj[:,:,col] - v, axis=1),-1)
-			weights[adj==-1] = 0
-			vectors = np.einsum('abc,adc->acd', weights[:,None], vadj)
-
-			if scalar is not None:
-				scalar[np.isnan(scalar)] = 0
-
-				sadj = scalar[adj]
-				sadj[adj==-1] = 0
-				if lambda_w < 1:
-					scalar = (scalar*(1-lambda_w)) + lambda_w*(np.sum(np.multiply(weights, sadj),axis=1) / np.sum(weights, axis = 1))
-				else:
-					scalar = np.sum(np.multiply(weights, sadj),axis=1) / np.sum(weights, axis = 1)
-				scalar[np.isnan(scalar)] = sorig[np.isnan(scalar)] # hacky scalar nan fix
-			if iter_num % 2 == 0:
-				v += lambda_w*(np.divide(np.sum(vectors, axis = 1), np.sum(weights[:,None], axis = 2)) - v)
-			elif mode == 'taubin':
-				v += mu_w*(np.divide(np.sum(vectors, axis = 1), np.sum(weights[:,None], axis = 2)) - v)
-			elif mode == 'laplacian':
-				v += lambda_w*(np.divide(np.sum(vectors, axis = 1), np.sum(weights[:,None], axis = 2)) - v)
+			with np.errstate(divide = 'ignore'):
+				set_weights(1. / np.linalg.norm(v[indices] - v[rows], axis = 1))
+		if scalar is not None:
+			if lambda_w < 1:
+				scalar = (scalar*(1-lambda_w)) + lambda_w*neighbour_mean(scalar)
 			else:
-				print("Error: mode %s not understood" % mode)
-				quit()
-			v[np.isnan(v)] = vorig[np.isnan(v)] # hacky vertex nan fix
+				scalar = neighbour_mean(scalar)
+		if (iter_num % 2 == 1) and (mode == 'taubin'):
+			v += mu_w*(neighbour_mean(v) - v)
 		else:
-			if scalar is not None:
-				sadj = scalar[adj]
-				sadj[adj==-1] = 0
-
-				if lambda_w < 1:
-					scalar = (scalar*(1-lambda_w)) + (lambda_w*np.divide(np.sum(sadj, axis = 1),lengths))
-				else:
-					scalar = np.divide(np.sum(sadj, axis = 1),lengths)
-			if iter_num % 2 == 0:
-				v += np.array(lambda_w*np.swapaxes(w,0,1)*(np.swapaxes(v[adj], 0, 1)-v)).sum(0)
-			elif mode == 'taubin':
-				v += np.array(mu_w*np.swapaxes(w,0,1)*(np.swapaxes(v[adj], 0, 1)-v)).sum(0)
-			elif mode == 'laplacian':
-				v += np.array(lambda_w*np.swapaxes(w,0,1)*(np.swapaxes(v[adj], 0, 1)-v)).sum(0)
-			else:
-				print("Error: mode %s not understood" % mode)
-				quit()
+			v += lambda_w*(neighbour_mean(v) - v)
 
 	if scalar is not None:
 		return (v, f, scalar)
@@ -1015,9 +1465,12 @@ def vectorized_surface_smooth(v, f, adjacency, number_of_iter = 5, scalar = None
 		return (v, f)
 
 
-def image_regression(y, image_x, pred_x, covars = None, normalize = False, verbose = True):
+def image_regression(y, image_x, pred_x, covars = None, normalize = False, verbose = True, blocksize = 16384, tolerance = 1e-8):
 	"""
-	Applies regression using a voxel/vertex wise regressor
+	Applies regression using a voxel/vertex wise regressor. The shared design (intercept, predictors and
+	covariates) is solved once, and by the Frisch-Waugh-Lovell theorem the image regressor and the data of every
+	element are residualised against it in blocks of matrix products. The coefficient of the image regressor and the
+	coefficients and standard errors of the shared design then follow from row-wise dot products.
 	
 	Parameters
 	----------
@@ -1037,6 +1490,11 @@ def image_regression(y, image_x, pred_x, covars = None, normalize = False, verbo
 		Z-scale the image regressor
 	verbose : bool
 		Verbose output
+	blocksize : int
+		number of elements per block (default = 16384)
+	tolerance : float
+		elements where the residual variance of the image regressor is below tolerance times its variance (i.e.,
+		collinear with the shared design) are set to zero (default = 1e-8)
 	
 	Returns
 	-------
@@ -1054,27 +1512,36 @@ def image_regression(y, image_x, pred_x, covars = None, normalize = False, verbo
 	else:
 		regressors = pred_x
 	regressors = np.column_stack([np.ones(len(regressors)),regressors])
-	arr = np.zeros((nv,len(regressors.T)+1))
+	k = len(regressors.T) + 1
+	arr = np.zeros((nv,k))
 
 	if normalize:
 		image_x = zscaler(image_x, axis=0, w_mean=True, w_std=True)
 
-	for i in range(nv):
-		if i % 5000 == 0:
-			print(i)
-		if (image_x[i,:].std() < 0.01) or (np.any(np.isnan(image_x[i,:]))):
-			arr[i,:] = 0
-		else:
-			temp_data = image_x[i,:]
-			temp_y =  y[i,:]
-			X = np.column_stack((regressors, temp_data))
-			k = len(X.T)
-			invXX = np.linalg.inv(np.dot(X.T, X))
-			a = cy_lin_lstsqr_mat(X, temp_y)
-			sigma2 = np.sum((temp_y - np.dot(X,a))**2,axis=0) / (n - k)
-			se = np.sqrt(np.diag(sigma2 * invXX))
-			arr[i] = a / se
-	print(("Finished. Image-wise independent variable regression took %.1f seconds" % (time() - start_time)))
+	invZZ = np.linalg.inv(np.dot(regressors.T, regressors))
+	projection = np.dot(invZZ, regressors.T) # (Z'Z)^-1 Z'
+	for start in range(0, nv, blocksize):
+		stop = min(start + blocksize, nv)
+		temp_x = np.array(image_x[start:stop], dtype = np.float64)
+		temp_y = np.array(y[start:stop], dtype = np.float64)
+		beta_x = np.dot(temp_x, projection.T)
+		beta_y = np.dot(temp_y, projection.T)
+		resid_x = temp_x - np.dot(beta_x, regressors.T)
+		resid_y = temp_y - np.dot(beta_y, regressors.T)
+		xx = np.einsum('ij,ij->i', resid_x, resid_x)
+		xy = np.einsum('ij,ij->i', resid_x, resid_y)
+		valid = (temp_x.std(1) >= 0.01) & np.all(np.isfinite(temp_x), 1)
+		valid &= xx > tolerance * np.sum((temp_x - temp_x.mean(1)[:,np.newaxis])**2, 1)
+		xx[~valid] = 1
+		gamma = xy / xx
+		sigma2 = (np.einsum('ij,ij->i', resid_y, resid_y) - gamma * xy) / (n - k)
+		# partitioned inverse of X'X for the shared design: (Z'Z)^-1 + beta_x beta_x' / xx
+		se = np.sqrt(sigma2[:,np.newaxis] * (np.diag(invZZ) + beta_x**2 / xx[:,np.newaxis]))
+		arr[start:stop,:-1] = (beta_y - gamma[:,np.newaxis] * beta_x) / se
+		arr[start:stop,-1] = gamma / np.sqrt(sigma2 / xx)
+		arr[start:stop][~valid] = 0
+	if verbose:
+		print(("Finished. Image-wise independent variable regression took %.1f seconds" % (time() - start_time)))
 	Tval = np.array(arr[:,:len(pred_x.T)+1], dtype=np.float32)
 	Timg = np.array(np.squeeze(arr[:,-1:]), dtype=np.float32)
 	return(Tval, Timg)
@@ -1188,6 +1655,105 @@ def erode_3D_image(img_data, erode_iter = 2, do_binary_opening = False, do_binar
 	img_data *= erode_mask
 	return img_data, erode_mask
 
+def open_voxel_neuroimage(image_path):
+	"""
+	Opens a voxel image (NifTI, MINC, or other formats supported by nibabel) without reading its data
+	
+	Parameters
+	----------
+	image_path : string
+		PATH/TO/IMAGE
+	
+	Returns
+	-------
+	image : array
+		nibable image object
+	
+	"""
+	if not os.path.exists(image_path):
+		print('Error: %s not found' % image_path)
+		quit()
+	try:
+		return nib.load(image_path)
+	except nib.filebasedimages.ImageFileError:
+		print('Error: filetype for %s is not supported' % image_path)
+		quit()
+
+def mask_slice_rows(mask_index):
+	"""
+	Rows of the masked data (i.e., data[mask_index]) of each axial slice of a mask
+	
+	Parameters
+	----------
+	mask_index : array
+		3D mask (bool or binary)
+	
+	Returns
+	-------
+	slice_rows : list
+		index array of the rows of the masked voxels in each slice
+	
+	"""
+	x, y, z = np.nonzero(mask_index)
+	order = np.lexsort((y, x, z))
+	bounds = np.searchsorted(z[order], np.arange(mask_index.shape[2] + 1))
+	return [order[bounds[k]:bounds[k+1]] for k in range(mask_index.shape[2])]
+
+def read_masked_voxels(image_path, mask_index, out, slice_rows = None, image = None):
+	"""
+	Reads the masked voxels of an image. NifTI images (including *.nii.gz) are read as a stream, one axial slice at
+	a time, so only the masked voxels are held in memory. Other formats are read one volume at a time.
+	
+	Parameters
+	----------
+	image_path : string
+		PATH/TO/IMAGE
+	mask_index : array
+		3D mask (bool or binary)
+	out : array
+		Output array (N_masked_voxels, N_volumes). It can be a view of a larger (memory-mapped) array.
+	
+	Optional Flags
+	----------
+	slice_rows : list
+		Output of mask_slice_rows(mask_index) (Default = None)
+	image : array
+		nibable image object of image_path (Default = None)
+	
+	Returns
+	-------
+	out : array
+		masked image data (N_masked_voxels, N_volumes)
+	
+	"""
+	if image is None:
+		image = open_voxel_neuroimage(image_path)
+	mask_index = np.asarray(mask_index, dtype = bool)
+	if not np.array_equal(image.shape[:3], mask_index.shape):
+		print("Error: the dimensions of %s do not match the mask" % image_path)
+		quit()
+	nvolumes = int(np.prod(image.shape[3:]))
+	if not isinstance(image, nib.Nifti1Image):
+		for t in range(nvolumes):
+			out[:, t] = np.asarray(image.dataobj[..., t] if image.ndim > 3 else image.dataobj)[mask_index]
+		return out
+	if slice_rows is None:
+		slice_rows = mask_slice_rows(mask_index)
+	proxy = image.dataobj
+	nx, ny, nz = image.shape[:3]
+	slice_nbytes = nx * ny * proxy.dtype.itemsize
+	with nib.openers.ImageOpener(image_path) as fobj:
+		fobj.seek(proxy.offset)
+		for t in range(nvolumes):
+			for k in range(nz):
+				raw = fobj.read(slice_nbytes)
+				if len(slice_rows[k]) == 0:
+					continue
+				# stored in fortran order
+				img_slice = np.frombuffer(raw, dtype = proxy.dtype).reshape((nx, ny), order = 'F')[mask_index[:, :, k]]
+				out[slice_rows[k], t] = img_slice * proxy.slope + proxy.inter
+	return out
+
 def import_voxel_neuroimage(image_path, mask_index = None):
 	"""
 	Low-RAM voxel-image importer using nibabel
@@ -1213,37 +1779,309 @@ def import_voxel_neuroimage(image_path, mask_index = None):
 		numpy array of masked image data
 	
 	"""
-	if not os.path.exists(image_path):
-		print('Error: %s not found' % image_path)
-		quit()
-	base, file_ext = os.path.splitext(image_path)
-	if file_ext == '.gz':
-		file_ext = os.path.splitext(base)[1]
-		if file_ext == '.nii':
-			if os.path.getsize(image_path) < 50000000:
-				image = nib.load(image_path)
-			else:
-				tempname = str(uuid.uuid4().hex) + '.nii'
-				os.system("zcat %s > %s" % (image_path,tempname))
-				image = nib.load(tempname)
-				os.system("rm %s" % tempname)
-		else:
-			print('Error: filetype for %s is not supported' % image_path)
-	elif file_ext == '.nii':
-		image = nib.load(image_path)
-	elif file_ext == '.mnc':
-		image = nib.load(image_path)
-	else:
-		print('Error filetype for %s is not supported' % file_ext)
-		quit()
+	image = open_voxel_neuroimage(image_path)
 	print("Imported:\t%s" % image_path)
 	if mask_index is not None:
-		image_data = image.get_data()
-		image_data = image_data[mask_index]
+		image_data = np.zeros((int(np.count_nonzero(mask_index)), int(np.prod(image.shape[3:]))), dtype = np.float32)
+		read_masked_voxels(image_path, mask_index, image_data, image = image)
+		if image.ndim == 3:
+			image_data = image_data[:, 0]
 		return image_data
 	else:
 		return image
 
+class MaskedImageCache(object):
+	"""
+	On-disk cache of masked images. Each image is stored as a memory-mappable float32 *.npy file (N_masked_voxels,
+	N_volumes) keyed by the image (path, size and modification time, or its content) and the mask. The least recently
+	used entries are removed when the cache is larger than max_bytes.
+	
+	Parameters
+	----------
+	cache_dir : string
+		PATH/TO/CACHE (created if it does not exist)
+	
+	Optional Flags
+	----------
+	max_bytes : int
+		Maximum size of the cache in bytes (Default = 10GB)
+	hash_content : bool
+		Key images by a hash of their content instead of their path, size and modification time (Default = False)
+	
+	"""
+	def __init__(self, cache_dir, max_bytes = 10 * 1024**3, hash_content = False):
+		self.cache_dir = cache_dir
+		self.max_bytes = int(max_bytes)
+		self.hash_content = hash_content
+		self._lock = threading.Lock()
+		if not os.path.exists(cache_dir):
+			os.makedirs(cache_dir)
+
+	def mask_key(self, mask_index):
+		mask_index = np.asarray(mask_index, dtype = bool)
+		h = hashlib.sha1(str(mask_index.shape).encode("UTF-8"))
+		h.update(np.packbits(mask_index).tobytes())
+		return h.hexdigest()
+
+	def image_key(self, image_path):
+		if self.hash_content:
+			h = hashlib.sha1()
+			with open(image_path, 'rb') as obj:
+				for block in iter(lambda: obj.read(16*1024*1024), b''):
+					h.update(block)
+		else:
+			stat = os.stat(image_path)
+			h = hashlib.sha1(("%s %d %d" % (os.path.realpath(image_path), stat.st_size, stat.st_mtime_ns)).encode("UTF-8"))
+		return h.hexdigest()
+
+	def filename(self, image_path, mask_key):
+		return os.path.join(self.cache_dir, "%s_%s.npy" % (self.image_key(image_path), mask_key[:16]))
+
+	def get(self, filename):
+		if not os.path.exists(filename):
+			return None
+		try:
+			data = np.load(filename, mmap_mode = 'r')
+		except (OSError, ValueError):
+			return None
+		# the modification time is the LRU clock
+		os.utime(filename, None)
+		return data
+
+	def put(self, filename, data):
+		tempname = "%s.%d.%d.tmp.npy" % (filename[:-4], os.getpid(), threading.get_ident())
+		np.save(tempname, np.asarray(data, dtype = np.float32))
+		os.replace(tempname, filename)
+		self.evict()
+
+	def evict(self):
+		with self._lock:
+			entries = []
+			for name in os.listdir(self.cache_dir):
+				if name.endswith('.npy') and not name.endswith('.tmp.npy'):
+					try:
+						stat = os.stat(os.path.join(self.cache_dir, name))
+					except OSError:
+						continue
+					entries.append((stat.st_mtime_ns, stat.st_size, name))
+			entries.sort()
+			total = sum([entry[1] for entry in entries])
+			for _, size, name in entries:
+				if total <= self.max_bytes:
+					break
+				try:
+					os.remove(os.path.join(self.cache_dir, name))
+				except OSError:
+					pass
+				total -= size
+
+def import_voxel_neuroimages(image_paths, mask_index, nthreads = 1, outname = None, cache = None):
+	"""
+	Parallel low-RAM importer of the masked voxels of many images (e.g., subjects). The images are read concurrently
+	and written directly to a preallocated (or memory-mapped) array.
+	
+	Parameters
+	----------
+	image_paths : list
+		PATH/TO/IMAGE for each image (3D or 4D)
+	mask_index : index array (bool or binary)
+		Masks the images by non-zero index
+	
+	Optional Flags
+	----------
+	nthreads : int
+		Number of images that are read concurrently (Default = 1)
+	outname : string
+		Writes the data to a memory-mapped *.npy file instead of memory (Default = None)
+	cache : object
+		MaskedImageCache. Cached images are not decoded (Default = None)
+	
+	Returns
+	-------
+	image_data : array
+		masked image data (N_masked_voxels, N_volumes) float32
+	
+	"""
+	mask_index = np.asarray(mask_index, dtype = bool)
+	nvoxels = int(np.count_nonzero(mask_index))
+	images = [None] * len(image_paths)
+	cached = [None] * len(image_paths)
+	cachenames = [None] * len(image_paths)
+	nvolumes = []
+	if cache is not None:
+		mask_key = cache.mask_key(mask_index)
+	for i, image_path in enumerate(image_paths):
+		if cache is not None:
+			cachenames[i] = cache.filename(image_path, mask_key)
+			cached[i] = cache.get(cachenames[i])
+		if cached[i] is not None:
+			nvolumes.append(int(cached[i].shape[1]))
+		else:
+			images[i] = open_voxel_neuroimage(image_path)
+			nvolumes.append(int(np.prod(images[i].shape[3:])))
+	offsets = np.concatenate(([0], np.cumsum(nvolumes))).astype(int)
+	shape = (nvoxels, int(offsets[-1]))
+	if outname is not None:
+		image_data = np.lib.format.open_memmap(outname, mode = 'w+', dtype = np.float32, shape = shape)
+	else:
+		image_data = np.zeros(shape, dtype = np.float32)
+	slice_rows = mask_slice_rows(mask_index)
+	def read_image(i):
+		if cached[i] is not None:
+			image_data[:, offsets[i]:offsets[i+1]] = cached[i]
+			print("Imported:\t%s (cached)" % image_paths[i])
+			return
+		read_masked_voxels(image_paths[i], mask_index, image_data[:, offsets[i]:offsets[i+1]], slice_rows, images[i])
+		if cache is not None:
+			cache.put(cachenames[i], image_data[:, offsets[i]:offsets[i+1]])
+		print("Imported:\t%s" % image_paths[i])
+	with ThreadPoolExecutor(max_workers = nthreads) as executor:
+		list(executor.map(read_image, range(len(image_paths))))
+	return image_data
+
+def rm_anova_model(data, between_factor = None):
+	"""
+	Precomputes a repeated measure ANOVA with k intervals (timepoints) and an optional between subject factor. The
+	sums of squares of the subjects, the groups and the total within-subject sum of squares do not change when the
+	intervals are shuffled within each subject, so only the interval and interaction sums of squares are computed
+	for each permutation (rm_anova_fstats).
+	
+	Parameters
+	----------
+	data : array
+		Data array (N_intervals, N_individuals, N_dependent variables)
+	
+	Optional Flags
+	----------
+	between_factor : array
+		1D array of the between subject factor
+	
+	Returns
+	-------
+	rm_model : dict
+		the grand mean centred data (N_intervals * N_individuals, N_dependent variables), the group of each
+		individual, the invariant sums of squares, the degrees of freedom, and the between subject F-statistics
+	
+	"""
+	k, ns, nv = data.shape
+	if between_factor is None:
+		groups = np.zeros(ns, dtype = int)
+	else:
+		_, groups = np.unique(between_factor, return_inverse = True)
+	group_sizes = np.bincount(groups).astype(np.float64)
+	ng = len(group_sizes)
+	centred = np.array(data, dtype = np.float64).reshape(k*ns, nv)
+	centred -= centred.mean(0)
+	subject_means = centred.reshape(k, ns, nv).mean(0)
+	SSsub = k * np.sum(subject_means**2, 0)
+	SSgroups = np.zeros(nv)
+	for g in range(ng):
+		SSgroups += k * group_sizes[g] * subject_means[groups == g].mean(0)**2
+	rm_model = {'k': k,
+		'ns': ns,
+		'groups': groups,
+		'group_sizes': group_sizes,
+		'data': centred,
+		'SSgroups': SSgroups,
+		'SSwithinsubs': np.einsum('ij,ij->j', centred, centred) - SSsub,
+		'df_time': k - 1,
+		'df_int': (ng - 1) * (k - 1),
+		'df_error': (ns - ng) * (k - 1)}
+	if ng > 1:
+		rm_model['df_groups'] = ng - 1
+		rm_model['df_withingroups'] = ns - ng
+		rm_model['Fbetween'] = np.divide(SSgroups / (ng - 1), (SSsub - SSgroups) / (ns - ng))
+	return rm_model
+
+def rm_permutations(ns, k, nperm, seed = None):
+	"""
+	Random within-subject permutations of the intervals
+	
+	Parameters
+	----------
+	ns : int
+		number of individuals
+	k : int
+		number of intervals
+	nperm : int
+		number of permutations
+	
+	Optional Flags
+	----------
+	seed : int
+		random seed
+	
+	Returns
+	-------
+	permutations : array
+		the order of the intervals of each individual (N_permutations, N_individuals, N_intervals)
+	
+	"""
+	return np.argsort(np.random.RandomState(seed).random_sample((nperm, ns, k)), 2)
+
+def rm_anova_fstats(rm_model, permutations = None, blocksize = 16, dtype = np.float32):
+	"""
+	F-statistics of the interval and the factor*interval interaction for a set of within-subject permutations. The
+	cell means of a block of permutations are computed with one matrix multiplication of the data.
+	
+	Parameters
+	----------
+	rm_model : dict
+		output of rm_anova_model
+	
+	Optional Flags
+	----------
+	permutations : array
+		the order of the intervals of each individual (N_permutations, N_individuals, N_intervals). Default is the
+		unpermuted data.
+	blocksize : int
+		number of permutations per matrix multiplication (default = 16)
+	dtype : dtype
+		output type (default = np.float32)
+	
+	Returns
+	-------
+	Ftime : array
+		F-statistics of the interval (N_permutations, N_dependent variables)
+	Fint : array
+		F-statistics of the factor*interval interaction (N_permutations, N_dependent variables). None without a
+		between subject factor.
+	
+	"""
+	k = rm_model['k']
+	ns = rm_model['ns']
+	groups = rm_model['groups']
+	group_sizes = rm_model['group_sizes']
+	ng = len(group_sizes)
+	nv = rm_model['data'].shape[1]
+	if permutations is None:
+		permutations = np.tile(np.arange(k), (1, ns, 1))
+	permutations = np.asarray(permutations).reshape(-1, ns, k)
+	nperm = permutations.shape[0]
+	Ftime = np.zeros((nperm, nv), dtype = dtype)
+	Fint = None
+	if ng > 1:
+		Fint = np.zeros((nperm, nv), dtype = dtype)
+	subjects = np.arange(ns)
+	for start in range(0, nperm, blocksize):
+		block = permutations[start:start+blocksize]
+		nblock = block.shape[0]
+		# weights of the cell (group, interval) means: row (permutation, group, interval), column (interval, subject)
+		weights = np.zeros((nblock, ng, k, k*ns))
+		for b in range(nblock):
+			for t in range(k):
+				weights[b, groups, t, block[b,:,t]*ns + subjects] = 1 / group_sizes[groups]
+		cells = np.dot(weights.reshape(nblock*ng*k, k*ns), rm_model['data']).reshape(nblock, ng, k, nv)
+		time_means = np.einsum('g,bgtv->btv', group_sizes, cells) / ns
+		SStime = ns * np.sum(time_means**2, 1)
+		SSerror = rm_model['SSwithinsubs'] - SStime
+		if ng > 1:
+			SSint = np.einsum('g,bgtv->bv', group_sizes, cells**2) - SStime - rm_model['SSgroups']
+			SSerror -= SSint
+			Fint[start:start+nblock] = np.divide(SSint / rm_model['df_int'], SSerror / rm_model['df_error'])
+		Ftime[start:start+nblock] = np.divide(SStime / rm_model['df_time'], SSerror / rm_model['df_error'])
+	return (Ftime, Fint)
+
 def rm_anova(data, output_sig = False):
 	"""
 	Repeated measure ANOVA for longitudinal dependent variables
@@ -1269,23 +2107,10 @@ def rm_anova(data, output_sig = False):
 		P-statistics of the interval variable
 	
 	"""
-
-	k = data.shape[0]
-	ni = data.shape[1]
-	mu_grand = np.divide((np.mean(data[0],0) + np.mean(data[1],0)),2)
-	SStime = ni * ((np.mean(data[0],0)-mu_grand)**2 + (np.mean(data[1],0)-mu_grand)**2)
-	SSw = np.sum(np.square(data[0] - np.mean(data[0],0)),0) + np.sum(np.square(data[1] - np.mean(data[1],0)),0)
-	SSsub = k * np.sum(np.square(np.divide((data[0] + data[1]),2) - mu_grand),0)
-	SSerror = SSw - SSsub
-
-	df_time = (k-1)
-	df_error = (ni -1) * df_time
-
-	MStime = np.divide(SStime, df_time)
-	MSerror = np.divide(SSerror, df_error)
-	F = np.divide(MStime, MSerror)
+	rm_model = rm_anova_model(data.reshape(data.shape[0], data.shape[1], -1))
+	F = rm_anova_fstats(rm_model, dtype = np.float64)[0][0].reshape(data.shape[2:])
 	if output_sig:
-		P = 1 - f.cdf(F,df_time,df_error)
+		P = 1 - f.cdf(F,rm_model['df_time'],rm_model['df_error'])
 		return(F, P)
 	else:
 		return(F)
@@ -1326,80 +2151,15 @@ def rm_anova_one_bs_factor(data, between_factor, output_sig = False):
 		P-statistics of the factor*interval interaction
 	
 	"""
-
-	k = data.shape[0]
-	Ns =  data.shape[1]
-
-	#grand mean
-	mu_grand = 0
-	for i in range(k):
-		mu_grand += np.mean(data[i],0)
-	mu_grand = np.divide(mu_grand,k)
-
-	# Total sum of squares
-	if data.ndim == 3:
-		SStotal = np.sum((data - mu_grand)**2, (0,1))
-	else:
-		SStotal = np.sum((data - mu_grand)**2)
-
-
-	# Sum of squareas of the subjects
-	SSsub = np.sum((np.mean(data,0) - mu_grand)**2,0) * k
-
-	ni_array = []
-	for factor in np.unique(between_factor):
-		ni = data[:,between_factor==factor].shape[1]
-		ni_array.append(ni)
-	ni = np.divide(np.sum(np.array(ni_array)), k)
-	print ni
-
-	# Sum of squares of the groups
-	SSgroups = 0
-	for factor in np.unique(between_factor):
-		if data.ndim == 3:
-			SSgroups += (np.mean(data[:,between_factor==factor], (0,1)) - mu_grand)**2 * k * data[:,between_factor==factor].shape[1]
-		else:
-			SSgroups += (np.mean(data[:,between_factor==factor]) - mu_grand)**2 * k * data[:,between_factor==factor].shape[1]
-
-	# Sum of squares intervals (i.e., time)
-	ki = len(np.unique(between_factor))
-	SStime = np.sum((np.mean(data,1) - mu_grand)**2,0) * ni * ki
-
-	# Sum of squares for cells
-	SScells = 0
-
-	for factor in np.unique(between_factor):
-		SScells += np.sum(np.square(np.mean(data[:,between_factor==factor],1) - mu_grand),0) * data[:,between_factor==factor].shape[1]
-
-	SSint = SScells - SStime - SSgroups
-	SSwithingroups = SSsub - SSgroups
-
-	SSwithinsubs = SStotal - SSsub
-	SSintwithingroups = SSwithinsubs - SStime - SSint
-
-	df_total = k * Ns - 1
-	df_groups = ki - 1
-	df_withingroups = (ki * (ni - 1))
-	df_time = (k-1)
-	df_int = df_groups * df_time
-	df_intwithingroups = df_total - df_groups - df_withingroups - df_time - df_int
-
-	MSgroups = np.divide(SSgroups, df_groups)
-	MSwithingroups = np.divide(SSwithingroups, df_withingroups)
-	Fbetween = np.divide(MSgroups, MSwithingroups)
-
-
-	MStime = np.divide(SStime, df_time)
-	MSint = np.divide(SSint, df_int)
-	MSintwithingroups = np.divide(SSintwithingroups, df_intwithingroups)
-
-	Ftime =  np.divide(MStime, MSintwithingroups)
-	Fint =  np.divide(MSint, MSintwithingroups)
-
+	rm_model = rm_anova_model(data.reshape(data.shape[0], data.shape[1], -1), between_factor)
+	Ftime, Fint = rm_anova_fstats(rm_model, dtype = np.float64)
+	Fbetween = rm_model['Fbetween'].reshape(data.shape[2:])
+	Ftime = Ftime[0].reshape(data.shape[2:])
+	Fint = Fint[0].reshape(data.shape[2:])
 	if output_sig:
-		Pbetween = 1 - f.cdf(Fbetween,df_groups,df_withingroups)
-		Ptime = 1 - f.cdf(Ftime,df_time,df_intwithingroups)
-		Pint = 1 - f.cdf(Fint,df_int,df_intwithingroups)
+		Pbetween = 1 - f.cdf(Fbetween,rm_model['df_groups'],rm_model['df_withingroups'])
+		Ptime = 1 - f.cdf(Ftime,rm_model['df_time'],rm_model['df_error'])
+		Pint = 1 - f.cdf(Fint,rm_model['df_int'],rm_model['df_error'])
 		return(Fbetween, Ftime, Fint, Pbetween, Ptime, Pint)
 	else:
 		return(Fbetween, Ftime, Fint)
@@ -21,6 +21,16 @@ from libcpp.vector cimport vector
 cdef extern from "fast_tfce.hpp":
   void tfce[T](float H, float E, float minT, float deltaT, vector[vector[int]]& adjacencyList, T* image, T* enhn)
 
+cdef vector[vector[int]]* csr_to_adjacency(const int[::1] indptr, const int[::1] indices):
+  cdef Py_ssize_t num_vertex = indptr.shape[0] - 1
+  cdef vector[vector[int]] *Adjacency_ = new vector[vector[int]](num_vertex)
+  cdef Py_ssize_t i, j
+  for i in range(num_vertex):
+    Adjacency_[0][i].reserve(indptr[i+1] - indptr[i])
+    for j in range(indptr[i], indptr[i+1]):
+      Adjacency_[0][i].push_back(indices[j])
+  return Adjacency_
+
 cdef class CreateAdjSet:
   cdef vector[vector[int]] *Adjacency
 
@@ -32,6 +42,11 @@ cdef class CreateAdjSet:
     self.H = H
     self.E = E
 
+    if hasattr(pyAdjacency, 'indptr'): # CSR adjacency (e.g., memory-mapped from a tmi file)
+      self.Adjacency = csr_to_adjacency(numpy.ascontiguousarray(pyAdjacency.indptr, dtype = numpy.int32),
+        numpy.ascontiguousarray(pyAdjacency.indices, dtype = numpy.int32))
+      return
+
     cdef vector[vector[int]] *Adjacency_ = new vector[vector[int]]()
 
     cdef vector[int] Adjacency__
@@ -41,6 +56,9 @@ cdef class CreateAdjSet:
 
     self.Adjacency = Adjacency_
 
+  def __dealloc__(self):
+    del self.Adjacency
+
   def run(self, numpy.ndarray[float, ndim=1, mode="c"] image, numpy.ndarray[float, ndim=1, mode="c"] enhn):
     tfce[float](self.H, self.E, 0, 0, self.Adjacency[0], &image[0], &enhn[0])
 
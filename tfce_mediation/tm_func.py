@@ -25,9 +25,10 @@ import nibabel as nib
 from time import time
 import matplotlib.pyplot as plt
 
-from tfce_mediation.cynumstats import tval_int
-from tfce_mediation.tm_io import savemgh_v2, savenifti_v2
-from tfce_mediation.pyfunc import convert_redtoyellow, convert_bluetolightblue, convert_mpl_colormaps, calc_sobelz, convert_mni_object, convert_fs, convert_gifti, convert_ply
+from tfce_mediation.cynumstats import tval_int, resid_covars
+from tfce_mediation.tfce import CreateAdjSet
+from tfce_mediation.tm_io import savemgh_v2, savenifti_v2, write_tm_filetype, CSRAdjacency, adjacency_to_csr, read_tm_data_block, read_tmi_index, tmi_data_shape
+from tfce_mediation.pyfunc import convert_redtoyellow, convert_bluetolightblue, convert_mpl_colormaps, mediation_invariants, calc_sobelz_permutations, convert_mni_object, convert_fs, convert_gifti, convert_ply
 
 # Main Functions
 
@@ -62,33 +63,12 @@ def calculate_tfce(merge_y, masking_array, pred_x, calcTFCE, vdensity, position_
 	if no_intercept:
 		tvals = tvals[1:,:]
 	tvals = tvals.astype(np.float32, order = "C")
-	tfce_tvals = np.zeros_like(tvals).astype(np.float32, order = "C")
-	neg_tfce_tvals = np.zeros_like(tvals).astype(np.float32, order = "C")
+	tfce_tvals, neg_tfce_tvals = tfce_from_tvals(tvals, calcTFCE, vdensity, position_array, fullmask)
 
 	for tstat_counter in range(tvals.shape[0]):
-		tval_temp = np.zeros_like((fullmask)).astype(np.float32, order = "C")
-		if tvals.shape[0] == 1:
-			tval_temp[fullmask==1] = tvals[0]
-		else:
-			tval_temp[fullmask==1] = tvals[tstat_counter]
-		tval_temp = tval_temp.astype(np.float32, order = "C")
-		tfce_temp = np.zeros_like(tval_temp).astype(np.float32, order = "C")
-		neg_tfce_temp = np.zeros_like(tval_temp).astype(np.float32, order = "C")
-		calcTFCE.run(tval_temp, tfce_temp)
-		calcTFCE.run((tval_temp*-1), neg_tfce_temp)
-		tval_temp = tval_temp[fullmask==1]
-		tfce_temp = tfce_temp[fullmask==1]
-		neg_tfce_temp = neg_tfce_temp[fullmask==1]
-#		position = 0
 		for surf_count in range(len(masking_array)):
 			start = position_array[surf_count]
 			end = position_array[surf_count+1]
-			if isinstance(vdensity, int): # check vdensity is a scalar
-				tfce_tvals[tstat_counter,start:end] = (tfce_temp[start:end] * (tval_temp[start:end].max()/100) * vdensity)
-				neg_tfce_tvals[tstat_counter,start:end] = (neg_tfce_temp[start:end] * ((tval_temp*-1)[start:end].max()/100) * vdensity)
-			else:
-				tfce_tvals[tstat_counter,start:end] = (tfce_temp[start:end] * (tval_temp[start:end].max()/100) * vdensity[start:end])
-				neg_tfce_tvals[tstat_counter,start:end] = (neg_tfce_temp[start:end] * ((tval_temp*-1)[start:end].max()/100) * vdensity[start:end])
 			if randomise:
 				if set_surf_count is not None:
 					os.system("echo %f >> perm_maxTFCE_surf%d_tcon%d.csv" % (np.nanmax(tfce_tvals[tstat_counter,start:end]),int(set_surf_count[surf_count]),tstat_counter+1))
@@ -115,9 +95,6 @@ def calculate_tfce(merge_y, masking_array, pred_x, calcTFCE, vdensity, position_
 		tvals = None
 		tfce_tvals = None
 		neg_tfce_tvals = None
-	tval_temp = None
-	tfce_temp = None
-	neg_tfce_temp = None
 	del calcTFCE
 	if not randomise:
 		return (tvals.astype(np.float32, order = "C"), tfce_tvals.astype(np.float32, order = "C"), neg_tfce_tvals.astype(np.float32, order = "C"))
@@ -185,6 +162,358 @@ def low_ram_calculate_tfce(data, mask, pred_x, calcTFCE, vdensity, set_surf_coun
 		return (tvals.astype(np.float32, order = "C"), tfce_tvals.astype(np.float32, order = "C"), neg_tfce_tvals.astype(np.float32, order = "C"))
 
 
+# TFCE transformation of t-values (positive and negative) with the scaling and vertex density weighting of each surface
+#
+# Input:
+# tvals = the t-values (contrasts, vertices)
+# calcTFCE = the TFCE function
+# vdensity = the vertex density weighting (or 1)
+# position_array = the position of each mask in the data array
+# fullmask = concatenated mask of all masks
+# negative = also transform the negative associations (default is true). Only tfce_tvals is returned if false (e.g., F-statistics).
+#
+# Output:
+# tfce_tvals = TFCE transformed values for postive associations
+# neg_tfce_tvals = TFCE transformed values for negative associations
+def tfce_from_tvals(tvals, calcTFCE, vdensity, position_array, fullmask, negative = True):
+	tfce_tvals = np.zeros(tvals.shape, dtype = np.float32)
+	neg_tfce_tvals = np.zeros(tvals.shape, dtype = np.float32)
+	for tstat_counter in range(tvals.shape[0]):
+		tval_temp = np.zeros(fullmask.shape, dtype = np.float32)
+		tval_temp[fullmask==1] = tvals[tstat_counter]
+		tfce_temp = np.zeros_like(tval_temp)
+		neg_tfce_temp = np.zeros_like(tval_temp)
+		calcTFCE.run(tval_temp, tfce_temp)
+		if negative:
+			calcTFCE.run((tval_temp*-1), neg_tfce_temp)
+		tval_temp = tval_temp[fullmask==1]
+		tfce_temp = tfce_temp[fullmask==1]
+		neg_tfce_temp = neg_tfce_temp[fullmask==1]
+		for surf_count in range(len(position_array) - 1):
+			start = position_array[surf_count]
+			end = position_array[surf_count+1]
+			if isinstance(vdensity, int): # check vdensity is a scalar
+				weight = vdensity
+			else:
+				weight = vdensity[start:end]
+			tfce_tvals[tstat_counter,start:end] = (tfce_temp[start:end] * (tval_temp[start:end].max()/100) * weight)
+			if negative:
+				neg_tfce_tvals[tstat_counter,start:end] = (neg_tfce_temp[start:end] * ((tval_temp*-1)[start:end].max()/100) * weight)
+	if not negative:
+		return tfce_tvals
+	return (tfce_tvals, neg_tfce_tvals)
+
+
+# TFCE object, vertex density weighting and full mask of a tmi file (shared by the tmi statistics commands)
+#
+# Input:
+# masking_array = masks of the tmi file
+# adjacency_array = adjacency sets of the tmi file
+# setadjacencyobjs = the adjacency set of each mask (default is one adjacency set per mask, in order)
+# tfce = TFCE settings [H, E]
+# noweight = do not weight each vertex for density of vertices
+#
+# Output:
+# calcTFCE = the TFCE function of the merged adjacency sets
+# vdensity = the vertex density weighting (or 1)
+# fullmask = concatenated mask of all masks
+def setup_tfce(masking_array, adjacency_array, setadjacencyobjs = None, tfce = [2.0, 0.67], noweight = False):
+	if setadjacencyobjs:
+		if len(setadjacencyobjs) == len(masking_array):
+			adjacent_range = np.array(setadjacencyobjs, dtype = int)
+		else:
+			print("Error: # of masking arrays (%d) must and list of matching adjacency (%d) must be equal." % (len(masking_array), len(setadjacencyobjs)))
+			quit()
+	else:
+		adjacent_range = list(range(len(adjacency_array)))
+	calcTFCE = CreateAdjSet(float(tfce[0]), float(tfce[1]), merge_adjacency_array(adjacent_range, adjacency_array))
+
+	# make mega mask
+	fullmask = create_full_mask(masking_array)
+
+	if not noweight:
+		# correction for vertex density
+		vdensity = []
+		for i in range(len(masking_array)):
+			temp_vdensity = adjacency_array[adjacent_range[i]].degree().astype(np.float64)
+			if masking_array[i].shape[2] == 1:
+				temp_vdensity = temp_vdensity[masking_array[i][:,0,0]==True]
+			vdensity = np.hstack((vdensity, np.array((1 - (temp_vdensity/temp_vdensity.max())+(temp_vdensity.mean()/temp_vdensity.max())), dtype=np.float32)))
+		del temp_vdensity
+	else:
+		vdensity = 1
+	return (calcTFCE, vdensity, fullmask)
+
+
+# Columns of a stats tmi file of t-values: the t-values, and the positive and negative TFCE values of each contrast
+#
+# Input:
+# tvals = the t-values (contrasts, vertices)
+# tfce_tvals = TFCE transformed values for postive associations
+# neg_tfce_tvals = TFCE transformed values for negative associations
+#
+# Output:
+# outdata = the data array (vertices, columns)
+# contrast_names = the name of each column
+def tstat_columns(tvals, tfce_tvals, neg_tfce_tvals):
+	num_contrasts = tvals.shape[0]
+	contrast_names = []
+	for i in range(num_contrasts):
+		contrast_names.append(("tstat_con%d" % (i+1)))
+	for j in range(num_contrasts):
+		contrast_names.append(("tstat_tfce_con%d" % (j+1)))
+	for k in range(num_contrasts):
+		contrast_names.append(("negtstat_tfce_con%d" % (k+1)))
+	outdata = np.column_stack((tvals.T, tfce_tvals.T))
+	outdata = np.column_stack((outdata, neg_tfce_tvals.T))
+	return (outdata, contrast_names)
+
+
+# Writes a stats tmi file with the masks and surfaces of the analysed tmi file
+#
+# Input:
+# outname = the stats tmi file
+# outdata = the data array (vertices, columns)
+# contrast_names = the name of each column
+# masking_array, maskname, affine_array, vertex_array, face_array, surfname = from the analysed tmi file
+def write_stats_tmi(outname, outdata, contrast_names, masking_array, maskname, affine_array, vertex_array, face_array, surfname):
+	write_tm_filetype(outname,
+		image_array = outdata,
+		masking_array = masking_array,
+		maskname = maskname,
+		affine_array = affine_array,
+		vertex_array = vertex_array,
+		face_array = face_array,
+		surfname = surfname,
+		checkname = False,
+		columnids = np.array(contrast_names),
+		tmi_history=[])
+
+
+# Out-of-core GLM
+#
+# The data (vertices, subjects) is read in blocks of vertices from a memory-mapped source, and only the t-values of
+# each model are kept in memory. The size of the blocks is set by a memory budget.
+
+# T-values of a GLM for every column of y (same as cynumstats.tval_int without the per-vertex loop)
+def glm_tvals(X, invXX, y):
+	n, k = X.shape
+	a = np.dot(np.dot(invXX, X.T), y)
+	sigma2 = np.sum((y - np.dot(X, a))**2, axis=0) / (n - k)
+	se = np.sqrt(np.outer(np.diag(invXX), sigma2))
+	return (a / se).astype(np.float32)
+
+
+# Returns a function that reads a block of vertices, block(start, stop, subjects = None) -> (vertices, subjects), of a
+# tmi file or a numpy (*.npy) array (vertices, subjects). subjects is an optional [start, stop) range. Neither is read
+# into memory.
+#
+# Input:
+# tm_file = the *.tmi file (binary)
+# npy_file = the *.npy file
+#
+# Output:
+# read_block = block reader
+# nvertices = number of vertices
+# nsubjects = number of subjects
+def data_block_reader(tm_file = None, npy_file = None):
+	if npy_file is not None:
+		data = np.load(npy_file, mmap_mode = 'r')
+		if data.ndim != 2:
+			print("Error: %s must be a two dimensional (vertices, subjects) array" % npy_file)
+			exit()
+		def read_block(start, stop, subjects = None):
+			if subjects is None:
+				subjects = (0, data.shape[1])
+			return np.array(data[start:stop, subjects[0]:subjects[1]], dtype = np.float32)
+		return (read_block, data.shape[0], data.shape[1])
+	# the reader can be used after a change of directory
+	tm_file = os.path.abspath(tm_file)
+	nvertices, nsubjects = tmi_data_shape(read_tmi_index(tm_file))
+	def read_block(start, stop, subjects = None):
+		return read_tm_data_block(tm_file, vertices = (start, stop), subjects = subjects)
+	return (read_block, nvertices, nsubjects)
+
+
+# Number of vertices per block for a memory budget (in MB). Each block is held as float32 (vertices, subjects) and
+# about three float64 working copies (subjects, vertices) for the regression.
+def glm_block_size(nsubjects, memory_budget, reserved_bytes = 0):
+	bytes_per_vertex = nsubjects * (4 + 3 * 8)
+	available = memory_budget * 1024**2 - reserved_bytes
+	if available < bytes_per_vertex:
+		print("Error: the memory budget (%d MB) is too small. At least %1.1f MB is required." % (memory_budget, (reserved_bytes + bytes_per_vertex) / 1024.**2))
+		exit()
+	return int(available // bytes_per_vertex)
+
+
+# Out-of-core T-values for one or more design matrices (e.g., the model and its permutations)
+#
+# Input:
+# read_block = block reader (see data_block_reader)
+# nvertices = number of vertices
+# designs = list of design matrices (subjects, k) including the intercept
+# x_covars = covariates including the intercept (subjects, k_covars). The data is residualised in each block.
+# subset = bool array of the subjects to include
+# memory_budget = memory budget in MB
+# no_intercept = strip the intercept contrasts
+#
+# Output:
+# tvals = the t-values (designs, contrasts, vertices)
+def out_of_core_tvals(read_block, nvertices, designs, x_covars = None, subset = None, memory_budget = 1024, no_intercept = True):
+	ndesigns = len(designs)
+	nsubjects, k = designs[0].shape
+	if no_intercept:
+		k -= 1
+	invXX = [np.linalg.inv(np.dot(X.T, X)) for X in designs]
+	tvals = np.zeros((ndesigns, k, nvertices), dtype = np.float32)
+	blocksize = glm_block_size(nsubjects if subset is None else int(np.sum(subset)), memory_budget, tvals.nbytes)
+	for start in range(0, nvertices, blocksize):
+		stop = min(start + blocksize, nvertices)
+		block = read_block(start, stop)
+		if subset is not None:
+			block = block[:,subset]
+		if x_covars is not None:
+			y = resid_covars(x_covars, block)
+		else:
+			y = block.T
+		for i, X in enumerate(designs):
+			temp_tvals = glm_tvals(X, invXX[i], y)
+			tvals[i,:,start:stop] = temp_tvals[1:] if no_intercept else temp_tvals
+		block = y = None
+	return tvals
+
+
+# T-values of many models in one pass over the data. Models that share the covariates and the subset of subjects share
+# the residualised data, and their X'Y is computed with one stacked matrix product per block.
+#
+# Input:
+# read_block = block reader (see data_block_reader)
+# nvertices = number of vertices
+# models = list of dicts with X (design including the intercept), x_covars (covariates including the intercept, or
+# None), subset (bool array of the subjects, or None) and group (models with the same group share x_covars and subset)
+# memory_budget = memory budget in MB
+# no_intercept = strip the intercept contrasts
+#
+# Output:
+# tvals = list of the t-values (contrasts, vertices) of each model
+def batch_glm_tvals(read_block, nvertices, models, memory_budget = 1024, no_intercept = True):
+	groups = {}
+	for i, model in enumerate(models):
+		groups.setdefault(model['group'], []).append(i)
+	stacked = {}
+	for group, members in groups.items():
+		stacked[group] = np.vstack([models[i]['X'].T for i in members])
+	invXX = [np.linalg.inv(np.dot(model['X'].T, model['X'])) for model in models]
+	tvals = [np.zeros((model['X'].shape[1] - int(no_intercept), nvertices), dtype = np.float32) for model in models]
+	nsubjects = max([model['X'].shape[0] for model in models])
+	blocksize = glm_block_size(nsubjects, memory_budget, sum([t.nbytes for t in tvals]))
+	for start in range(0, nvertices, blocksize):
+		stop = min(start + blocksize, nvertices)
+		block = read_block(start, stop)
+		for group, members in groups.items():
+			subset = models[members[0]]['subset']
+			x_covars = models[members[0]]['x_covars']
+			y = block if subset is None else block[:,subset]
+			if x_covars is not None:
+				y = resid_covars(x_covars, y)
+			else:
+				y = y.T.astype(np.float64)
+			XtY = np.dot(stacked[group], y)
+			YtY = np.sum(y**2, axis=0)
+			y = None
+			offset = 0
+			for i in members:
+				n, k = models[i]['X'].shape
+				temp_XtY = XtY[offset:offset + k]
+				offset += k
+				a = np.dot(invXX[i], temp_XtY)
+				sigma2 = (YtY - np.sum(a * temp_XtY, axis=0)) / (n - k)
+				temp_tvals = a / np.sqrt(np.outer(np.diag(invXX[i]), sigma2))
+				tvals[i][:,start:stop] = temp_tvals[1:] if no_intercept else temp_tvals
+		block = None
+	return tvals
+
+
+# Incremental GLM
+#
+# The sufficient statistics of the regression, Z'Z, Z'Y and the per-vertex Y'Y with Z = [1, predictors, covariates],
+# are additive over subjects. They are updated with the subjects that were added to the data since the last update,
+# and the t-values (including the residualisation for the covariates) are computed from them without the data.
+
+# Updates (or creates) the sufficient statistics with the subjects that are not included yet
+#
+# Input:
+# stats = the sufficient statistics (dict with ZtZ, ZtY, YtY and design) or None
+# read_block = block reader (see data_block_reader)
+# nvertices = number of vertices
+# design = Z for all subjects (subjects, k). The rows of the subjects that are already included must be unchanged.
+# memory_budget = memory budget in MB
+#
+# Output:
+# stats = the updated sufficient statistics
+def update_glm_statistics(stats, read_block, nvertices, design, memory_budget = 1024):
+	design = np.asarray(design, dtype = np.float64)
+	if stats is None:
+		k = design.shape[1]
+		stats = {'ZtZ': np.zeros((k, k)),
+			'ZtY': np.zeros((k, nvertices)),
+			'YtY': np.zeros((nvertices)),
+			'design': np.zeros((0, k))}
+	n_old = stats['design'].shape[0]
+	if stats['ZtY'].shape != (design.shape[1], nvertices):
+		print("Error: the design (%d columns) or the number of vertices (%d) does not match the sufficient statistics." % (design.shape[1], nvertices))
+		exit()
+	if (design.shape[0] < n_old) or (not np.array_equal(design[:n_old], stats['design'])):
+		print("Error: the design of the %d subjects in the sufficient statistics has changed. Create new sufficient statistics." % n_old)
+		exit()
+	new_design = design[n_old:]
+	if new_design.shape[0] == 0:
+		return stats
+	blocksize = glm_block_size(new_design.shape[0], memory_budget, stats['ZtY'].nbytes + stats['YtY'].nbytes)
+	for start in range(0, nvertices, blocksize):
+		stop = min(start + blocksize, nvertices)
+		y = read_block(start, stop, subjects = (n_old, design.shape[0])).T.astype(np.float64)
+		stats['ZtY'][:,start:stop] += np.dot(new_design.T, y)
+		stats['YtY'][start:stop] += np.sum(y**2, axis=0)
+		y = None
+	stats['ZtZ'] += np.dot(new_design.T, new_design)
+	stats['design'] = design
+	return stats
+
+
+# T-values from the sufficient statistics. The data is residualised for the covariates (and the intercept), and then
+# regressed on the intercept and the predictors (same as resid_covars followed by tval_int).
+#
+# Input:
+# stats = the sufficient statistics
+# num_predictors = number of predictors (the remaining columns of Z after the intercept are covariates)
+# no_intercept = strip the intercept contrasts
+#
+# Output:
+# tvals = the t-values (contrasts, vertices)
+def glm_statistics_tvals(stats, num_predictors, no_intercept = True):
+	ZtZ = stats['ZtZ']
+	ZtY = stats['ZtY']
+	YtY = stats['YtY']
+	n = stats['design'].shape[0]
+	x_index = np.arange(num_predictors + 1)
+	c_index = np.concatenate(([0], np.arange(num_predictors + 1, ZtZ.shape[0]))).astype(int)
+	XtY = ZtY[x_index]
+	if len(c_index) > 1:
+		CtY = ZtY[c_index]
+		B = np.linalg.solve(ZtZ[np.ix_(c_index, c_index)], CtY)
+		XtY = XtY - np.dot(ZtZ[np.ix_(x_index, c_index)], B)
+		YtY = YtY - np.sum(CtY * B, axis=0)
+	invXX = np.linalg.inv(ZtZ[np.ix_(x_index, x_index)])
+	a = np.dot(invXX, XtY)
+	sigma2 = (YtY - np.sum(a * XtY, axis=0)) / (n - len(x_index))
+	se = np.sqrt(np.outer(np.diag(invXX), sigma2))
+	tvals = (a / se).astype(np.float32)
+	if no_intercept:
+		tvals = tvals[1:]
+	return tvals
+
+
 # Mulitmodal Multisurface Mediation
 #
 # Input:
@@ -200,23 +529,19 @@ def low_ram_calculate_tfce(data, mask, pred_x, calcTFCE, vdensity, set_surf_coun
 # perm_number = the permutation number
 # randomise = randomisation flag
 # verbose = longer output
+# mediation_model = the precomputed parts of the mediation model (pyfunc.mediation_invariants) to reuse across permutations
 #
 # Output:
 # SobelZ = the indirect effect statistic
 # tfce_SobelZ = TFCE transformed indirect effect statistic
-def calculate_mediation_tfce(medtype, merge_y, masking_array, pred_x, depend_y, calcTFCE, vdensity, position_array, fullmask, perm_number = None, randomise = False, verbose = False, no_intercept = True, print_interation = False):
+def calculate_mediation_tfce(medtype, merge_y, masking_array, pred_x, depend_y, calcTFCE, vdensity, position_array, fullmask, perm_number = None, randomise = False, verbose = False, no_intercept = True, print_interation = False, mediation_model = None):
+	if mediation_model is None:
+		mediation_model = mediation_invariants(medtype, pred_x, depend_y, merge_y)
+	indices_perm = None
 	if randomise:
 		np.random.seed(perm_number+int(float(str(time())[-6:])*100))
 		indices_perm = np.random.permutation(list(range(merge_y.shape[0])))
-		if (medtype == 'M') or (medtype == 'I'):
-			if randomise:
-				pred_x = pred_x[indices_perm]
-		else:
-			if randomise:
-				pred_x = pred_x[indices_perm]
-				depend_y = depend_y[indices_perm]
-	SobelZ = calc_sobelz(medtype, pred_x, depend_y, merge_y, merge_y.shape[0], merge_y.shape[1])
-	SobelZ = SobelZ.astype(np.float32, order = "C")
+	SobelZ = calc_sobelz_permutations(mediation_model, indices_perm)[0]
 	tfce_SobelZ = np.zeros_like(SobelZ).astype(np.float32, order = "C")
 	zval_temp = np.zeros_like((fullmask)).astype(np.float32, order = "C")
 	zval_temp[fullmask==1] = SobelZ
@@ -262,12 +587,16 @@ def calculate_mediation_tfce(medtype, merge_y, masking_array, pred_x, depend_y,
 # verbose = longer output
 # no_intercept = strip the intercept contrasts from the final results (default is true). Note, intercepts are always included in the regression model.
 # set_surf_count = set the surface number for output
+# mediation_model = the precomputed parts of the mediation model (pyfunc.mediation_invariants) to reuse across permutations
 #
 # Output:
 # SobelZ = the indirect effect statistic
 # tfce_SobelZ = TFCE transformed indirect effect statistic
-def low_ram_calculate_mediation_tfce(medtype, data, mask, pred_x, depend_y, calcTFCE, vdensity, set_surf_count = 0, perm_number = None, randomise = False, no_intercept = True, output_dir = None, perm_seed = None):
+def low_ram_calculate_mediation_tfce(medtype, data, mask, pred_x, depend_y, calcTFCE, vdensity, set_surf_count = 0, perm_number = None, randomise = False, no_intercept = True, output_dir = None, perm_seed = None, mediation_model = None):
 
+	if mediation_model is None:
+		mediation_model = mediation_invariants(medtype, pred_x, depend_y, data)
+	indices_perm = None
 	if randomise:
 		if perm_seed is not None:
 			np.random.seed(perm_number + perm_seed)
@@ -275,16 +604,7 @@ def low_ram_calculate_mediation_tfce(medtype, data, mask, pred_x, depend_y, calc
 			np.random.seed(perm_number+int(float(str(time())[-6:])*100))
 		indices_perm = np.random.permutation(list(range(data.shape[0])))
 
-		if (medtype == 'M') or (medtype == 'I'):
-			if randomise:
-				pred_x = pred_x[indices_perm]
-		else:
-			if randomise:
-				pred_x = pred_x[indices_perm]
-				depend_y = depend_y[indices_perm]
-
-	SobelZ = calc_sobelz(medtype, pred_x, depend_y, data, data.shape[0], data.shape[1])
-	SobelZ = SobelZ.astype(np.float32, order = "C")
+	SobelZ = calc_sobelz_permutations(mediation_model, indices_perm)[0]
 	tfce_SobelZ = np.zeros_like(SobelZ).astype(np.float32, order = "C")
 	zval = np.zeros_like((mask)).astype(np.float32, order = "C")
 	zval[mask==1] = SobelZ
@@ -517,27 +837,55 @@ def create_full_mask(masking_array):
 # adjacency_array = adjacency sets included in the tmi file
 #
 # Output:
-# adjacency = adjacency for all masks in tmi file
+# adjacency = CSR adjacency for all masks in tmi file
 def merge_adjacency_array(adjacent_range, adjacency_array):
 	v_count = 0
-	if len(adjacent_range) == 1:
-		adjacency = np.copy(adjacency_array[0])
-		for i in range(len(adjacency)):
-			adjacency[i] = np.array(list(adjacency[i])).tolist() # list fixes 'set' 'int' error
+	nnz_count = 0
+	indptr = [np.zeros((1), dtype = np.int32)]
+	indices = []
+	distances = []
+	for e in adjacent_range:
+		adjacency = adjacency_to_csr(adjacency_array[e])
+		indptr.append(adjacency.indptr[1:] + nnz_count)
+		indices.append(adjacency.indices + v_count)
+		distances.append(adjacency.distances)
+		v_count += adjacency.nvertices
+		nnz_count += adjacency.nnz
+	if any(d is None for d in distances):
+		distances = None
 	else:
-		for e in adjacent_range:
-			if v_count == 0:
-				adjacency = np.copy(adjacency_array[0])
-				for i in range(len(adjacency)):
-					adjacency[i] = np.array(list(adjacency[i])).tolist() # list fixes 'set' 'int' error
-				v_count += len(adjacency_array[e])
-			else:
-				temp_adjacency = np.copy(adjacency_array[e])
-				for i in range(len(adjacency_array[e])):
-					temp_adjacency[i] = np.add(list(temp_adjacency[i]), v_count).tolist() # list fixes 'set' 'int' error
-				adjacency = np.hstack((adjacency, temp_adjacency))
-				v_count += len(adjacency_array[e])
-	return adjacency
+		distances = np.concatenate(distances)
+	return CSRAdjacency(np.concatenate(indptr), np.concatenate(indices), distances)
+
+
+# Voxel adjacency set for TFCE connectivity. The voxels are labelled (in the order of np.where) in a volume padded
+# by one voxel of -1, and the neighbours of all voxels are looked up at once for each offset.
+#
+# Input:
+# data_index = binary mask of the voxels (3D)
+# connectivity = 6 (faces), 18 (faces and edges) or 26 (faces, edges and corners)
+#
+# Output:
+# adjacency = CSR adjacency of the masked voxels (neighbours are sorted)
+def create_voxel_adjacency(data_index, connectivity = 26):
+	connectivity = int(connectivity)
+	if connectivity not in (6, 18, 26):
+		raise ValueError("Voxel connectivity must be 6, 18 or 26 (not %d)" % connectivity)
+	data_index = np.asarray(data_index) > 0
+	num_voxel = int(data_index.sum())
+	labels = np.full(np.array(data_index.shape) + 2, -1, dtype = np.int32)
+	labels[1:-1, 1:-1, 1:-1][data_index] = np.arange(num_voxel, dtype = np.int32)
+	x, y, z = [axis + 1 for axis in np.where(data_index)]
+	# offsets in lexicographic order, so that neighbour labels increase along each row
+	offsets = [(dx, dy, dz) for dx in (-1, 0, 1) for dy in (-1, 0, 1) for dz in (-1, 0, 1)
+		if 0 < abs(dx) + abs(dy) + abs(dz) <= {6: 1, 18: 2, 26: 3}[connectivity]]
+	neighbours = np.empty((num_voxel, len(offsets)), dtype = np.int32)
+	for k, (dx, dy, dz) in enumerate(offsets):
+		neighbours[:, k] = labels[x + dx, y + dy, z + dz]
+	valid = neighbours >= 0
+	indptr = np.zeros(num_voxel + 1, dtype = np.int32)
+	np.cumsum(valid.sum(1), out = indptr[1:])
+	return CSRAdjacency(indptr, neighbours[valid])
 
 
 # checks the permutation files and make sure that they are all the same length
@@ -20,13 +20,21 @@
 
 import os
 import sys
+import json
+import shutil
+import gzip
+import hashlib
+import zlib
+import lzma
 try:
 	import pickle as pickle
 except:
 	import pickle
 import nibabel as nib
 import numpy as np
+from scipy import sparse
 from time import gmtime, strftime
+from concurrent.futures import ThreadPoolExecutor
 from tfce_mediation.pyfunc import check_outname, save_fs
 
 
@@ -65,11 +73,451 @@ def savenifti_v2(image_array, index, imagename, affine=None):
 	imgout[index]=outdata
 	nib.save(nib.Nifti1Image(imgout.astype(np.float32, order = "C"),affine=affine),imagename)
 
+######################
+# ADJACENCY OBJECTS  #
+######################
+
+class CSRAdjacency(object):
+	"""
+	Adjacency set stored in compressed sparse row (CSR) format. The neighbours
+	of vertex (or voxel) i are indices[indptr[i]:indptr[i+1]].
+
+	Parameters
+	----------
+	indptr : array
+		int32 array of row pointers (length = number of vertices + 1)
+	indices : array
+		int32 array of neighbour indices
+
+	Optional Parameters
+	----------
+	distances : array
+		float32 array of the (geodesic) distance to each neighbour
+
+	"""
+	def __init__(self, indptr, indices, distances = None):
+		self.indptr = np.asarray(indptr, dtype = np.int32)
+		self.indices = np.asarray(indices, dtype = np.int32)
+		if distances is not None:
+			distances = np.asarray(distances, dtype = np.float32)
+		self.distances = distances
+
+	@property
+	def nvertices(self):
+		return int(self.indptr.shape[0] - 1)
+
+	@property
+	def nnz(self):
+		return int(self.indices.shape[0])
+
+	@property
+	def shape(self):
+		return (self.nvertices,)
+
+	def degree(self):
+		return np.diff(self.indptr)
+
+	def neighbours(self, i):
+		return self.indices[self.indptr[i]:self.indptr[i+1]]
+
+	def tolist(self):
+		return [self.indices[self.indptr[i]:self.indptr[i+1]].tolist() for i in range(self.nvertices)]
+
+
+# Converts an adjacency set (list of sets or lists, object array or CSRAdjacency) to CSRAdjacency
+def adjacency_to_csr(adjacency, distances = None):
+	if isinstance(adjacency, CSRAdjacency):
+		return adjacency
+	neighbours = [sorted(adj) for adj in adjacency]
+	indptr = np.zeros(len(neighbours)+1, dtype = np.int32)
+	np.cumsum([len(adj) for adj in neighbours], out = indptr[1:])
+	indices = np.fromiter((j for adj in neighbours for j in adj), dtype = np.int32, count = int(indptr[-1]))
+	return CSRAdjacency(indptr, indices, distances)
+
+
+# Loads an adjacency set from a *.npy (object array of sets) or a *.npz (CSR) file
+def load_adjacency(filename):
+	if filename.endswith('.npz'):
+		csr = np.load(filename)
+		distances = None
+		if 'distances' in csr.files:
+			distances = csr['distances']
+		return CSRAdjacency(csr['indptr'], csr['indices'], distances)
+	adjacency = np.load(filename, allow_pickle = True)
+	return adjacency_to_csr(adjacency)
+
+
+# Saves an adjacency set as a *.npz file (CSR)
+def save_adjacency(filename, adjacency):
+	adjacency = adjacency_to_csr(adjacency)
+	if adjacency.distances is not None:
+		np.savez(filename, indptr = adjacency.indptr, indices = adjacency.indices, distances = adjacency.distances)
+	else:
+		np.savez(filename, indptr = adjacency.indptr, indices = adjacency.indices)
+
+
+# Loads the sufficient statistics of an incremental GLM (see tm_func.update_glm_statistics)
+def load_glm_statistics(filename):
+	stats = np.load(filename)
+	return {'ZtZ': stats['ZtZ'], 'ZtY': stats['ZtY'], 'YtY': stats['YtY'], 'design': stats['design']}
+
+
+# Saves the sufficient statistics of an incremental GLM. The file is replaced only when it is completely written.
+def save_glm_statistics(filename, stats):
+	tempname = "%s.%d.tmp.npz" % (filename[:-4] if filename.endswith('.npz') else filename, os.getpid())
+	np.savez(tempname, ZtZ = stats['ZtZ'], ZtY = stats['ZtY'], YtY = stats['YtY'], design = stats['design'])
+	os.replace(tempname, filename)
+
+
+class GeodesicCache(object):
+	"""
+	On-disk cache of geodesic distance lists. The pairs of vertices (i < j) within a threshold and their distances
+	are stored as a CSR adjacency (*.npz) keyed by a hash of the vertices, faces and geodesic method. A cached list
+	is also used for any smaller threshold, so adjacency sets and FWHM distance lists for the same mesh are only
+	computed once. Geodesic FWHM smoothing kernels (sparse matrices) are cached for each distance list, FWHM and mask.
+
+	Parameters
+	----------
+	cache_dir : string
+		PATH/TO/CACHE (created if it does not exist)
+
+	"""
+	def __init__(self, cache_dir):
+		self.cache_dir = cache_dir
+		if not os.path.exists(cache_dir):
+			os.makedirs(cache_dir)
+
+	def mesh_key(self, v, f, method = 'exact', subdivision_level = 2):
+		v = np.ascontiguousarray(v, dtype = np.float32)
+		f = np.ascontiguousarray(f, dtype = np.int32)
+		h = hashlib.sha1(("%s %s %s %d" % (str(v.shape), str(f.shape), method, subdivision_level)).encode("UTF-8"))
+		h.update(v.tobytes())
+		h.update(f.tobytes())
+		return h.hexdigest()
+
+	def filename(self, mesh_key, threshold):
+		return os.path.join(self.cache_dir, "%s_%1.4fmm.npz" % (mesh_key, float(threshold)))
+
+	# Returns (source, target, distances) for the pairs within threshold, or None
+	def get(self, mesh_key, threshold):
+		cached = []
+		for name in os.listdir(self.cache_dir):
+			if name.startswith(mesh_key + '_') and name.endswith('mm.npz'):
+				try:
+					cached_threshold = float(name[len(mesh_key)+1:-6])
+				except ValueError:
+					continue
+				if cached_threshold >= float(threshold):
+					cached.append((cached_threshold, name))
+		for _, name in sorted(cached):
+			try:
+				adjacency = load_adjacency(os.path.join(self.cache_dir, name))
+			except (OSError, ValueError, KeyError):
+				continue
+			if adjacency.distances is None:
+				continue
+			source = np.repeat(np.arange(adjacency.nvertices, dtype = np.int32), adjacency.degree())
+			within = adjacency.distances < float(threshold)
+			return source[within], adjacency.indices[within], adjacency.distances[within]
+		return None
+
+	def put(self, mesh_key, threshold, nvertices, source, target, distances):
+		order = np.lexsort((target, source))
+		indptr = np.zeros(nvertices + 1, dtype = np.int32)
+		np.cumsum(np.bincount(source, minlength = nvertices), out = indptr[1:])
+		filename = self.filename(mesh_key, threshold)
+		tempname = "%s.%d.tmp.npz" % (filename[:-4], os.getpid())
+		save_adjacency(tempname, CSRAdjacency(indptr, target[order], distances[order]))
+		os.replace(tempname, filename)
+
+	# Key of a precomputed distance list file (path, size and modification time)
+	def file_key(self, filename):
+		stat = os.stat(filename)
+		return hashlib.sha1(("%s %d %d" % (os.path.realpath(filename), stat.st_size, stat.st_mtime_ns)).encode("UTF-8")).hexdigest()
+
+	# Key of a smoothing kernel built from a distance list (mesh_key or file_key), a FWHM and a vertex mask
+	def kernel_key(self, distances_key, fwhm, mask_index = None):
+		h = hashlib.sha1(("%s %1.6f" % (distances_key, float(fwhm))).encode("UTF-8"))
+		if mask_index is not None:
+			h.update(np.asarray(mask_index).tobytes())
+		return h.hexdigest()
+
+	# Returns the cached sparse smoothing kernel, or None
+	def get_kernel(self, kernel_key):
+		filename = os.path.join(self.cache_dir, "%s_kernel.npz" % kernel_key)
+		if not os.path.exists(filename):
+			return None
+		try:
+			return sparse.load_npz(filename).tocsr()
+		except (OSError, ValueError, KeyError):
+			return None
+
+	def put_kernel(self, kernel_key, kernel):
+		filename = os.path.join(self.cache_dir, "%s_kernel.npz" % kernel_key)
+		tempname = "%s.%d.tmp.npz" % (filename[:-4], os.getpid())
+		sparse.save_npz(tempname, kernel)
+		os.replace(tempname, filename)
+
+######################
+# CHUNKED DATA ARRAY #
+######################
+
+# Encodes a data_array block. Returns the compressed bytes, scale and intercept (decoded = stored * scale + intercept).
+def encode_data_chunk(block, compression = 'zlib', quantisation = None):
+	scale = 1.0
+	intercept = 0.0
+	if quantisation == 'float16':
+		block = block.astype(np.float16)
+	elif quantisation == 'int16':
+		# the finite values are stored as -32767 to 32767, and non-finite values (NaN, +/-inf) as -32768 (decoded as NaN)
+		block = block.astype(np.float64)
+		finite = np.isfinite(block)
+		intercept = float(block[finite].min()) if finite.any() else 0.0
+		scale = (float(block[finite].max()) - intercept) / 65534. if finite.any() else 0.0
+		if scale > 0:
+			block = np.rint((np.where(finite, block, intercept) - intercept) / scale) - 32767
+		else:
+			block = np.zeros_like(block) - 32767
+		block[~finite] = -32768
+		block = block.astype(np.int16)
+		intercept += 32767 * scale
+	elif quantisation is None:
+		block = block.astype(np.float32)
+	else:
+		print("Error: quantisation %s is not understood {float16|int16}" % quantisation)
+		exit()
+	raw = np.ascontiguousarray(block).tobytes()
+	if compression == 'zlib':
+		raw = zlib.compress(raw, 6)
+	elif compression == 'lzma':
+		raw = lzma.compress(raw)
+	elif compression is not None:
+		print("Error: compression %s is not understood {zlib|lzma}" % compression)
+		exit()
+	return raw, scale, intercept
+
+
+# Decodes a data_array block written by encode_data_chunk
+def decode_data_chunk(raw, shape, compression = 'zlib', quantisation = None, scale = 1.0, intercept = 0.0):
+	if compression == 'zlib':
+		raw = zlib.decompress(raw)
+	elif compression == 'lzma':
+		raw = lzma.decompress(raw)
+	if quantisation == 'float16':
+		return np.frombuffer(raw, dtype = np.float16).reshape(shape).astype(np.float32)
+	elif quantisation == 'int16':
+		block = np.frombuffer(raw, dtype = np.int16).reshape(shape)
+		data = (block * scale + intercept).astype(np.float32)
+		data[block == -32768] = np.nan
+		return data
+	return np.frombuffer(raw, dtype = np.float32).reshape(shape)
+
+
+# Returns the (vertex, subject) slice of each chunk in storage order (subject blocks, then vertex blocks)
+def data_chunk_slices(datashape, chunkshape):
+	slices = []
+	for s in range(0, int(datashape[1]), int(chunkshape[1])):
+		for v in range(0, int(datashape[0]), int(chunkshape[0])):
+			slices.append((slice(v, min(v + int(chunkshape[0]), int(datashape[0]))), slice(s, min(s + int(chunkshape[1]), int(datashape[1])))))
+	return slices
+
+
+# Compresses a data_array in vertex x subject chunks. zlib and lzma release the GIL, so chunks are encoded in threads.
+# Each block of subjects is only read once from image_array, so it can be a lazily loaded source (see write_tm_filetype).
+def write_data_chunks(image_array, chunkshape = (4096, 256), compression = 'zlib', quantisation = None, nthreads = 1):
+	if image_array.ndim == 1:
+		image_array = np.asarray(image_array)[:, np.newaxis]
+	nvert, nsub = image_array.shape
+	data_chunks = []
+	for s in range(0, int(nsub), int(chunkshape[1])):
+		subjectblock = np.asarray(image_array[:, s:min(s + int(chunkshape[1]), int(nsub))])
+		def encode(v):
+			return encode_data_chunk(subjectblock[v:min(v + int(chunkshape[0]), int(nvert))], compression, quantisation)
+		if nthreads > 1:
+			with ThreadPoolExecutor(max_workers = nthreads) as executor:
+				data_chunks += list(executor.map(encode, range(0, int(nvert), int(chunkshape[0]))))
+		else:
+			data_chunks += [encode(v) for v in range(0, int(nvert), int(chunkshape[0]))]
+	return data_chunks
+
+
+# Reads a chunked data_array, or the [vertices, subjects] ranges of it. Only the chunks that overlap the ranges are decompressed.
+def read_data_chunks(tm_file, position, datashape, chunkshape, chunkindex, compression = 'zlib', quantisation = None, vertices = None, subjects = None, nthreads = 1):
+	if vertices is None:
+		vertices = (0, int(datashape[0]))
+	if subjects is None:
+		subjects = (0, int(datashape[1]))
+	outdata = np.zeros((vertices[1] - vertices[0], subjects[1] - subjects[0]), dtype = np.float32)
+	tasks = []
+	for sl, chunk in zip(data_chunk_slices(datashape, chunkshape), chunkindex):
+		if (sl[0].stop <= vertices[0]) or (sl[0].start >= vertices[1]) or (sl[1].stop <= subjects[0]) or (sl[1].start >= subjects[1]):
+			continue
+		tasks.append((sl, chunk))
+	def decode(task):
+		sl, chunk = task
+		with open(tm_file, 'rb') as obj:
+			obj.seek(position + int(chunk[0]))
+			raw = obj.read(int(chunk[1]))
+		block = decode_data_chunk(raw, (sl[0].stop - sl[0].start, sl[1].stop - sl[1].start), compression, quantisation, chunk[2], chunk[3])
+		v0 = max(sl[0].start, vertices[0])
+		v1 = min(sl[0].stop, vertices[1])
+		s0 = max(sl[1].start, subjects[0])
+		s1 = min(sl[1].stop, subjects[1])
+		outdata[v0-vertices[0]:v1-vertices[0], s0-subjects[0]:s1-subjects[0]] = block[v0-sl[0].start:v1-sl[0].start, s0-sl[1].start:s1-sl[1].start]
+	if nthreads > 1:
+		with ThreadPoolExecutor(max_workers = nthreads) as executor:
+			list(executor.map(decode, tasks))
+	else:
+		for task in tasks:
+			decode(task)
+	return outdata
+
+################
+# TMI ELEMENTS #
+################
+
+# Returns the header lines of a single element. The data elements (data_array, data_columns, data_rows) are stored uncompressed.
+def tmi_element_header(element, array, name = None):
+	header = "element %s\n" % element
+	if element in ['data_array', 'data_columns', 'data_rows']:
+		if array.ndim == 1:
+			nvert, nsub = array.shape[0], 1
+		else:
+			nvert, nsub = array.shape[0], array.shape[1]
+		header += "dtype float32\n"
+		header += "nbytes %d\n" % (int(nvert) * int(nsub) * 4)
+		header += "datashape %d %d\n" % (nvert, nsub)
+	elif element == 'masking_array':
+		header += "dtype uint8\n" # for binarized masks
+		header += "nbytes %d\n" % array.size
+		header += "nmasked %d\n" % np.count_nonzero(array)
+		header += "maskshape %d %d %d\n" % (array.shape[0], array.shape[1], array.shape[2])
+		header += "maskname %s\n" % name
+	elif element == 'affine':
+		header += "dtype float32\n"
+		header += "nbytes %d\n" % (array.size * 4)
+		header += "affineshape %d %d\n" % (array.shape[0], array.shape[1])
+	elif element == 'vertex':
+		header = "surfname %s\n" % name + header
+		header += "dtype float32\n"
+		header += "nbytes %d\n" % (array.size * 4)
+		header += "vertexshape %d %d\n" % (array.shape[0], array.shape[1])
+	elif element == 'face':
+		header += "dtype uint32\n"
+		header += "nbytes %d\n" % (array.size * 4)
+		header += "faceshape %d %d\n" % (array.shape[0], array.shape[1])
+	elif element == 'adjacency_csr':
+		nbytes = array.indptr.nbytes + array.indices.nbytes
+		if array.distances is not None:
+			nbytes += array.distances.nbytes
+		header += "dtype int32\n"
+		header += "nbytes %d\n" % nbytes
+		header += "adjlength %d\n" % array.nvertices
+		header += "adjnnz %d\n" % array.nnz
+		header += "adjdistances %d\n" % int(array.distances is not None)
+	elif element == 'column_id':
+		header += "dtype %s\n" % array.dtype
+		header += "nbytes %d\n" % array.nbytes
+		header += "listlength %d\n" % len(array)
+	else:
+		print("Error: element %s is not understood" % element)
+		exit()
+	return header
+
+
+# Writes the rows of an array as text. Each block of rows is formatted with a single format operation.
+def write_ascii_rows(o, array, fmt = '%.9g', blocksize = 16384):
+	array = np.asarray(array)
+	if array.ndim == 1:
+		array = array[:, np.newaxis]
+	rowfmt = ' '.join([fmt] * array.shape[1]) + '\n'
+	for i in range(0, int(array.shape[0]), blocksize):
+		block = np.asarray(array[i:i+blocksize])
+		o.write(((rowfmt * block.shape[0]) % tuple(block.ravel().tolist())).encode("UTF-8"))
+
+
+# Parses nrows lines of an ascii payload (split into lines) in one call. Returns the array and the next line.
+def read_ascii_rows(lines, line, nrows, ncols = 1, dtype = np.float32):
+	nrows = int(nrows)
+	if nrows == 0:
+		return np.zeros((0, ncols), dtype = dtype), line
+	array = np.fromstring(b' '.join(lines[line:line+nrows]), dtype = dtype, sep = ' ')
+	return array.reshape(nrows, ncols), line + nrows
+
+
+# Writes the payload of a single element to a file opened in binary mode
+def write_tmi_element(o, element, array, output_binary = True, blocksize = 64):
+	if element in ['data_array', 'data_columns', 'data_rows']:
+		if output_binary:
+			# stored transposed (subjects x vertices). Subjects are written in blocks, so array can be a lazily loaded source.
+			if array.ndim == 1:
+				np.asarray(array, dtype = np.float32).tofile(o)
+			else:
+				for s in range(0, int(array.shape[1]), blocksize):
+					np.array(np.asarray(array[:, s:s+blocksize]).T, dtype = np.float32).tofile(o)
+		else:
+			write_ascii_rows(o, np.asarray(array, dtype = np.float32))
+	elif element == 'masking_array':
+		if output_binary:
+			np.array(array.T, dtype = np.uint8).tofile(o)
+		else:
+			write_ascii_rows(o, np.column_stack(np.nonzero(array)), fmt = '%d')
+	elif element == 'affine':
+		if output_binary:
+			np.array(array.T, dtype = np.float32).tofile(o)
+		else:
+			write_ascii_rows(o, np.asarray(array, dtype = np.float32))
+	elif element == 'vertex':
+		if output_binary:
+			np.array(array.T, dtype = np.float32).tofile(o)
+		else:
+			write_ascii_rows(o, array, fmt = '%1.6f')
+	elif element == 'face':
+		if output_binary:
+			np.array(array.T, dtype = np.uint32).tofile(o)
+		else:
+			write_ascii_rows(o, array, fmt = '%d')
+	elif element == 'adjacency_csr':
+		if output_binary:
+			array.indptr.tofile(o)
+			array.indices.tofile(o)
+			if array.distances is not None:
+				array.distances.tofile(o)
+		else:
+			write_ascii_rows(o, array.indptr, fmt = '%d')
+			write_ascii_rows(o, array.indices, fmt = '%d')
+			if array.distances is not None:
+				write_ascii_rows(o, array.distances, fmt = '%1.6f')
+	elif element == 'column_id':
+		if output_binary:
+			array.tofile(o)
+		else:
+			o.write(("\n".join([str(columnid) for columnid in array]) + "\n").encode("UTF-8"))
+
+
+# Opens a tmi file. Gzip compressed (ascii) tmi files are detected on reading by their magic number.
+def open_tmi_file(tm_file, mode = 'rb', output_gzip = None):
+	if output_gzip is None:
+		output_gzip = ('r' in mode) and is_gzip_file(tm_file)
+	if output_gzip:
+		return gzip.open(tm_file, mode, compresslevel = 6)
+	return open(tm_file, mode.replace('t', ''))
+
+
+def is_gzip_file(tm_file):
+	with open(tm_file, 'rb') as obj:
+		return obj.read(2) == b'\x1f\x8b'
+
+
+# Padding line of the header. It is overwritten when elements are appended in place.
+def tmi_reserved_line(nbytes):
+	return "reserved" + " " * max(int(nbytes) - 9, 0) + "\n"
+
 ###############
 #  WRITE TMI  #
 ###############
 
-def write_tm_filetype(outname, columnids = [], imgtype = [], checkname = True, output_binary = True, image_array = [], masking_array = [], maskname = [],  affine_array = [], vertex_array = [], face_array = [], surfname = [], adjacency_array = [], tmi_history = [], append_history = True): # NOTE: add ability to store subjectids and imgtypes
+def write_tm_filetype(outname, columnids = [], imgtype = [], checkname = True, output_binary = True, image_array = [], masking_array = [], maskname = [],  affine_array = [], vertex_array = [], face_array = [], surfname = [], adjacency_array = [], tmi_history = [], append_history = True, chunkshape = None, compression = None, quantisation = None, nthreads = 1, reserve_header = 4096, output_gzip = False): # NOTE: add ability to store subjectids and imgtypes
 	# timestamp
 	currentTime=int(strftime("%Y%m%d%H%M%S",gmtime()))
 	# counters
@@ -83,6 +531,8 @@ def write_tm_filetype(outname, columnids = [], imgtype = [], checkname = True, o
 	h_affine = 0
 	h_object = 0
 	h_adjacency = 0
+	# copy, so that the history of the caller (or the default argument) is not modified
+	tmi_history = list(tmi_history)
 
 	if not tmi_history == []:
 		for i in range(len(tmi_history)):
@@ -128,17 +578,13 @@ def write_tm_filetype(outname, columnids = [], imgtype = [], checkname = True, o
 			num_affine=int(affine_array.shape[0])
 		else:
 			print("Error affine dimension are not understood.")
-	if not adjacency_array==[]:
-		adjacency_array=np.array(adjacency_array)
-		if (adjacency_array.dtype.kind == 'O') or (adjacency_array.ndim==2):
-			num_adjacency=int(adjacency_array.shape[0])
-		elif adjacency_array.ndim==1:
-			num_adjacency = 1
-		else:
-			print("Error shape of adjacency objects are not understood.")
+	if len(adjacency_array) > 0:
+		# adjacency sets are always stored in CSR format (pickled adjacency objects are upgraded)
+		adjacency_array = [adjacency_to_csr(adjacency) for adjacency in adjacency_array]
+		num_adjacency = len(adjacency_array)
 
 	# write array shape
-	if not image_array == []:
+	if np.shape(image_array)[0] > 0:
 		num_data = 1
 		if image_array.ndim == 1:
 			nvert=len(image_array)
@@ -146,160 +592,345 @@ def write_tm_filetype(outname, columnids = [], imgtype = [], checkname = True, o
 		else:
 			nvert=image_array.shape[0]
 			nsub=image_array.shape[1]
+	if output_gzip:
+		# ascii files only, the binary format is read with seeks and memory-maps
+		if output_binary:
+			print("Error: gzip output is only supported for ascii tmi files.")
+			exit()
+		if outname.endswith('.gz'):
+			outname = outname[:-3]
 	if not outname.endswith('tmi'):
 		if output_binary:
 			if not outname.endswith('tmi'):
 				outname += '.tmi'
 		else:
 			outname += '.ascii.tmi'
+	if output_gzip:
+		outname += '.gz'
 	if checkname:
 		outname=check_outname(outname)
-	with open(outname, "w") as o:
+	remove_tmi_index(outname)
+	# chunked storage of the data_array (binary only)
+	data_chunks = []
+	if (num_data == 1) and output_binary and ((chunkshape is not None) or (compression is not None) or (quantisation is not None)):
+		if chunkshape is None:
+			chunkshape = (4096, 256)
+		data_chunks = write_data_chunks(image_array, chunkshape, compression, quantisation, nthreads)
+	with open_tmi_file(outname, "wt", output_gzip) as o:
 		o.write("tmi\n")
 		if output_binary:
 			o.write("format binary_%s_endian %s\n" % ( sys.byteorder, tm_filetype_version() ) )
 		else:
 			o.write("format ascii %s\n" % tm_filetype_version() )
 		o.write("comment made with TFCE_mediation\n")
-		if not image_array==[]:
-			o.write("element data_array\n")
-			o.write("dtype float32\n")
-			o.write("nbytes %d\n" % image_array.astype('float32').nbytes)
-			o.write("datashape %d %d\n" % (nvert,nsub))
-
-		if num_mask>0:
-			for i in range(num_mask):
-				o.write("element masking_array\n")
-				o.write("dtype uint8\n") # for binarized masks
-				o.write("nbytes %d\n" % masking_array[i].nbytes)
-				o.write("nmasked %d\n" % len(masking_array[i][masking_array[i]==True]))
-				o.write("maskshape %d %d %d\n" % (masking_array[i].shape[0],masking_array[i].shape[1],masking_array[i].shape[2]))
-				if maskname is not []:
-					o.write("maskname %s\n" % maskname[i])
-				else:
-					o.write("maskname unknown\n")
-
-		if num_affine>0:
-			for i in range(num_affine):
-				o.write("element affine\n")
+		if num_data == 1:
+			if len(data_chunks) > 0:
+				o.write("element data_array\n")
 				o.write("dtype float32\n")
-				o.write("nbytes %d\n" % affine_array[i].astype('float32').nbytes)
-				o.write("affineshape %d %d\n" % (affine_array[i].shape[0], affine_array[i].shape[1]) )
-
-		if num_object>0:
-			for i in range(num_object):
-				if surfname is not []:
-					o.write("surfname %s\n" % surfname[i])
-				else:
-					o.write("surfname unknown\n")
-
-				o.write("element vertex\n")
-				o.write("dtype float32\n")
-				o.write("nbytes %d\n" % vertex_array[i].astype('float32').nbytes)
-				o.write("vertexshape %d %d\n" % (vertex_array[i].shape[0], vertex_array[i].shape[1]) )
-
-				o.write("element face\n")
-				o.write("dtype uint32\n")
-				o.write("nbytes %d\n" % face_array[i].astype('uint32').nbytes)
-				o.write("faceshape %d %d\n" % (face_array[i].shape[0], face_array[i].shape[1]))
-
-		if num_adjacency>0:
-			for i in range(num_adjacency):
-				o.write("element adjacency_object\n")
-				o.write("dtype python_object\n")
-				o.write("nbytes %d\n" % len(pickle.dumps(adjacency_array[i], -1)) )
-				o.write("adjlength %d\n" % len(adjacency_array[i]) )
-
+				o.write("nbytes %d\n" % sum([len(chunk[0]) for chunk in data_chunks]))
+				o.write("datashape %d %d\n" % (nvert,nsub))
+				o.write("datachunks %d %d %d\n" % (int(chunkshape[0]), int(chunkshape[1]), len(data_chunks)))
+				o.write("compression %s\n" % str(compression).lower())
+				o.write("quantisation %s\n" % str(quantisation).lower())
+				# chunk index: byte offset (relative to the data_array), nbytes, scale, intercept
+				chunk_offset = 0
+				for chunk in data_chunks:
+					o.write("chunk %d %d %.17g %.17g\n" % (chunk_offset, len(chunk[0]), chunk[1], chunk[2]))
+					chunk_offset += len(chunk[0])
+			else:
+				o.write(tmi_element_header('data_array', image_array))
+		for i in range(num_mask):
+			o.write(tmi_element_header('masking_array', masking_array[i], maskname[i] if len(maskname) > i else 'unknown'))
+		for i in range(num_affine):
+			o.write(tmi_element_header('affine', affine_array[i]))
+		for i in range(num_object):
+			o.write(tmi_element_header('vertex', vertex_array[i], surfname[i] if len(surfname) > i else 'unknown'))
+			o.write(tmi_element_header('face', face_array[i]))
+		for i in range(num_adjacency):
+			o.write(tmi_element_header('adjacency_csr', adjacency_array[i]))
 		if not np.array_equal(columnids, []):
-				o.write("element column_id\n")
-				o.write("dtype %s\n" % columnids.dtype)
-				o.write("nbytes %d\n" % columnids.nbytes)
-				o.write("listlength %d\n" % len(columnids))
+			o.write(tmi_element_header('column_id', columnids))
 
 		# create a recorded of what was added to the file. 'mode_add' denotes these items were added. tmi_history is expandable.
 		if append_history:
 			tmi_history.append("history mode_add %d %d %d %d %d %d" % (currentTime, num_data, num_mask-h_mask, num_affine-h_affine, num_object-h_object, num_adjacency-h_adjacency) )
 		for i in range(len(tmi_history)):
 			o.write('%s\n' % (tmi_history[i]) )
+		# spare header space, so that elements can be appended in place (see append_tm_filetype)
+		if (reserve_header > 0) and not output_gzip:
+			o.write(tmi_reserved_line(reserve_header))
 		o.write("end_header\n")
 		o.close()
 
-		if output_binary:
-			with open(outname, "ab") as o:
-				image_array = np.array(image_array.T, dtype='float32') # transpose to reduce file size
-				image_array.tofile(o)
-				if num_mask>0:
-					for j in range(num_mask):
-						binarymask = masking_array[j] * 1
-						binarymask = np.array(binarymask.T, dtype=np.uint8)
-						binarymask.tofile(o)
-				if num_affine>0:
-					for j in range(num_affine):
-						outaffine = np.array(affine_array[j].T, dtype='float32')
-						outaffine.tofile(o)
-				if num_object>0:
-					for j in range(num_object):
-						outv = np.array(vertex_array[j].T, dtype='float32')
-						outv.tofile(o)
-						outf = np.array(face_array[j].T, dtype='uint32')
-						outf.tofile(o)
-				if not np.array_equal(columnids, []):
-					columnids.tofile(o)
-				if num_adjacency>0:
-					for j in range(num_adjacency):
-						pickle.dump(adjacency_array[j],o, protocol=pickle.HIGHEST_PROTOCOL)
-		else:
-			with open(outname, "a") as o:
-				if not image_array == []:
-					np.savetxt(o,image_array.astype(np.float32))
-				if num_mask>0:
-					for j in range(num_mask):
-						binarymask = masking_array[j] * 1
-						binarymask = np.array(binarymask, dtype=np.uint8)
-						x, y, z = np.ma.nonzero(binarymask)
-						for i in range(len(x)):
-							o.write("%d %d %d\n" % (int(x[i]), int(y[i]), int(z[i]) ) )
-				if num_affine>0:
-					for j in range(num_affine):
-						outaffine = np.array(affine_array[j])
-						np.savetxt(o,outaffine.astype(np.float32))
-				if columnids is not []:
-					columnids.tofile(o, sep='\n', format="%s")
-				if num_object>0:
-					for k in range(num_object):
-						for i in range(len(vertex_array[k])):
-							o.write("%1.6f %1.6f %1.6f\n" % (vertex_array[k][i,0],
-								vertex_array[k][i,1],
-								vertex_array[k][i,2]))
-						for j in range(len(face_array[k])):
-							o.write("%d %d %d\n" % (int(face_array[k][j,0]),
-								int(face_array[k][j,1]),
-								int(face_array[k][j,2])))
+	# gzip files are written as two gzip members (header, payload), which are read as a single stream
+	with open_tmi_file(outname, "ab", output_gzip) as o:
+		if len(data_chunks) > 0:
+			for chunk in data_chunks:
+				o.write(chunk[0])
+			data_chunks = []
+		elif num_data == 1:
+			write_tmi_element(o, 'data_array', image_array, output_binary)
+		for j in range(num_mask):
+			write_tmi_element(o, 'masking_array', masking_array[j], output_binary)
+		for j in range(num_affine):
+			write_tmi_element(o, 'affine', affine_array[j], output_binary)
+		for j in range(num_object):
+			write_tmi_element(o, 'vertex', vertex_array[j], output_binary)
+			write_tmi_element(o, 'face', face_array[j], output_binary)
+		for j in range(num_adjacency):
+			write_tmi_element(o, 'adjacency_csr', adjacency_array[j], output_binary)
+		if not np.array_equal(columnids, []):
+			write_tmi_element(o, 'column_id', columnids, output_binary)
 		o.close()
 
+# Appends elements to an existing tmi file (binary or ascii). The new elements are written at the end of the file and
+# the header is rewritten into its reserved space, so appending costs O(new data). Files without enough reserved space
+# are copied once with a new header. data_columns adds subjects (or contrasts) and data_rows adds the data of new masks.
+def append_tm_filetype(tm_file, data_columns = [], data_rows = [], columnids = [], masking_array = [], maskname = [], affine_array = [], vertex_array = [], face_array = [], surfname = [], adjacency_array = [], append_history = True, reserve_header = 4096):
+	currentTime=int(strftime("%Y%m%d%H%M%S",gmtime()))
+	# read the current header
+	index = read_tmi_index(tm_file)
+	if index.get('gzip', False):
+		print("Error: elements cannot be appended to a gzip compressed tmi file. Decompress %s first." % tm_file)
+		exit()
+	header_nbytes = index['header_nbytes']
+	with open(tm_file, 'rb') as obj:
+		header = obj.read(header_nbytes).decode("UTF-8").splitlines(True)
+	output_binary = index['filetype'] != 'ascii'
+	payload_nbytes = sum([e['nbytes'] for e in index['elements']])
+
+	# current shape of the data array
+	nvert, nsub = tmi_data_shape(index)
+
+	# new elements
+	new_elements = []
+	num_data = 0
+	for data, element in [(data_columns, 'data_columns'), (data_rows, 'data_rows')]:
+		if np.shape(data)[0] == 0:
+			continue
+		# data can be a lazily loaded source, it is written in blocks of subjects
+		if np.ndim(data) == 1:
+			data = np.asarray(data, dtype = np.float32)[:, np.newaxis]
+		if (nvert == 0) and (nsub == 0):
+			element = 'data_array'
+		elif (element == 'data_columns') and (data.shape[0] != nvert):
+			print("Error: the appended data_columns have %d rows, but the data array has %d rows." % (data.shape[0], nvert))
+			exit()
+		elif (element == 'data_rows') and (data.shape[1] != nsub):
+			print("Error: the appended data_rows have %d columns, but the data array has %d columns." % (data.shape[1], nsub))
+			exit()
+		new_elements.append((element, data, None))
+		nvert, nsub = (nvert + data.shape[0], data.shape[1]) if element == 'data_rows' else (data.shape[0], nsub + data.shape[1])
+		num_data = 1
+	for i in range(len(masking_array)):
+		new_elements.append(('masking_array', np.asarray(masking_array[i]), maskname[i] if len(maskname) > i else 'unknown'))
+	for i in range(len(affine_array)):
+		new_elements.append(('affine', np.asarray(affine_array[i]), None))
+	for i in range(len(vertex_array)):
+		new_elements.append(('vertex', np.asarray(vertex_array[i]), surfname[i] if len(surfname) > i else 'unknown'))
+		new_elements.append(('face', np.asarray(face_array[i]), None))
+	for i in range(len(adjacency_array)):
+		new_elements.append(('adjacency_csr', adjacency_to_csr(adjacency_array[i]), None))
+	if not np.array_equal(columnids, []):
+		new_elements.append(('column_id', np.array(columnids), None))
+	if len(new_elements) == 0:
+		return
+
+	# new header: existing elements, new elements, history, reserved space
+	element_lines = [line for line in header[:-1] if not (line.startswith('history') or line.startswith('reserved'))]
+	history_lines = [line for line in header if line.startswith('history')]
+	for element, array, name in new_elements:
+		element_lines.append(tmi_element_header(element, array, name))
+	if append_history:
+		history_lines.append("history mode_add %d %d %d %d %d %d\n" % (currentTime, num_data, len(masking_array), len(affine_array), len(vertex_array), len(adjacency_array)))
+	new_header = ''.join(element_lines + history_lines).encode("UTF-8")
+
+	if len(new_header) + len(tmi_reserved_line(0)) + len(b"end_header\n") <= header_nbytes:
+		# in place: append the new payload, then overwrite the header (same size)
+		with open(tm_file, 'r+b') as o:
+			o.seek(0, os.SEEK_END)
+			for element, array, name in new_elements:
+				write_tmi_element(o, element, array, output_binary)
+			o.seek(0)
+			o.write(new_header + tmi_reserved_line(header_nbytes - len(new_header) - len(b"end_header\n")).encode("UTF-8") + b"end_header\n")
+	else:
+		# not enough reserved space: copy the payload once behind a larger header
+		tmp_file = "%s.tmp" % tm_file
+		with open(tm_file, 'rb') as obj, open(tmp_file, 'wb') as o:
+			o.write(new_header)
+			if reserve_header > 0:
+				o.write(tmi_reserved_line(reserve_header).encode("UTF-8"))
+			o.write(b"end_header\n")
+			if output_binary:
+				obj.seek(os.stat(tm_file).st_size - payload_nbytes)
+			else:
+				obj.seek(header_nbytes)
+			shutil.copyfileobj(obj, o, 16*1024*1024)
+			for element, array, name in new_elements:
+				write_tmi_element(o, element, array, output_binary)
+		os.replace(tmp_file, tm_file)
+	remove_tmi_index(tm_file)
+
 ###############
-#  READ TMI   #
+#  TMI INDEX  #
 ###############
 
-def read_tm_filetype(tm_file, verbose=True):
-	# getfilesize
+# Parses the header of a tmi file into an index of its elements. Each element is a dictionary with the element name,
+# dtype, nbytes, shape and byte offset (binary files), and any element specific header fields (e.g., maskname, chunkindex).
+def parse_tmi_header(tm_file):
 	filesize = os.stat(tm_file).st_size
-	# declare variables
-	element = []
-	element_dtype = []
-	element_nbyte = []
-	element_nmasked = []
-	masking_array = []
-	datashape = []
-	maskshape = []
-	maskname = []
-	vertexshape = []
-	faceshape = []
-	surfname = []
-	affineshape = []
-	adjlength = []
-	array_read = []
-	object_read = []
+	compressed = is_gzip_file(tm_file)
+	with open_tmi_file(tm_file, 'rb', compressed) as obj:
+		header = obj.read(65536)
+		while b"\nend_header\n" not in header:
+			block = obj.read(len(header))
+			if len(block) == 0:
+				break
+			header += block
+	if not header.startswith(b"tmi\n"):
+		print("Error: not a TFCE_mediation image.")
+		exit()
+	end = header.find(b"\nend_header\n")
+	if end == -1:
+		print("Error: %s has no end_header" % tm_file)
+		exit()
+	header_nbytes = end + len(b"\nend_header\n")
+	lines = header[:end].decode("UTF-8").split("\n")
+	reader = lines[1].split()
+	if reader[0] != 'format':
+		print("Error: unknown reading file format")
+		exit()
+	index = {'filetype': reader[1], 'version': reader[2] if len(reader) > 2 else tm_filetype_version(), 'gzip': compressed, 'header_nbytes': header_nbytes, 'header_nlines': len(lines) + 1, 'elements': [], 'history': []}
+	current = None
+	surfname = None
+	for line in lines[2:]:
+		reader = line.split()
+		if len(reader) == 0:
+			continue
+		firstword = reader[0]
+		if firstword == 'element':
+			current = {'element': reader[1]}
+			if surfname is not None:
+				current['surfname'] = surfname
+				surfname = None
+			index['elements'].append(current)
+		elif firstword == 'dtype':
+			current['dtype'] = reader[1]
+		elif firstword == 'nbytes':
+			current['nbytes'] = int(reader[1])
+		elif firstword in ['datashape', 'maskshape', 'affineshape', 'vertexshape', 'faceshape', 'adjlength', 'listlength']:
+			current['shape'] = [int(i) for i in reader[1:]]
+		elif firstword in ['nmasked', 'adjnnz', 'adjdistances']:
+			current[firstword] = int(reader[1])
+		elif firstword == 'maskname':
+			current[firstword] = reader[1]
+		elif firstword in ['compression', 'quantisation']:
+			current[firstword] = None if reader[1] == 'none' else reader[1]
+		elif firstword == 'datachunks':
+			current['datachunks'] = [int(i) for i in reader[1:]]
+			current['chunkindex'] = []
+		elif firstword == 'chunk':
+			current['chunkindex'].append([int(reader[1]), int(reader[2]), float(reader[3]), float(reader[4])])
+		elif firstword == 'surfname':
+			# written before its vertex element
+			surfname = reader[1]
+		elif firstword == 'history':
+			index['history'].append(' '.join(reader))
+	# byte offsets (binary files): the payload is at the end of the file, in element order
+	position = filesize - sum([e['nbytes'] for e in index['elements']])
+	for e in index['elements']:
+		e['offset'] = position if index['filetype'] != 'ascii' else None
+		position += e['nbytes']
+	return index
+
+
+# Returns the shape of the data array, including any appended data_columns and data_rows
+def tmi_data_shape(index):
+	nvert = nsub = 0
+	for e in index['elements']:
+		if e['element'] == 'data_array':
+			nvert, nsub = e['shape']
+		elif e['element'] == 'data_columns':
+			nsub += e['shape'][1]
+		elif e['element'] == 'data_rows':
+			nvert += e['shape'][0]
+	return nvert, nsub
+
+
+# Sidecar file of the cached index
+def tmi_index_name(tm_file):
+	return "%s.idx" % tm_file
+
+
+# Removes a (stale) cached index. Called whenever a tmi file is written.
+def remove_tmi_index(tm_file):
+	if os.path.exists(tmi_index_name(tm_file)):
+		try:
+			os.remove(tmi_index_name(tm_file))
+		except OSError:
+			pass
+
+
+# Returns the index of a tmi file (see parse_tmi_header). The index is cached in a sidecar file (*.tmi.idx), which is
+# used as long as the size and modification time of the tmi file are unchanged.
+def read_tmi_index(tm_file, cache = True):
+	stat = os.stat(tm_file)
+	if cache and os.path.exists(tmi_index_name(tm_file)):
+		try:
+			with open(tmi_index_name(tm_file)) as obj:
+				cached = json.load(obj)
+			if (cached['size'] == stat.st_size) and (cached['mtime_ns'] == stat.st_mtime_ns):
+				return cached['index']
+		except (OSError, ValueError, KeyError):
+			pass
+	index = parse_tmi_header(tm_file)
+	if cache:
+		try:
+			with open(tmi_index_name(tm_file), 'w') as obj:
+				json.dump({'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'index': index}, obj)
+		except OSError:
+			pass
+	return index
+
+###############
+#  READ TMI   #
+###############
+
+# Adds the data_columns (subjects/contrasts) or data_rows (masks) appended to a tmi file to the data_array
+def merge_data_element(image_array, data, element):
+	if image_array.ndim == 1:
+		image_array = image_array[:, np.newaxis]
+	if element == 'data_columns':
+		return np.column_stack((image_array, data))
+	return np.vstack((image_array, data))
+
+
+# Column ids of appended data_columns are stored as additional column_id elements
+def merge_columnids(o_columnids, columnids):
+	if len(o_columnids) == 0:
+		return [columnids]
+	return [np.concatenate((o_columnids[0].astype(str), columnids.astype(str)))]
+
+
+# Memory-maps a CSR adjacency element at a byte offset of a binary tmi file
+def read_csr_adjacency(tm_file, position, adjlength, adjnnz, adjdistances = 0):
+	indptr = np.memmap(tm_file, dtype = np.int32, mode = 'r', offset = position, shape = (adjlength+1,))
+	position += indptr.nbytes
+	if adjnnz == 0:
+		return CSRAdjacency(indptr, np.zeros((0), dtype = np.int32))
+	indices = np.memmap(tm_file, dtype = np.int32, mode = 'r', offset = position, shape = (adjnnz,))
+	position += indices.nbytes
+	distances = None
+	if adjdistances:
+		distances = np.memmap(tm_file, dtype = np.float32, mode = 'r', offset = position, shape = (adjnnz,))
+	return CSRAdjacency(indptr, indices, distances)
+
+def read_tm_filetype(tm_file, verbose=True, nthreads=1, read_data=True):
+	index = read_tmi_index(tm_file)
+	element = [e['element'] for e in index['elements']]
+	maskname = [e.get('maskname', 'unknown') for e in index['elements'] if e['element'] == 'masking_array']
+	surfname = [e.get('surfname', 'unknown') for e in index['elements'] if e['element'] == 'vertex']
+	tmi_history = list(index['history'])
 	o_imgarray = []
 	o_masking_array = []
 	o_vertex = []
@@ -307,142 +938,146 @@ def read_tm_filetype(tm_file, verbose=True):
 	o_affine = []
 	o_adjacency = []
 	o_columnids = []
-	maskcounter = 0
-	vertexcounter = 0
-	facecounter = 0
-	affinecounter = 0
-	adjacencycounter = 0
-	tmi_history = []
-
-	# read first line
-	obj = open(tm_file, 'rb')
-	reader = obj.readline().decode("UTF-8").strip().split()
-	firstword=reader[0]
-	if firstword != 'tmi':
-		print("Error: not a TFCE_mediation image.")
-		exit()
-	reader = obj.readline().decode("UTF-8").strip().split()
-	firstword=reader[0]
-	if firstword != 'format':
-		print("Error: unknown reading file format")
-		exit()
-	else:
-		tm_filetype = reader[1]
-
 
-	while firstword != 'end_header':
-		reader = obj.readline().decode("UTF-8").strip().split()
-		firstword=reader[0]
-		if firstword == 'element':
-			element.append((reader[1]))
-		if firstword == 'dtype':
-			element_dtype.append((reader[1]))
-		if firstword == 'nbytes':
-			element_nbyte.append((reader[1]))
-		if firstword == 'datashape':
-			datashape.append(np.array((reader[1], reader[2])).astype(np.int))
-		if firstword == 'nmasked':
-			element_nmasked.append(( int(reader[1]) ))
-		if firstword == 'maskshape':
-			maskshape.append(np.array((reader[1], reader[2], reader[3])).astype(np.int))
-		if firstword == 'maskname':
-			maskname.append((reader[1]))
-		if firstword == 'affineshape':
-			affineshape.append(np.array((reader[1], reader[2])).astype(np.int))
-		if firstword == 'vertexshape':
-			vertexshape.append(np.array((reader[1], reader[2])).astype(np.int))
-		if firstword == 'surfname':
-			surfname.append((reader[1]))
-		if firstword == 'faceshape':
-			faceshape.append(np.array((reader[1], reader[2])).astype(np.int))
-		if firstword == 'adjlength':
-			adjlength.append(np.array(reader[1]).astype(np.int))
-		if firstword == 'history':
-			tmi_history.append(str(' '.join(reader)))
-		if firstword == 'listlength':
-			listlength=int(reader[1])
-	# skip header
-	position = filesize
-	for i in range(len(element_nbyte)):
-		position-=int(element_nbyte[i])
 	# readdata
-	if tm_filetype == 'binary_little_endian':
-		for e in range(len(element)):
-			obj.seek(position)
+	if index['filetype'] == 'binary_little_endian':
+		obj = open(tm_file, 'rb')
+		for e in index['elements']:
+			name = str(e['element'])
 			if verbose:
-				print(position)
-				print("reading %s" % str(element[e]))
-			if not str(element[e]) == 'adjacency_object':
-				array_read = np.fromfile(obj, dtype=element_dtype[e])
+				print(e['offset'])
+				print("reading %s" % name)
+			if (not read_data) and (name in ['data_array', 'data_columns', 'data_rows']):
+				# header only (e.g., the data is read in blocks with read_tm_data_block)
+				continue
+			if name == 'adjacency_object':
+				# upgrade pickled adjacency sets to CSR
+				obj.seek(e['offset'])
+				o_adjacency.append(adjacency_to_csr(pickle.load(obj)[:e['shape'][0]]))
+			elif name == 'adjacency_csr':
+				# memory-mapped, the adjacency set is only read from disk when it is used
+				o_adjacency.append(read_csr_adjacency(tm_file, e['offset'], e['shape'][0], e['adjnnz'], e['adjdistances']))
+			elif (name == 'data_array') and ('datachunks' in e):
+				o_imgarray.append(read_data_chunks(tm_file, e['offset'], e['shape'], e['datachunks'], e['chunkindex'], e['compression'], e['quantisation'], nthreads = nthreads))
 			else:
-				object_read.append(pickle.load(obj))
-			position += int(element_nbyte[e])
-			# reshape arrays
-			if str(element[e]) == 'data_array':
-				o_imgarray.append(np.array(array_read[:datashape[0][0]*datashape[0][1]]).reshape(datashape[0][1],datashape[0][0]).T)
-			if str(element[e]) == 'masking_array':
-				masktemp = np.array(array_read[:(maskshape[maskcounter][2]*maskshape[maskcounter][1]*maskshape[maskcounter][0])]).reshape(maskshape[maskcounter][2],maskshape[maskcounter][1],maskshape[maskcounter][0]).T
-				o_masking_array.append((np.array(masktemp, dtype=bool) ))
-				maskcounter += 1
-			if str(element[e]) == 'affine':
-				o_affine.append(np.array(array_read[:affineshape[affinecounter][1]*affineshape[affinecounter][0]]).reshape(affineshape[affinecounter][1],affineshape[affinecounter][0]).T)
-				affinecounter += 1
-			if str(element[e]) == 'vertex':
-				o_vertex.append(np.array(array_read[:vertexshape[vertexcounter][1]*vertexshape[vertexcounter][0]]).reshape(vertexshape[vertexcounter][1],vertexshape[vertexcounter][0]).T)
-				vertexcounter += 1
-			if str(element[e]) == 'face':
-				o_face.append(np.array(array_read[:faceshape[facecounter][1]*faceshape[facecounter][0]]).reshape(faceshape[facecounter][1],faceshape[facecounter][0]).T)
-				facecounter += 1
-			if str(element[e]) == 'column_id':
-				o_columnids.append(np.array(array_read[:listlength]))
-			if str(element[e]) == 'adjacency_object':
-				o_adjacency.append(np.array(object_read[adjacencycounter][:adjlength[adjacencycounter]]))
-				adjacencycounter += 1
-			array_read = []
-	elif tm_filetype == 'ascii':
-		for e in range(len(element)):
-			if str(element[e]) == 'data_array':
-				img_data = np.zeros((datashape[0][0], datashape[0][1]))
-				for i in range(int(datashape[0][0])):
-					img_data[i] = np.array(obj.readline().strip().split(), dtype = 'float32')
-				o_imgarray.append((np.array(img_data, dtype = 'float32')))
-			if str(element[e]) == 'masking_array':
-					for k in range(element_nmasked[maskcounter]):
-						masking_array.append((np.array(obj.readline().strip().split()).astype(np.int32)))
-					masking_array = np.array(masking_array)
-					outmask = np.zeros((maskshape[maskcounter]), dtype=np.int)
-					outmask[masking_array[:,0],masking_array[:,1],masking_array[:,2]] = 1
-					o_masking_array.append((np.array(outmask, dtype=bool)))
-					maskcounter += 1
-					masking_array=[]
-			if str(element[e]) == 'affine':
-				temparray = []
-				for k in range(int(affineshape[affinecounter][0])):
-					temparray.append((np.array(obj.readline().strip().split()).astype('float32')))
-				o_affine.append((np.array(temparray, dtype='float32')))
-				affinecounter += 1
-			if str(element[e]) == 'vertex':
-				temparray = []
-				for k in range(int(vertexshape[vertexcounter][0])):
-					temparray.append((np.array(obj.readline().strip().split()).astype('float32')))
-				o_vertex.append((np.array(temparray, dtype='float32')))
-				vertexcounter += 1
-			if str(element[e]) == 'face':
-				temparray = []
-				for k in range(int(faceshape[facecounter][0])):
-					temparray.append((np.array(obj.readline().strip().split()).astype('int32')))
-				o_face.append(( np.array(temparray, dtype='int32') ))
-				facecounter += 1
-			if str(element[e]) == 'column_id':
-				temparray = []
-				for k in range(listlength):
-					temparray.append(obj.readline().strip() )
-				o_columnids.append(( np.array(temparray, dtype=element_dtype[e]) ))
-
+				obj.seek(e['offset'])
+				array_read = np.fromfile(obj, dtype=e['dtype'], count=e['nbytes'] // np.dtype(e['dtype']).itemsize)
+				if name == 'column_id':
+					o_columnids = merge_columnids(o_columnids, np.array(array_read[:e['shape'][0]]))
+					continue
+				# arrays are stored transposed
+				shape = e['shape']
+				array_read = np.array(array_read[:int(np.prod(shape))]).reshape(shape[::-1]).T
+				if name == 'data_array':
+					o_imgarray.append(array_read)
+				elif name in ['data_columns', 'data_rows']:
+					# data appended in place (see append_tm_filetype)
+					o_imgarray[0] = merge_data_element(o_imgarray[0], array_read, name)
+				elif name == 'masking_array':
+					o_masking_array.append((np.array(array_read, dtype=bool) ))
+				elif name == 'affine':
+					o_affine.append(array_read)
+				elif name == 'vertex':
+					o_vertex.append(array_read)
+				elif name == 'face':
+					o_face.append(array_read)
+		obj.close()
+	elif index['filetype'] == 'ascii':
+		# each element is parsed in one call from its block of lines
+		with open_tmi_file(tm_file, 'rb', index.get('gzip', False)) as obj:
+			obj.seek(index['header_nbytes'])
+			lines = obj.read().split(b'\n')
+		line = 0
+		for e in index['elements']:
+			name = str(e['element'])
+			shape = e['shape']
+			if verbose:
+				print("reading %s" % name)
+			if (not read_data) and (name in ['data_array', 'data_columns', 'data_rows']):
+				line += shape[0]
+			elif name in ['data_array', 'data_columns', 'data_rows']:
+				img_data, line = read_ascii_rows(lines, line, shape[0], shape[1])
+				if name == 'data_array':
+					o_imgarray.append(img_data)
+				else:
+					o_imgarray[0] = merge_data_element(o_imgarray[0], img_data, name)
+			elif name == 'masking_array':
+				masking_array, line = read_ascii_rows(lines, line, e['nmasked'], 3, np.int64)
+				outmask = np.zeros((shape), dtype=bool)
+				outmask[masking_array[:,0],masking_array[:,1],masking_array[:,2]] = True
+				o_masking_array.append(outmask)
+			elif name == 'affine':
+				temparray, line = read_ascii_rows(lines, line, shape[0], shape[1])
+				o_affine.append(temparray)
+			elif name == 'vertex':
+				temparray, line = read_ascii_rows(lines, line, shape[0], shape[1])
+				o_vertex.append(temparray)
+			elif name == 'face':
+				temparray, line = read_ascii_rows(lines, line, shape[0], shape[1], np.int32)
+				o_face.append(temparray)
+			elif name == 'adjacency_csr':
+				indptr, line = read_ascii_rows(lines, line, shape[0]+1, 1, np.int32)
+				indices, line = read_ascii_rows(lines, line, e['adjnnz'], 1, np.int32)
+				distances = None
+				if e['adjdistances']:
+					distances, line = read_ascii_rows(lines, line, e['adjnnz'])
+					distances = distances.ravel()
+				o_adjacency.append(CSRAdjacency(indptr.ravel(), indices.ravel(), distances))
+			elif name == 'column_id':
+				temparray = [columnid.strip().decode("UTF-8") for columnid in lines[line:line+shape[0]]]
+				line += shape[0]
+				o_columnids = merge_columnids(o_columnids, np.array(temparray, dtype=e['dtype']))
 	else:
-		print("Error unknown filetype: %s" % tm_filetype)
+		print("Error unknown filetype: %s" % index['filetype'])
 	return(element, o_imgarray, o_masking_array, maskname, o_affine, o_vertex, o_face, surfname, o_adjacency, tmi_history, o_columnids)
 
+
+# Reads a block of the data_array of a binary tmi file without reading the whole file.
+# vertices and subjects are [start, stop) ranges. Chunked data_arrays only decompress the overlapping chunks.
+def read_tm_data_block(tm_file, vertices = None, subjects = None, nthreads = 1):
+	index = read_tmi_index(tm_file)
+	if index['filetype'] != 'binary_little_endian':
+		print("Error: partial reads are only supported for binary tmi files")
+		exit()
+	# the data_array and any appended data_columns/data_rows each cover a rectangle of the full data array
+	segments = []
+	nvert = nsub = 0
+	for e in index['elements']:
+		shape = e.get('shape')
+		if e['element'] == 'data_array':
+			segments.append((e, 0, 0))
+			nvert, nsub = shape
+		elif e['element'] == 'data_columns':
+			segments.append((e, 0, nsub))
+			nsub += shape[1]
+		elif e['element'] == 'data_rows':
+			segments.append((e, nvert, 0))
+			nvert += shape[0]
+	if len(segments) == 0:
+		print("Error: %s does not contain a data_array" % tm_file)
+		exit()
+	if vertices is None:
+		vertices = (0, nvert)
+	if subjects is None:
+		subjects = (0, nsub)
+	outdata = np.zeros((vertices[1] - vertices[0], subjects[1] - subjects[0]), dtype = np.float32)
+	for e, v_start, s_start in segments:
+		shape = e['shape']
+		v0 = max(vertices[0], v_start)
+		v1 = min(vertices[1], v_start + shape[0])
+		s0 = max(subjects[0], s_start)
+		s1 = min(subjects[1], s_start + shape[1])
+		if (v0 >= v1) or (s0 >= s1):
+			continue
+		if 'datachunks' in e:
+			block = read_data_chunks(tm_file, e['offset'], shape, e['datachunks'], e['chunkindex'], e['compression'], e['quantisation'], (v0 - v_start, v1 - v_start), (s0 - s_start, s1 - s_start), nthreads)
+		else:
+			# stored transposed (subjects x vertices)
+			data = np.memmap(tm_file, dtype = np.float32, mode = 'r', offset = e['offset'], shape = (shape[1], shape[0]))
+			block = data[s0 - s_start:s1 - s_start, v0 - v_start:v1 - v_start].T
+		outdata[v0 - vertices[0]:v1 - vertices[0], s0 - subjects[0]:s1 - subjects[0]] = block
+	return outdata
+
 # Depreciated
 ###############
 # CONVERT TMI #
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+#    Vectorised triangular mesh utilities for TFCE_mediation
+#    Copyright (C) 2016  Tristram Lett, Lea Waller
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+
+
+def mesh_edges(f):
+	"""
+	Unique undirected edges of a triangular mesh
+
+	Parameters
+	----------
+	f : array
+		face array (N_faces, 3)
+
+	Returns
+	-------
+	edges : array
+		int32 array (N_edges, 2) of vertex pairs (i < j) sorted by i then j
+
+	"""
+	f = np.asarray(f, dtype = np.int64)
+	edges = np.concatenate((f[:, [0, 1]], f[:, [1, 2]], f[:, [2, 0]]))
+	edges.sort(axis = 1)
+	edges = edges[edges[:, 0] != edges[:, 1]]
+	nvertices = int(f.max()) + 1 if f.size else 0
+	keys = np.unique(edges[:, 0] * nvertices + edges[:, 1])
+	return np.column_stack((keys // nvertices, keys % nvertices)).astype(np.int32)
+
+
+def mesh_adjacency(f, nvertices = None):
+	"""
+	Vertex adjacency (i.e., vertices that share an edge) of a triangular mesh in CSR format. The neighbours of
+	vertex i are indices[indptr[i]:indptr[i+1]] in ascending order.
+
+	Parameters
+	----------
+	f : array
+		face array (N_faces, 3)
+
+	Optional Flags
+	----------
+	nvertices : int
+		number of vertices (Default = largest vertex index in f + 1)
+
+	Returns
+	-------
+	indptr : array
+		int32 array of row pointers (nvertices + 1)
+	indices : array
+		int32 array of neighbour indices
+
+	"""
+	edges = mesh_edges(f)
+	if nvertices is None:
+		nvertices = int(np.max(f)) + 1 if np.size(f) else 0
+	rows = np.concatenate((edges[:, 0], edges[:, 1]))
+	cols = np.concatenate((edges[:, 1], edges[:, 0]))
+	order = np.lexsort((cols, rows))
+	indptr = np.zeros(nvertices + 1, dtype = np.int32)
+	np.cumsum(np.bincount(rows, minlength = nvertices), out = indptr[1:])
+	return indptr, cols[order].astype(np.int32)
+
+
+def merge_identical_vertices(v, f, decimals = 10, compact = False):
+	"""
+	Merges vertices with identical coordinates (after rounding)
+
+	Parameters
+	----------
+	v : array
+		vertex array (N_vertices, 3)
+	f : array
+		face array (N_faces, 3)
+
+	Optional Flags
+	----------
+	decimals : int
+		number of decimals used to compare coordinates (Default = 10)
+	compact : bool
+		Remove the duplicate vertices and renumber the faces. Otherwise, the faces are remapped to the first
+		occurrence of each vertex and the vertex array (and therefore the indexing of per-vertex data) is unchanged.
+		(Default = False)
+
+	Returns
+	-------
+	v : array
+		vertex array
+	f : array
+		int32 face array
+
+	"""
+	vr = np.ascontiguousarray(np.around(v, decimals = decimals))
+	_, idx, inv = np.unique(vr.view(vr.dtype.descr * vr.shape[1]).ravel(), return_index = True, return_inverse = True)
+	if compact:
+		# renumber in the order of first occurrence
+		order = np.argsort(idx)
+		rank = np.empty_like(order)
+		rank[order] = np.arange(order.shape[0])
+		return v[idx[order]], rank[inv][f].astype(np.int32)
+	return v, idx[inv][f].astype(np.int32)
+
+
+def face_normals(v, f):
+	"""
+	Unnormalised face normals (the length of each normal is twice the area of the face)
+	"""
+	v_ = v[f]
+	return np.cross(v_[:, 1] - v_[:, 0], v_[:, 2] - v_[:, 0])
+
+
+def remove_degenerate_triangles(v, f):
+	"""
+	Removes triangles with zero area (including faces with a repeated vertex)
+
+	Returns
+	-------
+	v : array
+		vertex array (unchanged)
+	f : array
+		face array
+
+	"""
+	fn = face_normals(v, f)
+	return v, f[np.logical_not(np.all(np.isclose(fn, 0), axis = 1)), :]
+
+
+def compute_vertex_normals(v, f):
+	"""
+	Area-weighted vertex normals (unit length; zero for vertices without faces)
+
+	Parameters
+	----------
+	v : array
+		vertex array (N_vertices, 3)
+	f : array
+		face array (N_faces, 3)
+
+	Returns
+	-------
+	vn : array
+		float32 array of vertex normals (N_vertices, 3)
+
+	"""
+	fn = face_normals(v, f)
+	vn = np.zeros((v.shape[0], 3), dtype = np.float64)
+	corners = np.ravel(f)
+	for k in range(3):
+		vn[:, k] = np.bincount(corners, weights = np.repeat(fn[:, k], 3), minlength = v.shape[0])
+	vlen = np.sqrt(np.sum(vn ** 2, axis = 1))
+	vn[vlen > 0] /= vlen[vlen > 0, None]
+	return vn.astype(np.float32)
+
+
+def project_vertices(v, vn, t, projfrac):
+	"""
+	Projects the vertices along their normals by a fraction of the cortical thickness (e.g., 0.5 for the
+	midthickness surface from the white matter surface)
+	"""
+	return v + (vn * t[:, None] * projfrac)
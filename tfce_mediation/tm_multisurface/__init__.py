@@ -2,3 +2,6 @@ from . import tm_mmr_randomise_parallel
 from . import tm_multimodality_multisurface_regression
 from . import tm_mmr_rand_low_ram
 from . import tm_mmr_rand_low_ram_parallel
+from . import tm_mmr_out_of_core
+from . import tm_mmr_batch
+from . import tm_rm_anova
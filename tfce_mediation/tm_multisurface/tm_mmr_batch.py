@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+#    TFCE_mediation TMI multimodality, multisurface multiple regression
+#    Copyright (C) 2017  Tristram Lett
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import shlex
+import numpy as np
+import argparse as ap
+from time import time
+
+from tfce_mediation.tm_io import read_tm_filetype
+from tfce_mediation.tm_func import setup_tfce, create_position_array, tfce_from_tvals, tstat_columns, write_stats_tmi, data_block_reader, batch_glm_tvals
+
+DESCRIPTION = "mmr-batch: fits many models (designs) of tm_multimodal mmr to one *.tmi file. The data and the adjacency sets are read once, the models are fitted in one pass over the data (in blocks of vertices), and one stats tmi file is written for each model."
+
+MANIFEST_HELP = "Manifest of the models. Each line is one model with the mmr options: -i_name NAME -i predictor(s) [-c covariates] [--subset subset]. Empty lines and lines starting with # are ignored. e.g., -i_name age -i age.csv -c sex.csv"
+
+def getArgumentParser(ap = ap.ArgumentParser(description = DESCRIPTION)):
+
+	ap.add_argument("-i_tmi", "--tmifile",
+		help="Input the *.tmi file for analysis. It must be a binary tmi file.",
+		nargs=1,
+		metavar=('*.tmi'),
+		required=True)
+	ap.add_argument("-m", "--manifest",
+		help=MANIFEST_HELP,
+		nargs=1,
+		metavar=('*.txt'),
+		required=True)
+	ap.add_argument("-mb", "--memorybudget",
+		help="Memory budget for the data blocks and the t-values in MB. Default: %(default)s MB.",
+		nargs=1,
+		type=int,
+		default=[1024],
+		metavar=('INT'))
+	ap.add_argument("--tfce",
+		help="TFCE settings. H (i.e., height raised to power H), E (i.e., extent raised to power E). Default: %(default)s). H=2, E=2/3.",
+		nargs=2,
+		default=[2.0,0.67],
+		type=float,
+		metavar=('H', 'E'))
+	ap.add_argument("-sa", "--setadjacencyobjs",
+		help="Specify the adjaceny object to use for each mask. The number of inputs must match the number of masks in the tmi file. Note, the objects start at zero. e.g., -sa 0 1 0 1",
+		nargs='+',
+		type=int,
+		metavar=('INT'))
+	ap.add_argument("--noweight",
+		help="Do not weight each vertex for density of vertices within the specified geodesic distance (not recommended).",
+		action="store_true")
+	return ap
+
+# parser of one line of the manifest
+def getManifestParser():
+	parser = ap.ArgumentParser(prog = "manifest", description = MANIFEST_HELP)
+	parser.add_argument("-i_name", "--analysisname",
+		nargs=1,
+		required=True)
+	parser.add_argument("-i", "--input",
+		nargs='+',
+		required=True)
+	parser.add_argument("-c", "--covariates",
+		nargs=1)
+	parser.add_argument("--subset",
+		nargs=1)
+	return parser
+
+# reads the models of the manifest. Models with the same covariates and subset share a group.
+def read_manifest(manifest, nsubjects):
+	parser = getManifestParser()
+	models = []
+	with open(manifest) as obj:
+		for line in obj:
+			line = line.strip()
+			if (line == '') or line.startswith('#'):
+				continue
+			mopts = parser.parse_args(shlex.split(line))
+			for i, arg_pred in enumerate(mopts.input):
+				if i == 0:
+					pred_x = np.genfromtxt(arg_pred, delimiter=',')
+				else:
+					pred_x = np.column_stack([pred_x, np.genfromtxt(arg_pred, delimiter=',')])
+			X = np.column_stack([np.ones(pred_x.shape[0]),pred_x])
+			x_covars = None
+			if mopts.covariates:
+				covars = np.genfromtxt(mopts.covariates[0], delimiter=',')
+				x_covars = np.column_stack([np.ones(len(covars)),covars])
+			subset = None
+			if mopts.subset:
+				subset = np.isfinite(np.genfromtxt(str(mopts.subset[0]), delimiter=','))
+				if len(subset) != nsubjects:
+					print("Error: the subset file of %s has %d rows, but the data has %d subjects." % (mopts.analysisname[0], len(subset), nsubjects))
+					quit()
+			elif X.shape[0] != nsubjects:
+				print("Error: the predictor(s) of %s have %d rows, but the data has %d subjects." % (mopts.analysisname[0], X.shape[0], nsubjects))
+				quit()
+			models.append({'name': mopts.analysisname[0],
+				'X': X,
+				'x_covars': x_covars,
+				'subset': subset,
+				'group': (mopts.covariates[0] if mopts.covariates else None, mopts.subset[0] if mopts.subset else None)})
+	if len(models) == 0:
+		print("Error: no models found in %s" % manifest)
+		quit()
+	return models
+
+def run(opts):
+	currentTime=int(time())
+
+	# read the tmi file without the data array
+	_, _, masking_array, maskname, affine_array, vertex_array, face_array, surfname, adjacency_array, _, _  = read_tm_filetype(opts.tmifile[0], verbose = False, read_data = False)
+	position_array = create_position_array(masking_array)
+	read_block, nvertices, nsubjects = data_block_reader(tm_file = opts.tmifile[0])
+	models = read_manifest(opts.manifest[0], nsubjects)
+
+	# one TFCE object for all models
+	calcTFCE, vdensity, fullmask = setup_tfce(masking_array, adjacency_array, opts.setadjacencyobjs, opts.tfce, opts.noweight)
+	adjacency_array = None
+
+	print("Fitting %d models (%d groups of covariates and subsets)" % (len(models), len(set([model['group'] for model in models]))))
+	all_tvals = batch_glm_tvals(read_block, nvertices, models, memory_budget = int(opts.memorybudget[0]))
+	print("Model fitting took %.1f seconds" % (time() - currentTime))
+
+	for model, tvals in zip(models, all_tvals):
+		tfce_tvals, neg_tfce_tvals = tfce_from_tvals(tvals, calcTFCE, vdensity, position_array, fullmask)
+		outdata, contrast_names = tstat_columns(tvals, tfce_tvals, neg_tfce_tvals)
+
+		# same output folder and name as mmr
+		outname = model['name']
+		if not os.path.exists("output_%s" % (outname)):
+			os.mkdir("output_%s" % (outname))
+		if not outname.endswith('tmi'):
+			outname += '.tmi'
+		outname = "output_%s/stats_%s" % (model['name'], outname)
+		print("Writing %s" % outname)
+		write_stats_tmi(outname, outdata, contrast_names, masking_array, maskname, affine_array, vertex_array, face_array, surfname)
+	print(("Total time took %.1f seconds" % (time() - currentTime)))
+
+if __name__ == "__main__":
+	parser = getArgumentParser()
+	opts = parser.parse_args()
+	run(opts)
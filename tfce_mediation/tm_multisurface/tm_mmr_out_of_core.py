@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+
+#    TFCE_mediation TMI multimodality, multisurface multiple regression
+#    Copyright (C) 2017  Tristram Lett
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import numpy as np
+import argparse as ap
+from time import time
+
+from tfce_mediation.tm_io import read_tm_filetype, load_glm_statistics, save_glm_statistics
+from tfce_mediation.tm_func import setup_tfce, create_position_array, tfce_from_tvals, tstat_columns, write_stats_tmi, data_block_reader, out_of_core_tvals, update_glm_statistics, glm_statistics_tvals
+
+DESCRIPTION = "mmr-ooc: out-of-core version of tm_multimodal mmr (multimodality, multisurface regression) for cohorts that exceed the available RAM. The data is read in blocks of vertices from the memory-mapped *.tmi file (or a *.npy array), and only the t-values are held in memory. The peak memory is bounded by --memorybudget."
+
+def getArgumentParser(ap = ap.ArgumentParser(description = DESCRIPTION)):
+
+	ap.add_argument("-i_tmi", "--tmifile",
+		help="Input the *.tmi file for analysis. It must be a binary tmi file.",
+		nargs=1,
+		metavar=('*.tmi'),
+		required=True)
+	ap.add_argument("-i", "--input",
+		nargs='+',
+		help="[Predictor(s)]",
+		metavar=('*.csv'),
+		required=True)
+	ap.add_argument("-c", "--covariates",
+		nargs=1,
+		help="[Covariate(s)]",
+		metavar=('*.csv'))
+	ap.add_argument("-npy", "--datanpy",
+		help="Read the data from a *.npy array (vertices, subjects) instead of the data_array of the tmi file. The vertices must be in the order of the masks of the tmi file.",
+		nargs=1,
+		metavar=('*.npy'))
+	ap.add_argument("-mb", "--memorybudget",
+		help="Memory budget for the data blocks and the t-values in MB. Default: %(default)s MB.",
+		nargs=1,
+		type=int,
+		default=[1024],
+		metavar=('INT'))
+	ap.add_argument("-ss", "--statsstore",
+		help="Persist the sufficient statistics (X'X, X'Y and Y'Y) of the model in a *.npz file. If the file exists, only the subjects that were added to the data since it was written (e.g., appended with tm_multimodal edit-tmi) are read, and the statistics are computed without reading the previous subjects. The rows of the predictors and covariates of the previous subjects must be unchanged. It cannot be used with --randomise or --subset.",
+		nargs=1,
+		metavar=('*.npz'))
+	ap.add_argument("-p", "--randomise",
+		help="Specify the range of permutations. e.g, -p 1 200",
+		nargs=2,
+		type=int,
+		metavar=['INT'])
+	ap.add_argument("--seed",
+		help="Random seed for the permutations (the seed of each permutation is the permutation number plus the seed).",
+		nargs=1,
+		type=int,
+		metavar=('INT'))
+	ap.add_argument("-i_name", "--analysisname",
+		help="Input the *.tmi file for analysis.",
+		nargs=1)
+	ap.add_argument("--tfce",
+		help="TFCE settings. H (i.e., height raised to power H), E (i.e., extent raised to power E). Default: %(default)s). H=2, E=2/3.",
+		nargs=2,
+		default=[2.0,0.67],
+		type=float,
+		metavar=('H', 'E'))
+	ap.add_argument("-sa", "--setadjacencyobjs",
+		help="Specify the adjaceny object to use for each mask. The number of inputs must match the number of masks in the tmi file. Note, the objects start at zero. e.g., -sa 0 1 0 1",
+		nargs='+',
+		type=int,
+		metavar=('INT'))
+	ap.add_argument("--noweight",
+		help="Do not weight each vertex for density of vertices within the specified geodesic distance (not recommended).",
+		action="store_true")
+	ap.add_argument("--subset",
+		help="Analyze a subset of subjects based on a single column text file. Subset will be performed based on whether each input is finite (keep) or text (remove).",
+		nargs=1)
+	return ap
+
+def run(opts):
+	currentTime=int(time())
+	memory_budget = int(opts.memorybudget[0])
+	if opts.statsstore:
+		if opts.randomise or opts.subset:
+			print("Error: --statsstore cannot be used with --randomise or --subset")
+			quit()
+		statsstore = os.path.abspath(opts.statsstore[0])
+
+	# read the tmi file without the data array
+	_, _, masking_array, maskname, affine_array, vertex_array, face_array, surfname, adjacency_array, _, _  = read_tm_filetype(opts.tmifile[0], verbose = False, read_data = False)
+	position_array = create_position_array(masking_array)
+
+	if opts.datanpy:
+		read_block, nvertices, nsubjects = data_block_reader(npy_file = opts.datanpy[0])
+	else:
+		read_block, nvertices, nsubjects = data_block_reader(tm_file = opts.tmifile[0])
+	if nvertices != position_array[-1]:
+		print("Error: the data has %d vertices, but the masks of %s contain %d vertices." % (nvertices, opts.tmifile[0], position_array[-1]))
+		quit()
+
+	calcTFCE, vdensity, fullmask = setup_tfce(masking_array, adjacency_array, opts.setadjacencyobjs, opts.tfce, opts.noweight)
+	adjacency_array = None
+
+	#load regressors
+	for i, arg_pred in enumerate(opts.input):
+		if i == 0:
+			pred_x = np.genfromtxt(arg_pred, delimiter=',')
+		else:
+			pred_x = np.column_stack([pred_x, np.genfromtxt(arg_pred, delimiter=',')])
+	X = np.column_stack([np.ones(pred_x.shape[0]),pred_x])
+	x_covars = None
+	design = X
+	if opts.covariates:
+		covars = np.genfromtxt(opts.covariates[0], delimiter=',')
+		x_covars = np.column_stack([np.ones(len(covars)),covars])
+		design = np.column_stack([X, covars])
+	subset = None
+	if opts.subset:
+		subset = np.isfinite(np.genfromtxt(str(opts.subset[0]), delimiter=','))
+		if len(subset) != nsubjects:
+			print("Error: the subset file has %d rows, but the data has %d subjects." % (len(subset), nsubjects))
+			quit()
+	elif X.shape[0] != nsubjects:
+		print("Error: the predictor(s) have %d rows, but the data has %d subjects." % (X.shape[0], nsubjects))
+		quit()
+	num_contrasts = X.shape[1] - 1
+
+	if opts.analysisname:
+		outname = opts.analysisname[0]
+	else:
+		outname = opts.tmifile[0][:-4]
+
+	# make output folder
+	if not os.path.exists("output_%s" % (outname)):
+		os.mkdir("output_%s" % (outname))
+	os.chdir("output_%s" % (outname))
+	if not outname.endswith('tmi'):
+		outname += '.tmi'
+	outname = 'stats_' + outname
+
+	if opts.randomise:
+		randTime=int(time())
+		if opts.seed:
+			perm_seed = int(opts.seed[0])
+		else:
+			perm_seed = int(float(str(time())[-6:])*100)
+		if not os.path.exists("output_%s" % (outname)):
+			os.mkdir("output_%s" % (outname))
+		os.chdir("output_%s" % (outname))
+
+		# the permutations are evaluated in batches, and the data is read once per batch. At most, half of the
+		# memory budget is used for the t-values of the batch.
+		perm_range = list(range(opts.randomise[0],(opts.randomise[1]+1)))
+		batchsize = max(1, int((memory_budget * 1024**2 / 2) // (num_contrasts * nvertices * 4)))
+		for b in range(0, len(perm_range), batchsize):
+			perm_batch = perm_range[b:b + batchsize]
+			designs = []
+			for perm_number in perm_batch:
+				np.random.seed(perm_number + perm_seed)
+				designs.append(X[np.random.permutation(list(range(X.shape[0])))])
+			tvals = out_of_core_tvals(read_block, nvertices, designs,
+				x_covars = x_covars,
+				subset = subset,
+				memory_budget = memory_budget)
+			for i, perm_number in enumerate(perm_batch):
+				tfce_tvals, neg_tfce_tvals = tfce_from_tvals(tvals[i], calcTFCE, vdensity, position_array, fullmask)
+				for tstat_counter in range(num_contrasts):
+					for surf_count in range(len(masking_array)):
+						start = position_array[surf_count]
+						end = position_array[surf_count+1]
+						with open("perm_maxTFCE_surf%d_tcon%d.csv" % (surf_count, tstat_counter+1), "a") as permfile:
+							permfile.write("%f\n" % np.nanmax(tfce_tvals[tstat_counter,start:end]))
+							permfile.write("%f\n" % np.nanmax(neg_tfce_tvals[tstat_counter,start:end]))
+			print("Permutations %d -> %d took %i seconds." % (perm_batch[0], perm_batch[-1], (int(time()) - randTime)))
+			tvals = None
+		print(("Total time took %.1f seconds" % (time() - currentTime)))
+		print(("Randomization took %.1f seconds" % (time() - randTime)))
+	else:
+		if opts.statsstore:
+			stats = None
+			if os.path.exists(statsstore):
+				stats = load_glm_statistics(statsstore)
+			n_old = 0 if stats is None else stats['design'].shape[0]
+			stats = update_glm_statistics(stats, read_block, nvertices, design, memory_budget = memory_budget)
+			save_glm_statistics(statsstore, stats)
+			print("Sufficient statistics updated with %d new subject(s) (%d in total)" % (nsubjects - n_old, nsubjects))
+			tvals = glm_statistics_tvals(stats, num_contrasts)
+		else:
+			tvals = out_of_core_tvals(read_block, nvertices, [X],
+				x_covars = x_covars,
+				subset = subset,
+				memory_budget = memory_budget)[0]
+		tfce_tvals, neg_tfce_tvals = tfce_from_tvals(tvals, calcTFCE, vdensity, position_array, fullmask)
+		for tstat_counter in range(num_contrasts):
+			for surf_count in range(len(masking_array)):
+				start = position_array[surf_count]
+				end = position_array[surf_count+1]
+				print("Maximum (untransformed) postive tfce value for surface %s, tcon %d: %f" % (surf_count,tstat_counter+1,np.nanmax(tfce_tvals[tstat_counter,start:end])))
+				print("Maximum (untransformed) negative tfce value for surface %s, tcon %d: %f" % (surf_count,tstat_counter+1,np.nanmax(neg_tfce_tvals[tstat_counter,start:end])))
+
+		outdata, contrast_names = tstat_columns(tvals, tfce_tvals, neg_tfce_tvals)
+
+		# write tstat
+		write_stats_tmi(outname, outdata, contrast_names, masking_array, maskname, affine_array, vertex_array, face_array, surfname)
+		print(("Total time took %.1f seconds" % (time() - currentTime)))
+
+if __name__ == "__main__":
+	parser = getArgumentParser()
+	opts = parser.parse_args()
+	run(opts)
@@ -155,9 +155,7 @@ def run(opts):
 	else:
 		for i in range(len(masking_array)):
 			if not opts.noweight:
-				temp_vdensity = np.zeros((adjacency_array[adjacent_range[i]].shape[0]))
-				for j in range(adjacency_array[adjacent_range[i]].shape[0]):
-					temp_vdensity[j] = len(adjacency_array[adjacent_range[i]][j])
+				temp_vdensity = adjacency_array[adjacent_range[i]].degree().astype(np.float64)
 				if masking_array[i].shape[2] == 1:
 					temp_vdensity = temp_vdensity[masking_array[i][:,0,0]==True]
 			else:
@@ -175,7 +173,8 @@ def run(opts):
 			np.save("%s/%s_mask_temp.npy" % (temp_directory, i), outmask)
 			temp_vdensity = None
 		for num, j in enumerate(adjacent_range):
-			np.save("%s/%s_adjacency_temp.npy" % (temp_directory, num), np.copy(adjacency_array[j]))
+			np.save("%s/%s_adjacency_indptr_temp.npy" % (temp_directory, num), adjacency_array[j].indptr)
+			np.save("%s/%s_adjacency_indices_temp.npy" % (temp_directory, num), adjacency_array[j].indices)
 		if opts.covariates:
 			covars = np.genfromtxt(opts.covariates[0], delimiter=',')
 			x_covars = np.column_stack([np.ones(len(covars)),covars])
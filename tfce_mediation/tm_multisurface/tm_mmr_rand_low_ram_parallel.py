@@ -24,12 +24,18 @@ from time import time
 
 from tfce_mediation.cynumstats import resid_covars
 from tfce_mediation.tfce import CreateAdjSet
-from tfce_mediation.tm_io import read_tm_filetype, write_tm_filetype, savemgh_v2, savenifti_v2
-from tfce_mediation.pyfunc import save_ply, convert_voxel, vectorized_surface_smooth
+from tfce_mediation.tm_io import read_tm_filetype, write_tm_filetype, savemgh_v2, savenifti_v2, CSRAdjacency
+from tfce_mediation.pyfunc import save_ply, convert_voxel, vectorized_surface_smooth, mediation_invariants
 from tfce_mediation.tm_func import calculate_tfce, calculate_mediation_tfce, calc_mixed_tfce, apply_mfwer, create_full_mask, merge_adjacency_array, lowest_length, create_position_array, paint_surface, strip_basename, saveauto, low_ram_calculate_tfce, low_ram_calculate_mediation_tfce
 
 DESCRIPTION = "Companion program for mmr-lr"
 
+# memory-map the CSR adjacency written by mmr-lr
+def load_temp_adjacency(surf_num, temp_directory = "tmi_temp"):
+	indptr = np.load("%s/%d_adjacency_indptr_temp.npy" % (temp_directory, surf_num), mmap_mode = 'r')
+	indices = np.load("%s/%d_adjacency_indices_temp.npy" % (temp_directory, surf_num), mmap_mode = 'r')
+	return CSRAdjacency(indptr, indices)
+
 def getArgumentParser(ap = ap.ArgumentParser(description = DESCRIPTION)):
 
 	ap.add_argument("-sn", "--surfacenumber",
@@ -81,7 +87,7 @@ def run(opts):
 
 		for surf_num in range(len(masking_array)):
 			print("Calculating stats for:\t %s" % maskname[surf_num])
-			adjacency = np.load("tmi_temp/%d_adjacency_temp.npy" % surf_num)
+			adjacency = load_temp_adjacency(surf_num)
 			mask = np.load("tmi_temp/%d_mask_temp.npy" % surf_num)
 			data = np.load("tmi_temp/%d_data_temp.npy" % surf_num)
 			vdensity = np.load("tmi_temp/%d_vdensity_temp.npy" % surf_num)
@@ -167,7 +173,7 @@ def run(opts):
 		currentTime=int(time())
 		surf_num = int(opts.surfacenumber[0])
 		p_range = np.array(opts.permutationrange)
-		adjacency = np.load("tmi_temp/%d_adjacency_temp.npy" % surf_num)
+		adjacency = load_temp_adjacency(surf_num)
 		mask = np.load("tmi_temp/%d_mask_temp.npy" % surf_num)
 		data = np.load("tmi_temp/%d_data_temp.npy" % surf_num)
 		vdensity = np.load("tmi_temp/%d_vdensity_temp.npy" % surf_num)
@@ -196,6 +202,7 @@ def run(opts):
 			medtype = sopts.inputmediation[0]
 			pred_x =  np.genfromtxt(sopts.inputmediation[1], delimiter=',')
 			depend_y =  np.genfromtxt(sopts.inputmediation[2], delimiter=',')
+			mediation_model = mediation_invariants(medtype, pred_x, depend_y, data)
 			for perm_number in range(p_range[0],int(p_range[1]+1)):
 				low_ram_calculate_mediation_tfce(medtype, data, mask, pred_x, depend_y, calcTFCE, vdensity,
 					set_surf_count = surf_num,
@@ -203,7 +210,8 @@ def run(opts):
 					randomise = True,
 					no_intercept = True,
 					output_dir = str(opts.path[0]),
-					perm_seed = int(opts.seed[0]))
+					perm_seed = int(opts.seed[0]),
+					mediation_model = mediation_model)
 		print("Mask %d, Iteration %d -> %d took %i seconds." % (surf_num, p_range[0], p_range[1], (int(time()) - currentTime)))
 
 if __name__ == "__main__":
@@ -24,8 +24,8 @@ from time import time
 
 from tfce_mediation.cynumstats import resid_covars
 from tfce_mediation.tfce import CreateAdjSet
-from tfce_mediation.tm_io import read_tm_filetype, write_tm_filetype, savemgh_v2, savenifti_v2
-from tfce_mediation.pyfunc import save_ply, convert_voxel, vectorized_surface_smooth
+from tfce_mediation.tm_io import read_tm_filetype, write_tm_filetype, append_tm_filetype, savemgh_v2, savenifti_v2
+from tfce_mediation.pyfunc import save_ply, convert_voxel, vectorized_surface_smooth, mediation_invariants, bootstrap_indirect_effect
 from tfce_mediation.tm_func import calculate_tfce, calculate_mediation_tfce, calc_mixed_tfce, apply_mfwer, create_full_mask, merge_adjacency_array, lowest_length, create_position_array, paint_surface, strip_basename, saveauto
 
 
@@ -68,6 +68,16 @@ def getArgumentParser(ap = ap.ArgumentParser(description = DESCRIPTION)):
 		nargs=2,
 		type=int,
 		metavar=['INT'])
+	ap.add_argument("-boot", "--bootstrap",
+		help="Must be used with -im option, and cannot be used with -p or a --outtype other than tmi. Calculate bootstrap confidence intervals of the indirect effect (a*b) with INT resamples, which are appended to the stats tmi. e.g., -boot 5000",
+		nargs=1,
+		type=int,
+		metavar=('INT'))
+	ap.add_argument("--cimethod",
+		help="Bootstrap confidence interval method. Bias-corrected and accelerated (bca) or percentile. Default: %(default)s",
+		nargs=1,
+		choices=['bca', 'percentile'],
+		default=['bca'])
 	ap.add_argument("-i_name", "--analysisname",
 		help="Input the *.tmi file for analysis.", 
 		nargs=1)
@@ -137,6 +147,12 @@ def getArgumentParser(ap = ap.ArgumentParser(description = DESCRIPTION)):
 
 def run(opts):
 	currentTime=int(time())
+	if opts.bootstrap and not opts.inputmediation:
+		print("Error: the -boot option must be used with -im option.")
+		quit()
+	if opts.bootstrap and (opts.randomise or opts.outtype[0] != 'tmi'):
+		print("Error: the -boot option cannot be used with -p or a --outtype other than tmi.")
+		quit()
 	if opts.multisurfacefwecorrection:
 		#############################
 		###### FWER CORRECTION ######
@@ -189,29 +205,16 @@ def run(opts):
 
 		# write out files
 		if opts.concatestats:
-			write_tm_filetype(opts.tmifile[0],
-				image_array = positive_data,
-				masking_array = masking_array,
-				maskname = maskname,
-				affine_array = affine_array,
-				vertex_array = vertex_array,
-				face_array = face_array,
-				surfname = surfname,
-				adjacency_array = adjacency_array,
-				checkname = False,
-				tmi_history = tmi_history)
-			_, image_array, masking_array, maskname, affine_array, vertex_array, face_array, surfname, adjacency_array, tmi_history, columnids = read_tm_filetype(opts.tmifile[0], verbose=False)
-			write_tm_filetype(opts.tmifile[0],
-				image_array = np.column_stack((image_array[0],negative_data)),
-				masking_array = masking_array,
-				maskname = maskname,
-				affine_array = affine_array,
-				vertex_array = vertex_array,
-				face_array = face_array,
-				surfname = surfname,
-				adjacency_array = adjacency_array,
-				checkname = False,
-				tmi_history = tmi_history)
+			# the pFWER images are appended in place to the stats file
+			contrast_names = []
+			if len(columnids) > 0:
+				for j in range(num_contrasts):
+					contrast_names.append(("tstat_pFWER_con%d" % (j+1)))
+				for k in range(num_contrasts):
+					contrast_names.append(("negtstat_pFWER_con%d" % (k+1)))
+			append_tm_filetype(opts.tmifile[0],
+				data_columns = np.column_stack((positive_data,negative_data)),
+				columnids = np.array(contrast_names))
 		else:
 			for i in range(len(opts.outtype)):
 				if opts.outtype[i] == 'tmi':
@@ -436,7 +439,7 @@ def run(opts):
 			for i in np.unique(opts.assigntfcesettings):
 				tfce_settings_mask.append((np.array(opts.assigntfcesettings) == int(i)))
 				pointer = int(i*2)
-				adjacency = merge_adjacency_array(np.array(adjacent_range)[tfce_settings_mask[int(i)]], np.array(adjacency_array)[tfce_settings_mask[int(i)]])
+				adjacency = merge_adjacency_array(np.array(adjacent_range)[tfce_settings_mask[int(i)]], adjacency_array)
 				calcTFCE.append((CreateAdjSet(float(opts.tfce[pointer]), float(opts.tfce[pointer+1]), adjacency)))
 				del adjacency
 		else:
@@ -451,9 +454,7 @@ def run(opts):
 			vdensity = []
 			#np.ones_like(masking_array)
 			for i in range(len(masking_array)):
-				temp_vdensity = np.zeros((adjacency_array[adjacent_range[i]].shape[0]))
-				for j in range(adjacency_array[adjacent_range[i]].shape[0]):
-					temp_vdensity[j] = len(adjacency_array[adjacent_range[i]][j])
+				temp_vdensity = adjacency_array[adjacent_range[i]].degree().astype(np.float64)
 				if masking_array[i].shape[2] == 1:
 					temp_vdensity = temp_vdensity[masking_array[i][:,0,0]==True]
 				vdensity = np.hstack((vdensity, np.array((1 - (temp_vdensity/temp_vdensity.max())+(temp_vdensity.mean()/temp_vdensity.max())), dtype=np.float32)))
@@ -535,6 +536,8 @@ def run(opts):
 			if not os.path.exists("output_%s" % (outname)):
 				os.mkdir("output_%s" % (outname))
 			os.chdir("output_%s" % (outname))
+			if opts.inputmediation and not opts.assigntfcesettings:
+				mediation_model = mediation_invariants(medtype, pred_x, depend_y, mapped_y)
 			for i in range(opts.randomise[0],(opts.randomise[1]+1)):
 				if opts.assigntfcesettings:
 					calc_mixed_tfce(opts.assigntfcesettings, 
@@ -557,7 +560,8 @@ def run(opts):
 						position_array,
 						fullmask,
 						perm_number = i,
-						randomise = True)
+						randomise = True,
+						mediation_model = mediation_model)
 				else:
 					calculate_tfce(mapped_y, 
 						masking_array,
@@ -610,6 +614,10 @@ def run(opts):
 					contrast_names.append(("SobelZ"))
 					contrast_names.append(("SobelZ_tfce"))
 					outdata = np.column_stack((SobelZ.T, tfce_SobelZ.T))
+					if opts.bootstrap:
+						indirect, lower, upper = bootstrap_indirect_effect(medtype, pred_x, depend_y, merge_y, nboot = int(opts.bootstrap[0]), ci = opts.cimethod[0])
+						contrast_names.extend(["IndirectEffect", "IndirectEffect_lowerCI", "IndirectEffect_upperCI"])
+						outdata = np.column_stack((outdata, indirect, lower, upper))
 				else:
 					if tvals.ndim == 1:
 						num_contrasts = 1
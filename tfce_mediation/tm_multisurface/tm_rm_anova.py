@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+#    TFCE_mediation TMI multimodality, multisurface repeated measure ANOVA
+#    Copyright (C) 2017  Tristram Lett
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import numpy as np
+import argparse as ap
+from time import time
+
+from tfce_mediation.tm_io import read_tm_filetype
+from tfce_mediation.tm_func import setup_tfce, create_position_array, tfce_from_tvals, write_stats_tmi
+from tfce_mediation.pyfunc import rm_anova_model, rm_anova_fstats, rm_permutations
+
+DESCRIPTION = "rm-anova: repeated measure ANOVA of a *.tmi file with k intervals (timepoints) and an optional between subject factor. The F-statistics of the interval and the factor*interval interaction are TFCE transformed, and family-wise error rate corrected by permutation of the intervals within each subject (max TFCE of all masks)."
+
+def getArgumentParser(ap = ap.ArgumentParser(description = DESCRIPTION)):
+
+	ap.add_argument("-i_tmi", "--tmifile",
+		help="Input the *.tmi file for analysis. The subjects must be ordered by interval, i.e., all subjects of the first interval, then all subjects of the second interval, etc.",
+		nargs=1,
+		metavar=('*.tmi'),
+		required=True)
+	ap.add_argument("-k", "--intervals",
+		help="The number of intervals (timepoints).",
+		nargs=1,
+		type=int,
+		metavar=('INT'),
+		required=True)
+	ap.add_argument("-b", "--betweenfactor",
+		help="Between subject factor (one row per subject).",
+		nargs=1,
+		metavar=('*.csv'))
+	ap.add_argument("-p", "--permutations",
+		help="Number of within-subject permutations for the FWER correction. e.g., -p 5000",
+		nargs=1,
+		type=int,
+		metavar=('INT'))
+	ap.add_argument("-bs", "--blocksize",
+		help="Number of permutations whose F-statistics are computed together (more uses more memory). Default: %(default)s",
+		nargs=1,
+		type=int,
+		default=[16],
+		metavar=('INT'))
+	ap.add_argument("--seed",
+		help="Random seed of the permutations.",
+		nargs=1,
+		type=int,
+		metavar=('INT'))
+	ap.add_argument("-i_name", "--analysisname",
+		help="Name of the output folder and stats tmi. Default is the name of the tmi file.",
+		nargs=1)
+	ap.add_argument("--tfce",
+		help="TFCE settings. H (i.e., height raised to power H), E (i.e., extent raised to power E). Default: %(default)s). H=2, E=2/3.",
+		nargs=2,
+		default=[2.0,0.67],
+		type=float,
+		metavar=('H', 'E'))
+	ap.add_argument("-sa", "--setadjacencyobjs",
+		help="Specify the adjaceny object to use for each mask. The number of inputs must match the number of masks in the tmi file. Note, the objects start at zero. e.g., -sa 0 1 0 1",
+		nargs='+',
+		type=int,
+		metavar=('INT'))
+	ap.add_argument("--noweight",
+		help="Do not weight each vertex for density of vertices within the specified geodesic distance (not recommended).",
+		action="store_true")
+	return ap
+
+def run(opts):
+	currentTime=int(time())
+
+	_, image_array, masking_array, maskname, affine_array, vertex_array, face_array, surfname, adjacency_array, _, _  = read_tm_filetype(opts.tmifile[0], verbose = False)
+	position_array = create_position_array(masking_array)
+	k = int(opts.intervals[0])
+	if image_array[0].shape[1] % k != 0:
+		print("Error: the tmi file has %d subjects, which is not a multiple of %d intervals." % (image_array[0].shape[1], k))
+		quit()
+	ns = image_array[0].shape[1] // k
+
+	between_factor = None
+	if opts.betweenfactor:
+		between_factor = np.genfromtxt(opts.betweenfactor[0], delimiter=',')
+		if len(between_factor) != ns:
+			print("Error: the between subject factor has %d rows, but the data has %d subjects." % (len(between_factor), ns))
+			quit()
+
+	calcTFCE, vdensity, fullmask = setup_tfce(masking_array, adjacency_array, opts.setadjacencyobjs, opts.tfce, opts.noweight)
+	adjacency_array = None
+
+	# (intervals, subjects, vertices)
+	rm_model = rm_anova_model(image_array[0].T.reshape(k, ns, -1), between_factor)
+	image_array = None
+	Ftime, Fint = rm_anova_fstats(rm_model)
+	fstats = [('Ftime', Ftime[0])]
+	if Fint is not None:
+		fstats.append(('Fint', Fint[0]))
+	tfce_fstats = tfce_from_tvals(np.array([fstat for _, fstat in fstats]), calcTFCE, vdensity, position_array, fullmask, negative = False)
+
+	if opts.analysisname:
+		outname = opts.analysisname[0]
+	else:
+		outname = os.path.basename(opts.tmifile[0])
+	# the output folder and the stats tmi are named without the extension
+	if outname.endswith('.tmi'):
+		outname = outname[:-4]
+	if not os.path.exists("output_%s" % (outname)):
+		os.mkdir("output_%s" % (outname))
+
+	if opts.permutations:
+		randTime=int(time())
+		num_perm = int(opts.permutations[0])
+		seed = int(opts.seed[0]) if opts.seed else None
+		permutations = rm_permutations(ns, k, num_perm, seed = seed)
+		max_tfce = np.zeros((len(fstats), num_perm))
+		blocksize = int(opts.blocksize[0])
+		for block_start in range(0, num_perm, blocksize):
+			perm_fstats = rm_anova_fstats(rm_model, permutations[block_start:block_start+blocksize], blocksize = blocksize)
+			perm_fstats = [fstat for fstat in perm_fstats if fstat is not None]
+			for i in range(perm_fstats[0].shape[0]):
+				perm_tfce = tfce_from_tvals(np.array([fstat[i] for fstat in perm_fstats]), calcTFCE, vdensity, position_array, fullmask, negative = False)
+				max_tfce[:, block_start+i] = perm_tfce.max(1)
+			print("Permutation %d of %d" % (min(block_start+blocksize, num_perm), num_perm))
+		print("Randomization took %.1f seconds" % (time() - randTime))
+
+	outdata = []
+	contrast_names = []
+	for i, (name, fstat) in enumerate(fstats):
+		outdata.extend([fstat, tfce_fstats[i]])
+		contrast_names.extend([name, "%s_tfce" % name])
+		if opts.permutations:
+			np.savetxt("output_%s/perm_maxTFCE_%s.csv" % (outname, name), max_tfce[i], fmt = "%f")
+			# 1 - p(FWER), i.e., the proportion of permuted max TFCE values below each TFCE value
+			sorted_max = np.sort(max_tfce[i])
+			outdata.append((np.searchsorted(sorted_max, tfce_fstats[i], side = 'left') / num_perm).astype(np.float32))
+			contrast_names.append("%s_tfce_pFWER" % name)
+
+	if 'Fbetween' in rm_model:
+		# the between subject factor does not change with within-subject permutations
+		Fbetween = rm_model['Fbetween'].astype(np.float32)
+		outdata.extend([Fbetween, tfce_from_tvals(Fbetween[np.newaxis], calcTFCE, vdensity, position_array, fullmask, negative = False)[0]])
+		contrast_names.extend(["Fbetween", "Fbetween_tfce"])
+
+	outname = "output_%s/rm_stats_%s.tmi" % (outname, outname)
+	print("Writing %s" % outname)
+	write_stats_tmi(outname, np.column_stack(outdata), contrast_names, masking_array, maskname, affine_array, vertex_array, face_array, surfname)
+	print(("Total time took %.1f seconds" % (time() - currentTime)))
+
+if __name__ == "__main__":
+	parser = getArgumentParser()
+	opts = parser.parse_args()
+	run(opts)
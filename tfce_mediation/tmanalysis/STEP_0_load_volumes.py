@@ -21,7 +21,7 @@ import numpy as np
 import nibabel as nib
 import argparse
 
-from tfce_mediation.pyfunc import import_voxel_neuroimage
+from tfce_mediation.pyfunc import import_voxel_neuroimage, import_voxel_neuroimages, MaskedImageCache
 
 
 DESCRIPTION = "Initial step to load in a 4D NifTi or MINC volumetric image, and its corresponding mask (binary image)."
@@ -45,6 +45,22 @@ def getArgumentParser(parser = argparse.ArgumentParser(description = DESCRIPTION
 		nargs=1, 
 		help="Must be used with --files or --filelist. USAGE: -m {Mask}", 
 		metavar=('*.nii.gz or *.mnc'))
+	parser.add_argument("-nt", "--numthreads", 
+		nargs=1, 
+		type=int, 
+		help="Number of images that are read concurrently. (default: %(default)s)", 
+		metavar=('INT'), 
+		default=[1])
+	parser.add_argument("--cachedir", 
+		nargs=1, 
+		help="Optional. Cache the masked images in a directory, so that re-runs with the same images and mask skip reading them. USAGE: --cachedir {directory}", 
+		metavar=('DIR'))
+	parser.add_argument("--cachesize", 
+		nargs=1, 
+		type=float, 
+		help="Maximum size of the cache in GB. The least recently used images are removed. (default: %(default)s)", 
+		metavar=('GB'), 
+		default=[10.0])
 	return parser
 
 def run(opts):
@@ -57,22 +73,25 @@ def run(opts):
 		quit()
 	img_mask = import_voxel_neuroimage(mask_name)
 	data_mask = img_mask.get_data()
-	affine_mask = img_mask.get_affine()
-	header_mask = img_mask.get_header()
+	affine_mask = img_mask.affine
+	header_mask = img_mask.header
 	mask_index = data_mask > 0.99
 
 	if opts.files:
-		nonzero_data = []
-		for image_path in opts.files:
-			nonzero_data.append(import_voxel_neuroimage(image_path, mask_index))
-		nonzero_data = np.array(nonzero_data).T
+		image_paths = opts.files
 	elif opts.filelist:
-		nonzero_data = []
-		for image_path in np.genfromtxt(opts.filelist[0], delimiter=',', dtype=None):
-			nonzero_data.append(import_voxel_neuroimage(image_path, mask_index))
-		nonzero_data = np.array(nonzero_data).T
+		image_paths = [str(image_path) for image_path in np.atleast_1d(np.genfromtxt(opts.filelist[0], delimiter=',', dtype=str))]
 	else:
-		nonzero_data = import_voxel_neuroimage(opts.input[0], mask_index)
+		image_paths = [opts.input[0]]
+
+	if not os.path.exists('python_temp'):
+		os.mkdir('python_temp')
+
+	# the masked voxels are written directly to python_temp/raw_nonzero.npy
+	cache = None
+	if opts.cachedir:
+		cache = MaskedImageCache(opts.cachedir[0], max_bytes = opts.cachesize[0] * 1024**3)
+	nonzero_data = import_voxel_neuroimages(image_paths, mask_index, nthreads = opts.numthreads[0], outname = 'python_temp/raw_nonzero.npy', cache = cache)
 
 	# check mask
 	mean = np.mean(nonzero_data, axis=1)
@@ -80,14 +99,13 @@ def run(opts):
 		print("Warning: the mask contains data that is all zeros in the 4D image. Creating a new mask:\t new_%s"% mask_name)
 		new_mask = np.zeros_like(mean)
 		new_mask[mean!=0] = 1
-		data_mask[data_mask!=0] = new_mask[:]
+		data_mask[mask_index] = new_mask[:]
 		nib.save(nib.Nifti1Image(data_mask.astype(np.float32),affine=img_mask.affine), 'new_%s' % mask_name)
-		nonzero_data = data_all[data_mask>0.99]
-
-	if not os.path.exists('python_temp'):
-		os.mkdir('python_temp')
+		nonzero_data = np.array(nonzero_data[mean!=0])
+		np.save('python_temp/raw_nonzero',nonzero_data.astype(np.float32, order = "C"))
+	else:
+		nonzero_data.flush()
 
-	np.save('python_temp/raw_nonzero',nonzero_data.astype(np.float32, order = "C"))
 	np.save('python_temp/header_mask',header_mask)
 	np.save('python_temp/affine_mask',affine_mask)
 	np.save('python_temp/data_mask',data_mask)
@@ -47,7 +47,7 @@ def getArgumentParser(parser = argparse.ArgumentParser(description = DESCRIPTION
 		nargs=2,
 		type=str,
 		help="""
-		Optional. Use geodesic FHWM smoothing at midthickness surface (no fudge factor). The distances lists must be specifity for the left and right hemispheres, respectively. The default FWHM is 3mm, but other distances can be specified using -f option. Important, this requires creation of distance lists for earh hemisphere using /tfce_mediation/misc_scripts/fwhm_compute_distances_parallel.py or downloading them from the midthickness surface from tm_addons (github.com/trislett/tm_addons). Please note that smoothing for each surface image with geodesicFWHM takes around 5 minutes per subject and uses around 2GB of RAM for the 9mm distance lists. e.g., -g $TM_ADDONS/geodesicFWHM/lh_9.0mm_fwhm_distances.npy $TM_ADDONS/geodesicFWHM/rh_9.0mm_fwhm_distances.npy.
+		Optional. Use geodesic FHWM smoothing at midthickness surface (no fudge factor). The distances lists must be specifity for the left and right hemispheres, respectively. The default FWHM is 3mm, but other distances can be specified using -f option. Important, this requires creation of distance lists for earh hemisphere using /tfce_mediation/misc_scripts/fwhm_compute_distances_parallel.py or downloading them from the midthickness surface from tm_addons (github.com/trislett/tm_addons). The geodesic smoothing kernel is built once for each hemisphere and FWHM, and applied to all subjects at once (the number of threads is set by -p). e.g., -g $TM_ADDONS/geodesicFWHM/lh_9.0mm_fwhm_distances.npy $TM_ADDONS/geodesicFWHM/rh_9.0mm_fwhm_distances.npy.
 		""", 
 		metavar=('STRING'))
 	parser.add_argument("-k", "--noclean", 
@@ -88,23 +88,7 @@ def run(opts):
 	os.chdir('%s/' % tempdir)
 
 
-	if opts.usegeodesicfwhm:
-		fwhm = [3.0]
-		if opts.fwhm:
-			fwhm = opts.fwhm
-		for j in fwhm:
-			print("Performing geodesic smoothing with FWHM = %smm." % j)
-			os.system("""
-					for i in lh*.mgh; do
-						temp_outname=$(basename ${i} .00.mgh).0%dB.mgh
-						echo tm_tools geodesic-fwhm --hemi lh -i ${i} -o ${temp_outname} -d %s -f %s
-					done >> %s""" % (int(float(j)), opts.usegeodesicfwhm[0],j,cmd_smooth) )
-			os.system("""
-					for i in rh*.mgh; do
-						temp_outname=$(basename ${i} .00.mgh).0%dB.mgh
-						echo tm_tools geodesic-fwhm --hemi rh -i ${i} -o ${temp_outname} -d %s -f %s
-					done >> %s""" % (int(float(j)),opts.usegeodesicfwhm[1],j,cmd_smooth) )
-	else:
+	if not opts.usegeodesicfwhm:
 		print("Performing smoothing with FWHM = 3.0mm ")
 		os.system("""
 			for hemi in lh rh; do
@@ -113,25 +97,32 @@ def run(opts):
 					echo $FREESURFER_HOME/bin/mri_surf2surf --hemi ${hemi} --s fsaverage --sval ${i} --tval ${temp_outname} --fwhm-trg 3 --noreshape --cortex 
 				done >> %s
 			done""" % (cmd_smooth) )
-	if opts.parallel:
-		os.system("cat %s | parallel -j %d;" % (cmd_smooth, numcore))
-	else:
-		os.system("while read -r i; do eval $i; done < %s" % (cmd_smooth) )
+		if opts.parallel:
+			os.system("cat %s | parallel -j %d;" % (cmd_smooth, numcore))
+		else:
+			os.system("while read -r i; do eval $i; done < %s" % (cmd_smooth) )
 	os.chdir('../')
 	print("Merging surface images")
 	merge_surfaces(tempdir,'lh','00',subjects,surface)
 	merge_surfaces(tempdir,'rh','00',subjects,surface)
 
-	if opts.usegeodesicfwhm and opts.fwhm:
+	if opts.usegeodesicfwhm:
+		# the smoothing kernel is built once and applied to all subjects
+		fwhm = [3.0]
+		if opts.fwhm:
+			fwhm = opts.fwhm
+		numthreads = 1
+		if opts.parallel:
+			numthreads = numcore
 		for j in fwhm:
-			fwhm_name = '0%dB' % int(j)
-			merge_surfaces(tempdir,'lh',fwhm_name,subjects,surface)
-			merge_surfaces(tempdir,'rh',fwhm_name,subjects,surface)
+			print("Performing geodesic smoothing with FWHM = %smm." % j)
+			for hemi, distanceslist in zip(['lh', 'rh'], opts.usegeodesicfwhm):
+				os.system("tm_tools geodesic-fwhm --hemi %s -i %s.all.%s.00.mgh -o %s.all.%s.0%dB.mgh -d %s -f %s -nt %d" % (hemi, hemi, surface, hemi, surface, int(float(j)), distanceslist, j, numthreads))
 	else:
 		merge_surfaces(tempdir,'lh','03B',subjects,surface)
 		merge_surfaces(tempdir,'rh','03B',subjects,surface)
 
-	if opts.fwhm:
+	if opts.fwhm and not opts.usegeodesicfwhm:
 		for i in range(len(opts.fwhm)):
 			os.system("""
 			$FREESURFER_HOME/bin/mri_surf2surf --hemi lh --s fsaverage --sval lh.all.%s.00.mgh --fwhm %d --cortex --tval lh.all.%s.0%dB.mgh
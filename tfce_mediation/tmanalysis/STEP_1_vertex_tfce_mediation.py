@@ -24,7 +24,7 @@ import argparse as ap
 
 from tfce_mediation.cynumstats import resid_covars
 from tfce_mediation.tfce import CreateAdjSet
-from tfce_mediation.pyfunc import write_vertStat_img, create_adjac_vertex, calc_sobelz, convert_fslabel
+from tfce_mediation.pyfunc import write_vertStat_img, create_adjac_vertex, calc_sobelz, convert_fslabel, bootstrap_indirect_effect
 
 DESCRIPTION = "Vertex-wise mediation with TFCE."
 
@@ -100,6 +100,16 @@ def getArgumentParser(ap = ap.ArgumentParser(description = DESCRIPTION)):
 	ap.add_argument("--noweight", 
 		help="Do not weight each vertex for density of vertices within the specified geodesic distance.", 
 		action="store_true")
+	ap.add_argument("-boot", "--bootstrap", 
+		nargs=1, 
+		type=int, 
+		help="Calculate bootstrap confidence intervals of the indirect effect (a*b) with INT resamples (e.g., -boot 5000).", 
+		metavar=('INT'))
+	ap.add_argument("--cimethod", 
+		nargs=1, 
+		choices=['bca', 'percentile'], 
+		default=['bca'], 
+		help="Bootstrap confidence interval method. Bias-corrected and accelerated (bca) or percentile. Default: %(default)s")
 
 	return ap
 
@@ -287,6 +297,13 @@ def run(opts):
 	write_vertStat_img('SobelZ_%s' % (medtype),SobelZ[:num_vertex_lh],outdata_mask_lh, affine_mask_lh, surface, 'lh', bin_mask_lh, calcTFCE_lh, bin_mask_lh.shape[0], vdensity_lh)
 	write_vertStat_img('SobelZ_%s' % (medtype),SobelZ[num_vertex_lh:],outdata_mask_rh, affine_mask_rh, surface, 'rh', bin_mask_rh, calcTFCE_rh, bin_mask_rh.shape[0], vdensity_rh)
 
+	#bootstrap confidence intervals of the indirect effect
+	if opts.bootstrap:
+		indirect, lower, upper = bootstrap_indirect_effect(medtype, pred_x, depend_y, merge_y, nboot = int(opts.bootstrap[0]), ci = opts.cimethod[0])
+		for statname, stat in [('IndirectEffect_%s' % medtype, indirect), ('IndirectEffect_lowerCI_%s' % medtype, lower), ('IndirectEffect_upperCI_%s' % medtype, upper)]:
+			write_vertStat_img(statname, stat[:num_vertex_lh], outdata_mask_lh, affine_mask_lh, surface, 'lh', bin_mask_lh, calcTFCE_lh, bin_mask_lh.shape[0], TFCE = False)
+			write_vertStat_img(statname, stat[num_vertex_lh:], outdata_mask_rh, affine_mask_rh, surface, 'rh', bin_mask_rh, calcTFCE_rh, bin_mask_rh.shape[0], TFCE = False)
+
 if __name__ == "__main__":
 	parser = getArgumentParser()
 	opts = parser.parse_args()
@@ -23,7 +23,9 @@ import numpy as np
 
 from tfce_mediation.cynumstats import resid_covars
 from tfce_mediation.tfce import CreateAdjSet
-from tfce_mediation.pyfunc import write_voxelStat_img, create_adjac_voxel, calc_sobelz
+from tfce_mediation.pyfunc import write_voxelStat_img, calc_sobelz, bootstrap_indirect_effect
+from tfce_mediation.tm_func import create_voxel_adjacency
+from tfce_mediation.tm_io import save_adjacency
 
 DESCRIPTION = "Voxel-wise mediation with TFCE"
 
@@ -46,7 +48,17 @@ def getArgumentParser(ap = ap.ArgumentParser(description = DESCRIPTION)):
 		help="H E Connectivity. Default is 2 1 26.", 
 		nargs = 3, 
 		default = [2, 1, 26], 
-		metavar = ('H', 'E', '[6 or 26]'))
+		metavar = ('H', 'E', '[6, 18 or 26]'))
+	ap.add_argument("-boot", "--bootstrap", 
+		nargs = 1, 
+		type = int, 
+		help = "Calculate bootstrap confidence intervals of the indirect effect (a*b) with INT resamples (e.g., -boot 5000).", 
+		metavar = ('INT'))
+	ap.add_argument("--cimethod", 
+		nargs = 1, 
+		choices = ['bca', 'percentile'], 
+		default = ['bca'], 
+		help = "Bootstrap confidence interval method. Bias-corrected and accelerated (bca) or percentile. Default: %(default)s")
 	return ap
 
 def run(opts):
@@ -74,7 +86,7 @@ def run(opts):
 #		imgext = np.load('python_temp/imgext.npy')
 
 	#TFCE
-	adjac = create_adjac_voxel(data_index,data_mask,num_voxel,dirtype=opts.tfce[2])
+	adjac = create_voxel_adjacency(data_index, connectivity = opts.tfce[2])
 	calcTFCE = CreateAdjSet(float(opts.tfce[0]), float(opts.tfce[1]), adjac) # i.e. default: H=2, E=2, 26 neighbour connectivity
 
 	#step1
@@ -89,7 +101,7 @@ def run(opts):
 	#save
 	np.save('python_temp/pred_x',pred_x)
 	np.save('python_temp/depend_y',depend_y)
-	np.save('python_temp/adjac',adjac)
+	save_adjacency('python_temp/adjac.npz',adjac)
 	np.save('python_temp/medtype',medtype)
 	np.save('python_temp/optstfce', opts.tfce)
 	np.save('python_temp/raw_nonzero_corr',y.T.astype(np.float32, order = "C"))
@@ -103,6 +115,13 @@ def run(opts):
 	os.chdir("output_med_%s" % medtype)
 	write_voxelStat_img('SobelZ_%s' % medtype, SobelZ, data_mask, data_index, affine_mask, calcTFCE, imgext)
 
+	#bootstrap confidence intervals of the indirect effect
+	if opts.bootstrap:
+		indirect, lower, upper = bootstrap_indirect_effect(medtype, pred_x, depend_y, y, nboot = int(opts.bootstrap[0]), ci = opts.cimethod[0])
+		write_voxelStat_img('IndirectEffect_%s' % medtype, indirect, data_mask, data_index, affine_mask, calcTFCE, imgext, TFCE = False)
+		write_voxelStat_img('IndirectEffect_lowerCI_%s' % medtype, lower, data_mask, data_index, affine_mask, calcTFCE, imgext, TFCE = False)
+		write_voxelStat_img('IndirectEffect_upperCI_%s' % medtype, upper, data_mask, data_index, affine_mask, calcTFCE, imgext, TFCE = False)
+
 if __name__ == "__main__":
 	parser = getArgumentParser()
 	opts = parser.parse_args()
@@ -25,7 +25,9 @@ import argparse as ap
 
 from tfce_mediation.cynumstats import resid_covars, tval_int, calcF
 from tfce_mediation.tfce import CreateAdjSet
-from tfce_mediation.pyfunc import write_voxelStat_img, create_adjac_voxel, image_regression, image_reg_VIF
+from tfce_mediation.pyfunc import write_voxelStat_img, image_regression, image_reg_VIF
+from tfce_mediation.tm_func import create_voxel_adjacency
+from tfce_mediation.tm_io import save_adjacency
 
 DESCRIPTION = "Voxel-wise multiple regression with TFCE. "
 
@@ -51,10 +53,10 @@ def getArgumentParser(ap = ap.ArgumentParser(description = DESCRIPTION)):
 				""", 
 		action="store_true")
 	ap.add_argument("-t", "--tfce", 
-		help="TFCE settings. H (i.e., height raised to power H), E (i.e., extent raised to power E), Connectivity (either 26 or 6 directions). Default: %(default)s).", 
+		help="TFCE settings. H (i.e., height raised to power H), E (i.e., extent raised to power E), Connectivity (26, 18 or 6 directions). Default: %(default)s).", 
 		nargs=3, 
 		default=[2,1,26], 
-		metavar=('H', 'E', '[6 or 26]'))
+		metavar=('H', 'E', '[6, 18 or 26]'))
 	ap.add_argument("-v", "--voxelregressor", 
 		nargs=1,
 		help="Add a voxel-wise independent regressor (beta feature). A variance inflation factor (VIF) image will also be produced to check for multicollinearity (generally, VIF > 5 suggest problematic collinearity.)", 
@@ -105,11 +107,11 @@ def run(opts):
 		ancova=1
 
 	#TFCE
-	adjac = create_adjac_voxel(data_index,data_mask,num_voxel,dirtype=opts.tfce[2])
+	adjac = create_voxel_adjacency(data_index, connectivity = opts.tfce[2])
 	calcTFCE = CreateAdjSet(float(opts.tfce[0]), float(opts.tfce[1]), adjac) # H=2, E=2, 26 neighbour connectivity
 
 	#save
-	np.save('python_temp/adjac',adjac)
+	save_adjacency('python_temp/adjac.npz',adjac)
 	np.save('python_temp/pred_x',pred_x)
 	np.save('python_temp/ancova', ancova)
 	np.save('python_temp/optstfce', opts.tfce)
@@ -22,7 +22,7 @@ from time import time
 import argparse as ap
 
 from tfce_mediation.tfce import CreateAdjSet
-from tfce_mediation.pyfunc import write_perm_maxTFCE_vertex, calc_sobelz
+from tfce_mediation.pyfunc import write_perm_maxTFCE_vertex, mediation_invariants, calc_sobelz_permutations
 
 DESCRIPTION = "Permutation testing for vetex-wise mediation with TFCE"
 start_time = time()
@@ -43,6 +43,12 @@ def getArgumentParser(ap = ap.ArgumentParser(description=DESCRIPTION)):
 		nargs=1, help="mediation type [M or Y or I].", 
 		choices=['M', 'Y', 'I'], 
 		required=True)
+	ap.add_argument("-bs", "--blocksize", 
+		nargs=1, 
+		type=int, 
+		default=[16], 
+		help="Number of permutations whose Sobel Z values are computed together (more uses more memory). Default: %(default)s", 
+		metavar=('INT'))
 	return ap
 
 def run(opts):
@@ -53,7 +59,6 @@ def run(opts):
 
 	#load variables
 	y = np.load("python_temp_med_%s/merge_y.npy" % (surface))
-	num_vertex = np.load("python_temp_med_%s/num_vertex.npy" % (surface))
 	num_vertex_lh = np.load("python_temp_med_%s/num_vertex_lh.npy" % (surface))
 	bin_mask_lh = np.load("python_temp_med_%s/bin_mask_lh.npy" % (surface))
 	bin_mask_rh = np.load("python_temp_med_%s/bin_mask_rh.npy" % (surface))
@@ -76,19 +81,18 @@ def run(opts):
 		os.mkdir("output_med_%s/perm_SobelZ_%s" % (surface,medtype))
 	os.chdir("output_med_%s/perm_SobelZ_%s" % (surface,medtype)) 
 
+	# the permutations are drawn first, and the Sobel Z of each block of permutations is computed together
+	mediation_model = mediation_invariants(medtype, pred_x, depend_y, y)
+	permutations = []
 	for iter_perm in range(arg_perm_start,arg_perm_stop):
 		np.random.seed(int(iter_perm*1000+time()))
-		print("Iteration number : %d" % (iter_perm))
-		indices_perm = np.random.permutation(list(range(n)))
-		if (medtype == 'M') or (medtype == 'I'):
-			pathA_nx = pred_x[indices_perm]
-			pathB_nx = depend_y
-			SobelZ = calc_sobelz(medtype, pathA_nx, pathB_nx, y, n, num_vertex)
-		else:
-			pathA_nx = pred_x[indices_perm]
-			pathB_nx = depend_y[indices_perm]
-			SobelZ = calc_sobelz(medtype, pathA_nx, pathB_nx, y, n, num_vertex)
-		write_perm_maxTFCE_vertex("Zstat_%s" % medtype, SobelZ, num_vertex_lh, bin_mask_lh, bin_mask_rh, calcTFCE_lh, calcTFCE_rh, vdensity_lh, vdensity_rh)
+		permutations.append(np.random.permutation(list(range(n))))
+	blocksize = int(opts.blocksize[0])
+	for block_start in range(0, len(permutations), blocksize):
+		SobelZ = calc_sobelz_permutations(mediation_model, permutations[block_start:block_start+blocksize], blocksize = blocksize)
+		for i in range(len(SobelZ)):
+			print("Iteration number : %d" % (arg_perm_start + block_start + i))
+			write_perm_maxTFCE_vertex("Zstat_%s" % medtype, SobelZ[i], num_vertex_lh, bin_mask_lh, bin_mask_rh, calcTFCE_lh, calcTFCE_rh, vdensity_lh, vdensity_rh)
 	print(("Finished. Randomization took %.1f seconds" % (time() - start_time)))
 
 if __name__ == "__main__":
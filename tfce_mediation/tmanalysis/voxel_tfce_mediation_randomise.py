@@ -22,7 +22,8 @@ import argparse as ap
 from time import time
 
 from tfce_mediation.tfce import CreateAdjSet
-from tfce_mediation.pyfunc import write_perm_maxTFCE_voxel, calc_sobelz
+from tfce_mediation.pyfunc import write_perm_maxTFCE_voxel, mediation_invariants, calc_sobelz_permutations
+from tfce_mediation.tm_io import load_adjacency
 
 DESCRIPTION = "Permutation testing for voxel-wise mediation with TFCE"
 start_time = time()
@@ -37,6 +38,12 @@ def getArgumentParser(ap = ap.ArgumentParser(description=DESCRIPTION)):
 		help="mediation type [M or Y or I].", 
 		choices=['M', 'Y', 'I'], 
 		required=True)
+	ap.add_argument("-bs", "--blocksize", 
+		nargs=1, 
+		type=int, 
+		default=[16], 
+		help="Number of permutations whose Sobel Z values are computed together (more uses more memory). Default: %(default)s", 
+		metavar=('INT'))
 	return ap
 
 def run(opts):
@@ -45,12 +52,11 @@ def run(opts):
 	medtype = str(opts.medtype[0])
 
 	#load variables
-	num_voxel = np.load('python_temp/num_voxel.npy')
 	n = np.load('python_temp/num_subjects.npy')
 	ny = np.load('python_temp/raw_nonzero_corr.npy').T
 	pred_x = np.load('python_temp/pred_x.npy')
 	depend_y = np.load("python_temp/depend_y.npy")
-	adjac = np.load('python_temp/adjac.npy')
+	adjac = load_adjacency('python_temp/adjac.npz')
 	optstfce = np.load('python_temp/optstfce.npy')
 
 	#load TFCE fucntion
@@ -61,19 +67,18 @@ def run(opts):
 		os.mkdir("output_med_%s/perm_SobelZ" % medtype)
 	os.chdir("output_med_%s/perm_SobelZ" % medtype)
 
+	# the permutations are drawn first, and the Sobel Z of each block of permutations is computed together
+	mediation_model = mediation_invariants(medtype, pred_x, depend_y, ny)
+	permutations = []
 	for iter_perm in range(arg_perm_start,arg_perm_stop):
 		np.random.seed(int(iter_perm*1000+time()))
-		print("Iteration number : %d" % (iter_perm))
-		indices_perm = np.random.permutation(list(range(n)))
-		if (medtype == 'M') or (medtype == 'I'):
-			pathA_nx = pred_x[indices_perm]
-			pathB_nx = depend_y
-			SobelZ = calc_sobelz(medtype, pathA_nx, pathB_nx, ny, n, num_voxel)
-		else:
-			pathA_nx = pred_x[indices_perm]
-			pathB_nx = depend_y[indices_perm]
-			SobelZ = calc_sobelz(medtype, pathA_nx, pathB_nx, ny, n, num_voxel)
-		write_perm_maxTFCE_voxel('Zstat_%s' % medtype, SobelZ, calcTFCE)
+		permutations.append(np.random.permutation(list(range(n))))
+	blocksize = int(opts.blocksize[0])
+	for block_start in range(0, len(permutations), blocksize):
+		SobelZ = calc_sobelz_permutations(mediation_model, permutations[block_start:block_start+blocksize], blocksize = blocksize)
+		for i in range(len(SobelZ)):
+			print("Iteration number : %d" % (arg_perm_start + block_start + i))
+			write_perm_maxTFCE_voxel('Zstat_%s' % medtype, SobelZ[i], calcTFCE)
 	print(("Finished. Randomization took %.1f seconds" % (time() - start_time)))
 
 if __name__ == "__main__":
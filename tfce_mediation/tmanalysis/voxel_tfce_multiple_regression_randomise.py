@@ -25,6 +25,7 @@ from time import time
 from tfce_mediation.cynumstats import tval_int, calcF
 from tfce_mediation.tfce import CreateAdjSet
 from tfce_mediation.pyfunc import write_perm_maxTFCE_voxel
+from tfce_mediation.tm_io import load_adjacency
 
 DESCRIPTION = "Permutation testing for voxel-wise multiple regression with TFCE"
 start_time = time()
@@ -54,7 +55,7 @@ def run(opts):
 	n = np.load('python_temp/num_subjects.npy')
 	ny = np.load('python_temp/raw_nonzero_corr.npy').T
 	pred_x = np.load('python_temp/pred_x.npy')
-	adjac = np.load('python_temp/adjac.npy')
+	adjac = load_adjacency('python_temp/adjac.npz')
 	ancova = np.load('python_temp/ancova.npy')
 	optstfce = np.load('python_temp/optstfce.npy')
 
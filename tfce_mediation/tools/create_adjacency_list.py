@@ -20,73 +20,39 @@ import numpy as np
 import nibabel as nib
 import os
 import argparse as ap
-from tfce_mediation.adjacency import compute
+from tfce_mediation.adjacency import compute_csr, geodesic_accuracy_report, print_accuracy_report, GEODESIC_METHODS
+from tfce_mediation.tm_io import GeodesicCache
+from tfce_mediation.tm_mesh import merge_identical_vertices, remove_degenerate_triangles, compute_vertex_normals, project_vertices
 
 DESCRIPTION = "Create adjacency list based on geodesic distance for vertex-based TFCE. Note, 1mm, 2mm, and 3mm adjacency list have already supplied (adjacency_sets/?h_adjacency_dist_?.0_mm.npy)"
 
-def mergeIdenticalVertices(v, f):
-	vr = np.around(v, decimals = 10)
-	vrv = vr.view(v.dtype.descr * v.shape[1])
-	_, idx, inv = np.unique(vrv, return_index = True, return_inverse = True)
-
-	lkp = idx[inv]
-
-	v_ = v[idx, :]
-	f_ = np.asarray([[lkp[f[i, j]] for j in range(f.shape[1])] for i in range(f.shape[0])], dtype = np.int32)
-
-	return v, f_
-
-def removeNonManifoldTriangles(v, f):
-	v_ = v[f]
-	fn = np.cross(v_[:, 1] - v_[:, 0], v_[:, 2] - v_[:,0])
-
-	f_ = f[np.logical_not(np.all(np.isclose(fn, 0), axis = 1)), :]
-
-	return v, f_
-
-def computeNormals(v, f):
-	v_ = v[f]
-
-	fn = np.cross(v_[:, 1] - v_[:, 0], v_[:, 2] - v_[:,0])
-
-	fs = np.sqrt(np.sum((v_[:, [1, 2, 0], :] - v_) ** 2, axis = 2))
-	fs_ = np.sum(fs, axis = 1) / 2 # heron's formula
-	fa = np.sqrt(fs_ * (fs_ - fs[:, 0]) * (fs_ - fs[:, 1]) * (fs_ - fs[:, 2]))[:, None]
-
-	vn = np.zeros_like(v, dtype = np.float32)
-	vn[f[:, 0]] += fn * fa # weight by area
-	vn[f[:, 1]] += fn * fa
-	vn[f[:, 2]] += fn * fa
-
-	vlen = np.sqrt(np.sum(vn ** 2, axis = 1))[np.any(vn != 0, axis = 1), None]
-	vn[np.any(vn != 0, axis = 1), :] /= vlen
-
-	return vn
-
-def projNormFracThick(v, vn, t, projfrac):
-	return v + (vn * t[:, None] * projfrac)
-
-def compute_adjacency(hemi, min_dist, max_dist, projfrac,step_dist):
+def compute_adjacency(hemi, min_dist, max_dist, projfrac,step_dist, method = 'exact', subdivision_level = 2, nreport = 0, cache = None):
 	v, f = nib.freesurfer.read_geometry("%s/fsaverage/surf/%s.white" % ((os.environ["SUBJECTS_DIR"]),hemi))
 	v = v.astype(np.float32, order = "C")
 	f = f.astype(np.int32, order = "C")
 
-	v, f = mergeIdenticalVertices(v, f)
-	v, f = removeNonManifoldTriangles(v, f)
+	v, f = merge_identical_vertices(v, f)
+	v, f = remove_degenerate_triangles(v, f)
 
-	vn = computeNormals(v, f)
+	vn = compute_vertex_normals(v, f)
 
 	t = nib.freesurfer.read_morph_data("%s/fsaverage/surf/%s.thickness" % ((os.environ["SUBJECTS_DIR"]),hemi))
 
-	v_ = projNormFracThick(v, vn, t, projfrac) # project to midthickness
+	v_ = project_vertices(v, vn, t, projfrac) # project to midthickness
 
 	nib.freesurfer.io.write_geometry("%s.midthickness" % hemi, v_, f)
 	
 	thresholds = np.arange(min_dist, max_dist, step=step_dist, dtype = np.float32)
-	adjacency = compute(v_, f, thresholds)
+	if (method != 'exact') and (nreport > 0):
+		print_accuracy_report(geodesic_accuracy_report(v_, f, thresholds.max(), method = method, subdivision_level = subdivision_level, nsources = nreport))
+	adjacency = compute_csr(v_, f, thresholds, method = method, subdivision_level = subdivision_level, cache = cache)
 	count = 0
 	for i in np.arange(min_dist, max_dist, step=step_dist):
-		np.save("%s_adjacency_dist_%.1f_mm" % (hemi,i),adjacency[count])
+		# saved in the format of the supplied adjacency sets (object array of neighbour lists)
+		adjacency_object = np.empty(adjacency[count].nvertices, dtype = object)
+		for j, neighbours in enumerate(adjacency[count].tolist()):
+			adjacency_object[j] = neighbours
+		np.save("%s_adjacency_dist_%.1f_mm" % (hemi,i),adjacency_object)
 		count += 1
 
 def getArgumentParser(ap = ap.ArgumentParser(description = DESCRIPTION)):
@@ -107,6 +73,27 @@ def getArgumentParser(ap = ap.ArgumentParser(description = DESCRIPTION)):
 		metavar = ('Float'),
 		default = [0.5],
 		type=float)
+	ap.add_argument("-gm", "--geodesicmethod", 
+		help = "Geodesic distance algorithm. exact: exact polyhedral distances; subdivision: shortest paths on the edges subdivided by --subdivisionlevel nodes; dijkstra: shortest paths along the mesh edges. The approximate methods overestimate distances. default: %(default)s).", 
+		choices = GEODESIC_METHODS,
+		default = 'exact')
+	ap.add_argument("--subdivisionlevel", 
+		nargs = 1, 
+		help = "[number of nodes added to each edge] for -gm subdivision. default: %(default)s).", 
+		metavar = ('int'),
+		default = [2],
+		type=int)
+	ap.add_argument("--accuracyreport", 
+		nargs = 1, 
+		help = "[number of sources] Report the accuracy of the selected approximate method against the exact method for a random sample of sources.", 
+		metavar = ('int'),
+		default = [0],
+		type=int)
+	ap.add_argument("--cachedir", 
+		nargs = 1, 
+		help = "[PATH/TO/CACHE] Store the geodesic distance lists in a cache directory keyed by the mesh, so they are only computed once for each surface. default: $TM_GEODESIC_CACHE", 
+		metavar = ('PATH'),
+		default = [os.environ.get("TM_GEODESIC_CACHE")])
 	return ap
 
 def run(opts):
@@ -114,11 +101,18 @@ def run(opts):
 	max_dist=float(opts.distance[1])
 	step=float(opts.stepsize[0])
 	projfrac=float(opts.projectfraction[0])
+	cache = None
+	if opts.cachedir[0]:
+		cache = GeodesicCache(opts.cachedir[0])
 
 	if np.divide(max_dist-min_dist,step).is_integer():
 		max_dist+=step
-		compute_adjacency('lh', min_dist, max_dist,projfrac,step)
-		compute_adjacency('rh', min_dist, max_dist,projfrac,step)
+		for hemi in ['lh','rh']:
+			compute_adjacency(hemi, min_dist, max_dist,projfrac,step,
+				method = opts.geodesicmethod,
+				subdivision_level = opts.subdivisionlevel[0],
+				nreport = opts.accuracyreport[0],
+				cache = cache)
 	else:
 		print("The difference between max and min distance must be evenly divisible by the step size.")
 		exit()
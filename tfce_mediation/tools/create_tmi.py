@@ -24,8 +24,8 @@ import nibabel as nib
 import argparse as ap
 
 from tfce_mediation.pyfunc import convert_mni_object, convert_fs, convert_gifti, convert_ply
-from tfce_mediation.tm_io import write_tm_filetype, read_tm_filetype
-from tfce_mediation.pyfunc import zscaler
+from tfce_mediation.tm_io import write_tm_filetype, append_tm_filetype, load_adjacency, read_tmi_index
+from tfce_mediation.pyfunc import zscaler, open_voxel_neuroimage, import_voxel_neuroimage, import_voxel_neuroimages, MaskedImageCache
 
 def maskdata(data):
 	if data.ndim==4:
@@ -51,6 +51,60 @@ def maskdata(data):
 		exit()
 	return (data, mask)
 
+# Masked, concatenated images that are only loaded when their subjects are written to the tmi file (see write_tm_filetype).
+# The images of each block of subjects are read concurrently (see import_voxel_neuroimages).
+class ConcatenatedImages(object):
+	def __init__(self, filenames, mask_data, scale = False, nthreads = 1, cache = None):
+		self.filenames = filenames
+		self.mask_data = mask_data
+		self.scale = scale
+		self.nthreads = nthreads
+		self.cache = cache
+		nvolumes = []
+		if cache is not None:
+			mask_key = cache.mask_key(mask_data)
+		for filename in filenames:
+			cached = cache.get(cache.filename(filename, mask_key)) if cache is not None else None
+			if cached is not None:
+				nvolumes.append(cached.shape[1])
+			else:
+				imgshape = open_voxel_neuroimage(filename).shape
+				nvolumes.append(imgshape[3] if len(imgshape) > 3 else 1)
+		self.offsets = np.concatenate(([0], np.cumsum(nvolumes))).astype(int)
+		self.shape = (int(np.count_nonzero(mask_data)), int(self.offsets[-1]))
+		self.ndim = 2
+		self.dtype = np.dtype(np.float32)
+		self._cache = {}
+
+	def load(self, first, last):
+		# images of the previous block are kept, so images that span blocks are only read once
+		missing = [i for i in range(first, last + 1) if i not in self._cache]
+		if len(missing) > 0:
+			tempdata = import_voxel_neuroimages([self.filenames[i] for i in missing], self.mask_data, self.nthreads, cache = self.cache)
+			start = 0
+			for i in missing:
+				nvolumes = self.offsets[i+1] - self.offsets[i]
+				self._cache[i] = tempdata[:, start:start + nvolumes]
+				if self.scale:
+					self._cache[i] = zscaler(self._cache[i].T).T
+				start += nvolumes
+		self._cache = dict([(i, self._cache[i]) for i in range(first, last + 1)])
+		return np.column_stack([self._cache[i] for i in range(first, last + 1)])
+
+	def __getitem__(self, key):
+		rows, columns = key
+		start, stop, _ = columns.indices(self.shape[1])
+		first = np.searchsorted(self.offsets, start, 'right') - 1
+		last = np.searchsorted(self.offsets, stop, 'left') - 1
+		data = self.load(first, last)
+		return data[rows, start - self.offsets[first]:stop - self.offsets[first]]
+
+	def __array__(self, dtype = None):
+		data = self[:, :]
+		if dtype is not None:
+			data = data.astype(dtype)
+		return data
+
 DESCRIPTION = "Build a tmi file."
 
 #arguments parser
@@ -147,7 +201,37 @@ def getArgumentParser(ap = ap.ArgumentParser(description = DESCRIPTION, formatte
 		const='binary',
 		nargs='?',
 		choices=['binary','ascii'],
-		help="Set output type. (default: %(default)s). The ascii option will not store adjacency objects.")
+		help="Set output type. (default: %(default)s).")
+	ap.add_argument("--cachedir",
+		nargs=1,
+		metavar=('DIR'),
+		help="Cache the masked images of -c_i in a directory, so that re-runs with the same images and mask skip reading them.")
+	ap.add_argument("--cachesize",
+		nargs=1,
+		type=float,
+		default=[10.0],
+		metavar=('GB'),
+		help="Maximum size of the cache in GB. The least recently used images are removed. Default: %(default)s.")
+	ap.add_argument("--gzip",
+		action='store_true',
+		help="Write the ascii output as a gzip stream (*.ascii.tmi.gz). Requires --outputtype ascii.")
+	ap.add_argument("--compress",
+		choices=['zlib','lzma'],
+		help="Store the data array in compressed chunks (binary output only).")
+	ap.add_argument("--quantise",
+		choices=['float16','int16'],
+		help="Store the data array as float16 or scaled int16 chunks (binary output only). Quantisation is lossy.")
+	ap.add_argument("--chunksize",
+		nargs=2,
+		type=int,
+		metavar=('INT', 'INT'),
+		help="Chunk size of the data array [vertices/voxels] [subjects]. Default: 4096 256.")
+	ap.add_argument("-nt", "--numthreads",
+		nargs=1,
+		type=int,
+		default=[1],
+		metavar=('INT'),
+		help="Number of threads used to read the images of -c_i and to compress the data array chunks. Default: %(default)s.")
 
 	return ap
 
@@ -172,42 +256,30 @@ def run(opts):
 			else:
 				outname += '.ascii.tmi'
 	if opts.append:
+		# new elements are appended in place (see append_tm_filetype)
 		outname = opts.append[0]
-		_, image_array, masking_array, maskname, affine_array, vertex_array, face_array, surfname, adjacency_array, tmi_history, subjectids = read_tm_filetype(outname)
 
 	if opts.inputimages:
 		for i in range(len(opts.inputimages)):
-			basename, file_ext = os.path.splitext(opts.inputimages[i])
-			if file_ext == '.gz':
-
-				os.system("zcat %s > %s" % (opts.inputimages[i],basename))
-				img = nib.load('%s' % basename)
-			else:
-				img = nib.load(opts.inputimages[i])
-			img_data = img.get_data()
-
-
+			img = open_voxel_neuroimage(opts.inputimages[i])
 			if opts.inputmasks:
 				mask = nib.load(opts.inputmasks[i])
 				mask_data = mask.get_data()
-				if not np.array_equal(img_data.shape[:3], mask_data.shape[:3]):
+				if not np.array_equal(img.shape[:3], mask_data.shape[:3]):
 					print("Error mask data dimension do not fit image dimension")
 					exit()
 				mask_data = mask_data==1
-				img_data = img_data[mask_data]
+				# only the masked voxels are read
+				img_data = import_voxel_neuroimage(opts.inputimages[i], mask_data)
 			else:
-				img_data, mask_data = maskdata(img_data)
+				img_data, mask_data = maskdata(img.get_data())
 			masking_array.append(np.array(mask_data))
 			image_array.append(np.array(img_data))
 			affine_array.append(img.affine)
 			maskname.append(np.array(os.path.basename(opts.inputimages[i])))
-			if file_ext == '.gz':
-				os.system("rm %s" % basename)
 
 	if opts.concatenateimages:
 		img = nib.load(opts.concatenateimages[0])
-		img_data = img.get_data()
-		numMerge=len(opts.concatenateimages)
 
 		if opts.inputmasks:
 			if not len(opts.inputmasks)==1:
@@ -215,29 +287,20 @@ def run(opts):
 				exit()
 			mask = nib.load(opts.inputmasks[0])
 			mask_data = mask.get_data()
-			if not np.array_equal(img_data.shape[:3], mask_data.shape[:3]):
+			if not np.array_equal(img.shape[:3], mask_data.shape[:3]):
 				print("Error mask data dimension do not fit image dimension")
 				exit()
 			mask_data = mask_data==1
-			img_data = img_data[mask_data].astype(np.float32)
 		else:
 			print("Creating mask from first image.")
-			img_data, mask_data = maskdata(img_data)
-
-		for i in range(numMerge):
-			print("merging image %s" % opts.concatenateimages[i])
-			if i > 0:
-				tempdata = nib.load(opts.concatenateimages[i]).get_data()
-				tempdata = tempdata[mask_data].astype(np.float32)
-				if opts.scale: 
-					tempdata = zscaler(tempdata.T).T
-				img_data = np.column_stack((img_data,tempdata))
-			else:
-				if opts.scale: 
-					img_data = zscaler(img_data.T).T
+			_, mask_data = maskdata(img.get_data())
 
+		# the images are streamed into the tmi file when it is written, instead of being held in memory
 		masking_array.append(np.array(mask_data))
-		image_array.append(np.array(img_data))
+		cache = None
+		if opts.cachedir:
+			cache = MaskedImageCache(opts.cachedir[0], max_bytes = opts.cachesize[0] * 1024**3)
+		image_array.append(ConcatenatedImages(opts.concatenateimages, mask_data, scale = opts.scale, nthreads = opts.numthreads[0], cache = cache))
 		affine_array.append(img.affine)
 		if opts.concatenatename:
 			maskname.append(np.array(os.path.basename(opts.concatenatename[0])))
@@ -309,28 +372,53 @@ def run(opts):
 			surfname.append(np.array(os.path.basename(opts.inputply[i])))
 	if opts.inputadjacencyobject:
 		for i in range(len(opts.inputadjacencyobject)):
-			adjacency_array.append(np.load(str(opts.inputadjacencyobject[i])))
-		if not np.equal(len(adjacency_array),len(masking_array)):
-			if not len(adjacency_array) % len(masking_array) == 0:
+			adjacency_array.append(load_adjacency(str(opts.inputadjacencyobject[i])))
+		num_masks = len(masking_array)
+		if opts.append:
+			# the masks of the existing tmi file are not read in append mode
+			num_masks += len([e for e in read_tmi_index(outname)['elements'] if e['element'] == 'masking_array'])
+		if (num_masks > 0) and not np.equal(len(adjacency_array),num_masks):
+			if not len(adjacency_array) % num_masks == 0:
 				print("Number of adjacency objects does not match number of images.")
 			else:
 				print("Error number of adjacency objects is not divisable by the number of masking arrays.")
 				exit()
 
 	if opts.inputcolumnnames:
+		if opts.append and (len(image_array) > 0):
+			print("Error: column names cannot be added when appending images (the appended masks have the same subjects as the tmi file).")
+			quit()
 		columnids = np.genfromtxt(opts.inputcolumnnames[0], delimiter=',', dtype=str)
 		if columnids.ndim != 1:
 			print("Error: column names must be a one dimensional array")
 			quit()
-		if columnids.shape[0] != image_array[0].shape[1]:
+		if (len(image_array) > 0) and (columnids.shape[0] != image_array[0].shape[1]):
 			print("Column name length %d does not match data array length %d" % (columnids.shape[0],image_array[0].shape[1]))
 			quit()
 
+	# a single data source (e.g., concatenated images) is written without stacking it in memory first
+	has_data = len(image_array) > 0
+	if len(image_array) == 1:
+		image_array = image_array[0]
+	elif len(image_array) > 1:
+		image_array = np.vstack(image_array)
+
 	# Write tmi file
-	if not image_array==[]:
+	if opts.append:
+		append_tm_filetype(outname,
+			data_rows = image_array,
+			masking_array = masking_array,
+			maskname = maskname,
+			affine_array = affine_array,
+			vertex_array = vertex_array,
+			face_array = face_array,
+			surfname = surfname,
+			adjacency_array = adjacency_array,
+			columnids = columnids)
+	elif has_data:
 		write_tm_filetype(outname, 
 			output_binary = opts.outputtype=='binary',
-			image_array = np.vstack(image_array),
+			image_array = image_array,
 			masking_array = masking_array,
 			maskname = maskname,
 			affine_array = affine_array,
@@ -340,7 +428,12 @@ def run(opts):
 			adjacency_array = adjacency_array,
 			columnids = columnids,
 			checkname = False,
-			tmi_history=tmi_history)
+			tmi_history=tmi_history,
+			output_gzip = opts.gzip,
+			chunkshape = opts.chunksize,
+			compression = opts.compress,
+			quantisation = opts.quantise,
+			nthreads = opts.numthreads[0])
 	else:
 		write_tm_filetype(outname,
 			output_binary = opts.outputtype=='binary',
@@ -353,7 +446,8 @@ def run(opts):
 			adjacency_array = adjacency_array,
 			columnids = columnids,
 			checkname = False,
-			tmi_history = tmi_history)
+			tmi_history = tmi_history,
+			output_gzip = opts.gzip)
 
 if __name__ == "__main__":
 	parser = getArgumentParser()
@@ -16,11 +16,11 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import os
 import sys
-import numpy as np
 import argparse as ap
 
+from tfce_mediation.tm_io import read_tmi_index, tmi_data_shape
+
 
 
 
@@ -63,105 +63,44 @@ def run(opts):
 		opts.outputshapeinfo = True
 
 	tm_file = opts.inputtmi[0]
-	# getfilesize
-	filesize = os.stat(tm_file).st_size
-	# declare variables
-	element = []
-	element_dtype = []
-	element_nbyte = []
-	element_nmasked = []
-	datashape = []
-	maskshape = []
-	maskname = []
-	vertexshape = []
-	faceshape = []
-	surfname = []
-	affineshape = []
-	adjlength = []
-	maskcounter=0
-	vertexcounter=0
-	affinecounter=0
-	adjacencycounter=0
-	tmi_history = []
-
-	# read first line
-	obj = open(tm_file)
-	reader = obj.readline().strip().split()
-	firstword=reader[0]
-	if firstword != 'tmi':
-		print("Error: not a TFCE_mediation image.")
-		exit()
-	reader = obj.readline().strip().split()
-	firstword=reader[0]
-	if firstword != 'format':
-		print("Error: unknown reading file format")
-		exit()
-	else:
-		tm_filetype = reader[1]
-		tmi_version = reader[2]
-
-	linecounter=0
-	while firstword != 'end_header':
-		linecounter+=1
-		reader = obj.readline().strip().split()
-		firstword=reader[0]
-		if firstword=='element':
-			element.append((reader[1]))
-		if firstword=='dtype':
-			element_dtype.append((reader[1]))
-		if firstword=='nbytes':
-			element_nbyte.append((reader[1]))
-		if firstword=='datashape':
-			datashape.append(np.array((reader[1], reader[2])).astype(np.int))
-		if firstword=='nmasked':
-			element_nmasked.append(( int(reader[1]) ))
-			maskcounter+=1 #dirty
-		if firstword=='maskshape':
-			maskshape.append(np.array((reader[1], reader[2], reader[3])).astype(np.int))
-		if firstword=='maskname':
-			maskname.append((reader[1]))
-		if firstword=='affineshape':
-			affineshape.append(np.array((reader[1], reader[2])).astype(np.int))
-			affinecounter+=1 #dirty
-		if firstword=='vertexshape':
-			vertexshape.append(np.array((reader[1], reader[2])).astype(np.int))
-			vertexcounter+=1 #dirty
-		if firstword=='faceshape':
-			faceshape.append(np.array((reader[1], reader[2])).astype(np.int))
-		if firstword=='surfname':
-			surfname.append((reader[1]))
-		if firstword=='adjlength':
-			adjlength.append(np.array(reader[1]).astype(np.int))
-			adjacencycounter+=1 #dirty
-		if firstword=='history':
-			tmi_history.append(str(' '.join(reader)))
-	# skip header
-	position = filesize
-	for i in range(len(element_nbyte)):
-		position-=int(element_nbyte[i])
+	index = read_tmi_index(tm_file)
+	tmi_history = index['history']
+	masks = [e for e in index['elements'] if e['element'] == 'masking_array']
+	vertices = [e for e in index['elements'] if e['element'] == 'vertex']
+	faces = [e for e in index['elements'] if e['element'] == 'face']
+	affines = [e for e in index['elements'] if e['element'] == 'affine']
+	adjacency = [e for e in index['elements'] if e['element'] in ['adjacency_csr', 'adjacency_object']]
 
 	if opts.outputbasicinfo:
 		print("--- Basic Information ---")
-		for i in range(len(element)):
-			if element[i]=='data_array':
-				print(("Data array shape: %dx%d [masked data length by # images (subjects)]" % (datashape[0][0],datashape[0][1])))
-		print(("Number of masks: %d" % maskcounter))
-		print(("Number of affines: %d" % affinecounter))
-		print(("Number of surfaces: %d" % vertexcounter))
-		print(("Number of adjacency sets: %d" % adjacencycounter))
+		for e in index['elements']:
+			if e['element'] == 'data_array':
+				datashape = tmi_data_shape(index)
+				print(("Data array shape: %dx%d [masked data length by # images (subjects)]" % (datashape[0],datashape[1])))
+				if 'datachunks' in e:
+					print(("Data array storage: %d chunks of %dx%d (compression: %s, quantisation: %s)" % (len(e['chunkindex']), e['datachunks'][0], e['datachunks'][1], e['compression'], e['quantisation'])))
+		print(("Number of masks: %d" % len(masks)))
+		print(("Number of affines: %d" % len(affines)))
+		print(("Number of surfaces: %d" % len(vertices)))
+		print(("Number of adjacency sets: %d" % len(adjacency)))
 		print ("")
 
 	if opts.fileformat:
 			print("--- File Information ---")
-			print("File type: %s" % tm_filetype)
-			print("Version: %s\n" % tmi_version)
+			print("File type: %s" % index['filetype'])
+			print("Version: %s" % index['version'])
+			print("Compression: %s\n" % ('gzip' if index.get('gzip', False) else 'none'))
 
 	if opts.headersize:
 		print("--- Header Information ---")
-		if tm_filetype == 'ascii':
-			print("Header size: %d lines\n" % (linecounter+2))
+		if index['filetype'] == 'ascii':
+			print("Header size: %d lines\n" % index['header_nlines'])
 		else:
-			print("Header size: %d bytes, %d lines\n" % (position,linecounter+2))
+			print("Header size: %d bytes, %d lines\n" % (index['header_nbytes'], index['header_nlines']))
+		for e in index['elements']:
+			if e['offset'] is not None:
+				print("%s: %s %s, offset %d, %d bytes" % (e['element'], e.get('dtype'), 'x'.join([str(i) for i in e.get('shape', [])]), e['offset'], e['nbytes']))
+		print("")
 
 	if opts.outputhistory: # in future, make this into a function
 		print("--- History ---")
@@ -186,19 +125,19 @@ def run(opts):
 
 	if opts.outputmaskinfo:
 		print("--- Mask Information ---")
-		for i in range(len(maskname)):
+		for i in range(len(masks)):
 			print("Mask element %d" % i)
-			print("Mask name: %s" % maskname[i])
-			print("Mask size: %s" % element_nmasked[i])
-			print(("Mask shape: %s %s %s\n" % (maskshape[i][0],maskshape[i][1],maskshape[i][2]) ))
+			print("Mask name: %s" % masks[i].get('maskname', 'unknown'))
+			print("Mask size: %s" % masks[i]['nmasked'])
+			print(("Mask shape: %s %s %s\n" % (masks[i]['shape'][0],masks[i]['shape'][1],masks[i]['shape'][2]) ))
 
 	if opts.outputshapeinfo:
 		print("--- Shape Information ---")
-		for i in range(len(surfname)):
+		for i in range(len(vertices)):
 			print("Shape element %d" % i)
-			print("Shape name: %s" % surfname[i])
-			print(("Vertices: %s %s" % (vertexshape[i][0],vertexshape[i][1]) ))
-			print(("Faces: %s %s\n" % (faceshape[i][0],faceshape[i][1]) ))
+			print("Shape name: %s" % vertices[i].get('surfname', 'unknown'))
+			print(("Vertices: %s %s" % (vertices[i]['shape'][0],vertices[i]['shape'][1]) ))
+			print(("Faces: %s %s\n" % (faces[i]['shape'][0],faces[i]['shape'][1]) ))
 
 if __name__ == "__main__":
 	parser = getArgumentParser()
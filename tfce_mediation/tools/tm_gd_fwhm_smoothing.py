@@ -21,17 +21,17 @@ import os
 import numpy as np
 import nibabel as nib
 import argparse as ap
-from scipy.stats import norm
 
-from tfce_mediation.pyfunc import loadmgh
-from tfce_mediation.cynumstats import calc_gd_fwhm
+from tfce_mediation.pyfunc import gd_fwhm_kernel, apply_sparse_kernel, save_masked_volumes
+from tfce_mediation.adjacency import compute_distance_pairs
+from tfce_mediation.tm_io import GeodesicCache
 
-DESCRIPTION = "Geodesic FHWM smoothing using accurate distances at midthickness surface. Expect processing to take ~4 minutes."
+DESCRIPTION = "Geodesic FHWM smoothing using accurate distances at midthickness surface. The input can be a single surface image or a 4D image of all subjects (e.g., lh.all.thickness.00.mgh). The smoothing kernel is built once (and cached with --cachedir) and applied to all subjects."
 
 def getArgumentParser(ap = ap.ArgumentParser(description = DESCRIPTION, formatter_class=ap.RawTextHelpFormatter)):
 	ap.add_argument("-i", "--input", 
 		nargs=1, 
-		help="input surface image to smooth", 
+		help="input surface image to smooth (3D or 4D)", 
 		metavar=('*.mgh'), 
 		required=True)
 	ap.add_argument("-o", "--output", 
@@ -50,11 +50,34 @@ def getArgumentParser(ap = ap.ArgumentParser(description = DESCRIPTION, formatte
 		nargs=1, 
 		default=[3.0],
 		metavar=('FLOAT'))
-	ap.add_argument("-d","--distanceslist", 
+	distgroup = ap.add_mutually_exclusive_group(required=True)
+	distgroup.add_argument("-d","--distanceslist", 
 		nargs=1, 
 		help="Input the precomputed fwhm distances (can be downloaded from tm_addons). Note, the *_indices.npy file must be in the same directory.", 
-		metavar=('/path/to/?h_8.0mm_fwhm_distances.npy'), 
-		required=True)
+		metavar=('/path/to/?h_8.0mm_fwhm_distances.npy'))
+	distgroup.add_argument("-s","--surface", 
+		nargs=1, 
+		help="Compute the fwhm distances from a freesurfer surface (e.g., ?h.midthickness from create_adjacency_list). Use with --cachedir to only compute them once.", 
+		metavar=('/path/to/?h.midthickness'))
+	ap.add_argument("-t","--distancethreshold", 
+		help="For -s, the maximum geodesic distance (mm) of the distance lists. Default: 3 x FWHM", 
+		type=float,
+		nargs=1, 
+		metavar=('FLOAT'))
+	ap.add_argument("-nt","--numthreads", 
+		help="The number of threads used to compute the distances (-s) and to smooth the subjects. Default: %(default)s", 
+		type=int,
+		nargs=1, 
+		default=[1],
+		metavar=('INT'))
+	ap.add_argument("--cachedir", 
+		nargs=1, 
+		help="Store the smoothing kernel for each FWHM (and for -s, the distance lists) in a cache directory. Default: $TM_GEODESIC_CACHE", 
+		default=[os.environ.get("TM_GEODESIC_CACHE")],
+		metavar=('PATH'))
+	ap.add_argument("--lowram", 
+		help="Write the smoothed subjects to a temporary memory-mapped file instead of RAM. Uncompressed (*.mgh) inputs are always memory-mapped.", 
+		action='store_true')
 	ap.add_argument("--correct_surface", 
 		nargs=1,
 		help="Experimental. Corrects extreme outliers. Enter the number of standard deviations (sigmas) constitutes an outlier (e.g. for 3 standard deviatiosn, --correct_surface 3.0). This should not be used with after performing a Box-Cox transformation.", 
@@ -65,39 +88,84 @@ def getArgumentParser(ap = ap.ArgumentParser(description = DESCRIPTION, formatte
 def run(opts):
 
 	scriptwd = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
-	img, data = loadmgh(opts.input[0])
+	if not os.path.exists(opts.input[0]):
+		print("Cannot find input image: %s" % opts.input[0])
+		exit()
+	img = nib.freesurfer.mghformat.load(opts.input[0])
 	outname = str(opts.output[0])
 	hemi = str(opts.hemi[0])
 	fwhm = float(opts.geodesicfwhm[0])
-	sigma = fwhm / np.sqrt(8 * np.log(2))
+	nthreads = int(opts.numthreads[0])
 
-	# load distances and indices 
-	dist = np.load(opts.distanceslist[0])
-	basenamefwhm = opts.distanceslist[0].split('_distances.npy',1)[0]
-	indices = np.load('%s_indices.npy' % basenamefwhm)
+	# vertices x subjects (memory-mapped for uncompressed images)
+	data = np.asanyarray(img.dataobj)
+	nvertices = data.shape[0]
+	data = data.reshape(nvertices, -1, order = 'F')
 
 	cortex_index = np.load('%s/adjacency_sets/%s_cortex_mask_index.npy' % (scriptwd,hemi))
-	distmask_index_start = np.in1d(indices[:,0], cortex_index)
-	distmask_index_end = np.in1d(indices[:,1], cortex_index)
-	distmask_index = distmask_index_start & distmask_index_end
-
-	# mask out non-cortex values
-	indices_masked = indices[distmask_index]
-	dist_masked = dist[distmask_index]
+	cache = None
+	if opts.cachedir[0]:
+		cache = GeodesicCache(opts.cachedir[0])
+
+	# load (or compute) distances and indices 
+	if opts.surface:
+		v, f = nib.freesurfer.read_geometry(opts.surface[0])
+		threshold = 3 * fwhm
+		if opts.distancethreshold:
+			threshold = opts.distancethreshold[0]
+		distances_key = None
+		if cache is not None:
+			distances_key = "%s %1.4f" % (cache.mesh_key(v, f), threshold)
+	else:
+		basenamefwhm = opts.distanceslist[0].split('_distances.npy',1)[0]
+		distances_key = None
+		if cache is not None:
+			distances_key = "%s %s" % (cache.file_key(opts.distanceslist[0]), cache.file_key('%s_indices.npy' % basenamefwhm))
+
+	kernel = None
+	if cache is not None:
+		kernel_key = cache.kernel_key(distances_key, fwhm, cortex_index)
+		kernel = cache.get_kernel(kernel_key)
+	if kernel is None:
+		if opts.surface:
+			source, target, dist = compute_distance_pairs(v, f, threshold, nthreads = nthreads, cache = cache)
+			indices = np.column_stack((source, target))
+		else:
+			dist = np.load(opts.distanceslist[0])
+			indices = np.load('%s_indices.npy' % basenamefwhm)
+		# mask out non-cortex values
+		kernel = gd_fwhm_kernel(indices, dist, fwhm, nvertices, mask_index = cortex_index)
+		if cache is not None:
+			cache.put_kernel(kernel_key, kernel)
 
 	if opts.correct_surface:
 		multipler = opts.correct_surface[0]
-		y = data[cortex_index].flatten()
-		(mu, sigma) = norm.fit(y)
+		data = np.array(data, dtype = np.float32)
+		y = data[cortex_index]
+		(mu, sigma) = (y.mean(0), y.std(0)) # norm.fit of each subject
 		cthresh = multipler*sigma + mu
-		print("The upper threshold is: %1.4f" % cthresh)
-		data[data>cthresh] = cthresh
-
-	smoothed = calc_gd_fwhm(indices_masked.astype(np.int32, order='c'), dist_masked.astype(np.float32, order='c'), data[:,0,0].astype(np.float32, order = "c"), sigma)
-
-	outdata = np.zeros_like(data)
-	outdata[cortex_index,0,0] = smoothed[cortex_index]
-	nib.save(nib.freesurfer.mghformat.MGHImage(outdata,img.affine),outname)
+		if cthresh.shape[0] == 1:
+			print("The upper threshold is: %1.4f" % cthresh[0])
+		else:
+			print("The upper thresholds are: %1.4f to %1.4f" % (cthresh.min(), cthresh.max()))
+		np.minimum(data, cthresh[None,:], out = data)
+
+	if opts.lowram:
+		tempname = '%s.smooth_temp.npy' % outname
+		smoothed = np.lib.format.open_memmap(tempname, mode = 'w+', dtype = np.float32, shape = data.shape)
+	else:
+		smoothed = np.zeros(data.shape, dtype = np.float32)
+	apply_sparse_kernel(kernel, data, out = smoothed, nthreads = nthreads)
+	noncortex = np.ones(nvertices, dtype = bool)
+	noncortex[cortex_index] = False
+	smoothed[noncortex] = 0
+
+	if len(img.shape) == 3:
+		smoothed = smoothed[:,0]
+	save_masked_volumes(smoothed, img, np.ones(img.shape[:3], dtype = bool), outname, output_mgh = True)
+	if opts.lowram:
+		del smoothed
+		os.remove(tempname)
 
 if __name__ == "__main__":
 	parser = getArgumentParser()
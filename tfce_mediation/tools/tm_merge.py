@@ -21,7 +21,8 @@ import numpy as np
 import nibabel as nib
 import argparse as ap
 from tfce_mediation.pyfunc import *
-from tfce_mediation.pyfunc import zscaler
+from tfce_mediation.pyfunc import zscaler, open_voxel_neuroimage, import_voxel_neuroimages, save_masked_volumes, MaskedImageCache
+from tfce_mediation.tm_io import write_tm_filetype
 from sklearn.decomposition import FastICA
 
 DESCRIPTION = "Efficient merging for Nifti or MGH images"
@@ -34,7 +35,7 @@ def getArgumentParser(ap = ap.ArgumentParser(description = DESCRIPTION, formatte
 	datatype.add_argument("--vertex", 
 		help="Vertex input",
 		action="store_true")
-	ap.add_argument("-o", "--output", nargs=1, help="[4D_image]", metavar=('*.nii.gz or *.mgh'), required=True)
+	ap.add_argument("-o", "--output", nargs=1, help="[4D_image]. The merged (masked) images can also be written to a tmi file.", metavar=('*.nii.gz, *.mgh, or *.tmi'), required=True)
 	ap.add_argument("-i", "--input", nargs='+', help="[3Dimage] ...", metavar=('*.nii.gz or *.mgh'), required=True)
 	ap.add_argument("-m", "--mask", nargs=1, help="[3Dimage]", metavar=('*.nii.gz or *.mgh'))
 	ap.add_argument("-s", "--scale",action = 'store_true')
@@ -42,43 +43,60 @@ def getArgumentParser(ap = ap.ArgumentParser(description = DESCRIPTION, formatte
 		help="Independent component analysis. Input the number of components (e.g.,--fastica 8 for eight components). Outputs the recovered sources, and the component fit for each subject. (recommended to scale first)",
 		nargs=1,
 		metavar=('INT'))
+	ap.add_argument("-nt", "--numthreads",
+		help="Number of images that are read concurrently. Default: %(default)s",
+		nargs=1,
+		type=int,
+		default=[1],
+		metavar=('INT'))
+	ap.add_argument("--lowram",
+		help="Merge the images into a temporary memory-mapped file (OUTPUT.merge_temp.npy) instead of RAM. The output is written one volume at a time.",
+		action="store_true")
+	ap.add_argument("--cachedir",
+		help="Cache the masked images in a directory, so that re-runs with the same images and mask skip reading them.",
+		nargs=1,
+		metavar=('DIR'))
+	ap.add_argument("--cachesize",
+		help="Maximum size of the cache in GB. The least recently used images are removed. Default: %(default)s",
+		nargs=1,
+		type=float,
+		default=[10.0],
+		metavar=('GB'))
 	return ap
 
 def run(opts):
-	if opts.voxel:
-		img, img_data = loadnifti(opts.input[0])
-	if opts.vertex:
-		img, img_data = loadmgh(opts.input[0])
-	numMerge=len(opts.input)
+	img = open_voxel_neuroimage(opts.input[0])
 	outname=opts.output[0]
 
 	if opts.mask:
-		if opts.voxel:
-			mask , data_mask = loadnifti(opts.mask[0])
-		if opts.vertex:
-			mask , data_mask = loadmgh(opts.mask[0])
+		data_mask = open_voxel_neuroimage(opts.mask[0]).get_data()
 		mask_index = data_mask>0.99
 	else:
-		mask_index = np.zeros((img_data.shape[0],img_data.shape[1],img_data.shape[2]))
-		mask_index = (mask_index == 0)
-	img_data_trunc = img_data[mask_index].astype(np.float32)
-	if opts.scale: 
-		img_data_trunc = zscaler(img_data_trunc.T).T
-
-	for i in range(numMerge):
-		print("merging image %s" % opts.input[i])
-		if i > 0:
-			if opts.voxel:
-				_, tempimgdata = loadnifti(opts.input[i])
-			if opts.vertex:
-				_, tempimgdata = loadmgh(opts.input[i])
-			tempimgdata=tempimgdata[mask_index].astype(np.float32)
-			if opts.scale:
-				tempimgdata = zscaler(tempimgdata.T).T
-			img_data_trunc = np.column_stack((img_data_trunc,tempimgdata))
+		mask_index = np.ones((img.shape[0],img.shape[1],img.shape[2]), dtype=bool)
+
+	# the images are read in parallel, and each is written to its columns of the (preallocated) output
+	cache = None
+	if opts.cachedir:
+		cache = MaskedImageCache(opts.cachedir[0], max_bytes = opts.cachesize[0] * 1024**3)
+	tempname = None
+	if opts.lowram:
+		tempname = '%s.merge_temp.npy' % outname
+	img_data_trunc = import_voxel_neuroimages(opts.input, mask_index, nthreads = opts.numthreads[0], outname = tempname, cache = cache)
+
+	if opts.scale:
+		start = 0
+		for image_path in opts.input:
+			nvolumes = int(np.prod(open_voxel_neuroimage(image_path).shape[3:]))
+			block = img_data_trunc[:, start:start+nvolumes]
+			if nvolumes == 1:
+				block[:, 0] = zscaler(block[:, 0])
+			else:
+				block[:] = zscaler(block.T).T
+			start += nvolumes
 	# remove nan if any
-	img_data_trunc[np.isnan(img_data_trunc)] = 0
-
+	for i in range(0, img_data_trunc.shape[1], 256):
+		block = img_data_trunc[:, i:i+256]
+		block[np.isnan(block)] = 0
 	if opts.fastica:
 		ica = FastICA(n_components=int(opts.fastica[0]),max_iter=5000,  tol=0.0001)
 		S_ = ica.fit_transform(img_data_trunc).T
@@ -110,10 +128,13 @@ def run(opts):
 				savemgh(tempmask[tempmask==1], img, mask_index, 'ICA_temp/mask.mgh')
 
 
-	if opts.voxel:
-		savenifti(img_data_trunc.astype(np.float32), img, mask_index, outname)
-	if opts.vertex:
-		savemgh(img_data_trunc.astype(np.float32), img, mask_index, outname)
+	if outname.endswith('.tmi'):
+		write_tm_filetype(outname, image_array = img_data_trunc, masking_array = [mask_index], maskname = [os.path.basename(outname)], affine_array = [img.affine], checkname = False)
+	else:
+		save_masked_volumes(img_data_trunc, img, mask_index, outname, output_mgh = opts.vertex)
+	if tempname is not None:
+		del img_data_trunc
+		os.remove(tempname)
 
 if __name__ == "__main__":
 	parser = getArgumentParser()
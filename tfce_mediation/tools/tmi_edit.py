@@ -24,7 +24,7 @@ import nibabel as nib
 import argparse as ap
 from time import gmtime, strftime
 
-from tfce_mediation.tm_io import write_tm_filetype, read_tm_filetype
+from tfce_mediation.tm_io import write_tm_filetype, read_tm_filetype, read_tmi_index, load_adjacency
 from tfce_mediation.tm_func import replacemask, replacesurface
 
 def maskdata(data):
@@ -106,7 +106,7 @@ def getArgumentParser(ap = ap.ArgumentParser(description = DESCRIPTION, formatte
 		metavar=('int'),
 		required=False)
 	ap.add_argument("-radj", "--replaceadj",
-		help="Replace existing adjacency with inputted one. Must specifiy adjacency, and input new adjacency (as a *.npy). e.g., -radj 2 lh.midthickness.adj.3mm.npy",
+		help="Replace existing adjacency with inputted one. Must specifiy adjacency, and input new adjacency (as a *.npy or CSR *.npz). e.g., -radj 2 lh.midthickness.adj.3mm.npy",
 		nargs=2,
 		metavar=('int', '*.npy'),
 		required=False)
@@ -131,9 +131,6 @@ def getArgumentParser(ap = ap.ArgumentParser(description = DESCRIPTION, formatte
 
 def run(opts):
 	currentTime=int(strftime("%Y%m%d%H%M%S",gmtime()))
-	# read tmi
-	element, image_array, masking_array, maskname_array, affine_array, vertex_array, face_array, surfname, adjacency_array, tmi_history, columnids = read_tm_filetype(opts.inputtmi[0])
-
 	num_masks = 0
 	num_affines = 0
 	num_surfaces = 0
@@ -146,6 +143,15 @@ def run(opts):
 	if len(sys.argv) <= 4:
 		opts.history = True
 
+	# the history only needs the header index
+	index = read_tmi_index(opts.inputtmi[0])
+	tmi_history = index['history']
+	maskname_array = [e.get('maskname', 'unknown') for e in index['elements'] if e['element'] == 'masking_array']
+	surfname = [e.get('surfname', 'unknown') for e in index['elements'] if e['element'] == 'vertex']
+	if opts.outputstats or not opts.history:
+		# read tmi
+		element, image_array, masking_array, maskname_array, affine_array, vertex_array, face_array, surfname, adjacency_array, tmi_history, columnids = read_tm_filetype(opts.inputtmi[0])
+
 	if opts.outputnewtmi:
 		outname = opts.outputnewtmi[0]
 	else:
@@ -155,9 +161,10 @@ def run(opts):
 	# first, index data array
 	pointer = 0
 	position_array = [0]
-	for i in range(len(masking_array)):
-		pointer += len(masking_array[i][masking_array[i]==True])
-		position_array.append(pointer)
+	for e in index['elements']:
+		if e['element'] == 'masking_array':
+			pointer += e['nmasked']
+			position_array.append(pointer)
 	del pointer
 
 	if opts.outputstats:
@@ -374,12 +381,12 @@ def run(opts):
 	# adjacency sets
 	if opts.replaceadj:
 		original_adj = adjacency_array[int(opts.replaceadj[0])]
-		new_adj = np.load(opts.replaceadj[1])
+		new_adj = load_adjacency(opts.replaceadj[1])
 
-		if not len(original_adj) == len(new_adj):
+		if not original_adj.nvertices == new_adj.nvertices:
 			print("Error. Adjacency set lengths must match.")
 			sys.exit()
-		affine_array[int(opts.replaceadj[0])] = new_adj
+		adjacency_array[int(opts.replaceadj[0])] = new_adj
 		tmi_history.append("history mode_replace %d 1 0 0 0 1" % currentTime)
 		append_history = False
 	if opts.reorderadj:
@@ -449,7 +456,7 @@ def run(opts):
 			arr_size = len(adjacency_array)
 			mask = np.ones(len(adjacency_array), dtype=bool)
 			mask[delete_range] = False
-			adjacency_array = np.array(adjacency_array)[mask]
+			adjacency_array = [adjacency_array[i] for i in np.where(mask)[0]]
 			tmi_history.append("history mode_sub %d 1 0 0 0 %d" % (currentTime,int(len(delete_range))))
 			append_history = False
 		else: 